@@ -35,5 +35,6 @@ from conscan.interface import *
 from conscan.base import *
 from conscan.triangle import *
 from conscan.pair import *
+from conscan.cache import *
 
 
@@ -34,35 +34,185 @@
 
 from molmod import PairSearchIntra, Rotation
 
-from interface import ProgressMessage
-
-import math, numpy, copy
-
-
-__all__ = ["Scanner"]
+from interface import Geometry, ProgressMessage, ResultsMessage, QualityEvaluator
+
+import math, numpy, copy, multiprocessing, heapq, time
+
+
+__all__ = ["EnvironmentTable", "Environment", "Scanner"]
+
+
+class EnvironmentTable(object):
+    """The environments of all points of a geometry in one compressed table
+
+    The neighbors of all environments are stored in flat arrays, ordered by
+    environment, and the slice of environment i is offsets[i]:offsets[i+1].
+    The entries for a given point and neighbor are found by a binary search
+    in the sorted keys, row*size + neighbor, instead of a dictionary per
+    point. The table holds only a few arrays, so it is cheap to pickle.
+    """
+    def __init__(self, ids, offsets, neighbors, deltas, distances, size):
+        self.ids = ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.deltas = deltas
+        self.distances = distances
+        self.size = size
+        counts = offsets[1:] - offsets[:-1]
+        self.rows = numpy.arange(len(ids)).repeat(counts)
+        self.directions = deltas/(distances + (distances == 0.0)).reshape(-1, 1)
+        self.rows_by_id = numpy.zeros(size, int) - 1
+        self.rows_by_id[ids] = numpy.arange(len(ids))
+        keys = self.rows*size + neighbors
+        self.key_order = keys.argsort(kind="mergesort")
+        self.sorted_keys = keys[self.key_order]
+
+    def lookup(self, id, neighbors):
+        """Return the positions of the given neighbors of point id
+
+        The positions refer to the flat arrays. They are -1 when a neighbor
+        is not present in the environment of point id.
+        """
+        neighbors = numpy.asarray(neighbors)
+        row = self.rows_by_id[id]
+        if row < 0 or len(self.sorted_keys) == 0:
+            return numpy.zeros(neighbors.shape, int) - 1
+        keys = row*self.size + neighbors
+        positions = self.sorted_keys.searchsorted(keys).clip(0, len(self.sorted_keys)-1)
+        return numpy.where(self.sorted_keys[positions] == keys, self.key_order[positions], -1)
 
 
 class Environment(object):
-    def __init__(self, id, coordinate):
-        self.id = id
+    """A view on the neighbors of one point in an EnvironmentTable
+
+    The attributes deltas, distances, neighbors and directions are slices of
+    the arrays in the table. Only the id and the coordinate are pickled.
+    """
+    def __init__(self, table, row, coordinate):
+        self.table = table
+        self.row = row
+        self.id = table.ids[row]
         self.coordinate = coordinate
-        deltas = []
-        distances = []
+        self.begin = table.offsets[row]
+        self.end = table.offsets[row+1]
+        self.n = self.end - self.begin
+        self.deltas = table.deltas[self.begin:self.end]
+        self.distances = table.distances[self.begin:self.end]
+        self.neighbors = table.neighbors[self.begin:self.end]
+        self.directions = table.directions[self.begin:self.end]
 
+    def __getstate__(self):
+        return {"id": self.id, "coordinate": self.coordinate}
 
+    def find(self, neighbor):
+        """Return the index of neighbor in this environment, or -1"""
+        position = self.table.lookup(self.id, neighbor)
+        if position < 0:
+            return -1
+        return position - self.begin
 
 
 class EmptyGeometry(Exception):
     pass
 
 
+# The scanner that is shared with the worker processes. The workers are forked
+# after this global is set, such that the scanner and its environments need
+# not to be pickled.
+_pool_scanner = None
+
+
+def _compare_chunk(ids1):
+    return len(ids1), _pool_scanner.compare_chunk(ids1)
+
+
+def quaternions_from_matrices(rotations):
+    """Convert an array of rotation matrices into quaternions
+
+    The scalar part of the quaternions, the first column, is not negative.
+    """
+    rotations = rotations.reshape(-1, 3, 3)
+    diagonals = numpy.array([rotations[:,0,0], rotations[:,1,1], rotations[:,2,2]]).transpose()
+    result = numpy.zeros((len(rotations), 4), float)
+    result[:,0] = 1 + diagonals.sum(axis=1)
+    result[:,1] = 1 + diagonals[:,0] - diagonals[:,1] - diagonals[:,2]
+    result[:,2] = 1 - diagonals[:,0] + diagonals[:,1] - diagonals[:,2]
+    result[:,3] = 1 - diagonals[:,0] - diagonals[:,1] + diagonals[:,2]
+    result = 0.5*numpy.sqrt(result.clip(0, 4))
+    result[:,1] *= numpy.where(rotations[:,2,1] < rotations[:,1,2], -1, 1)
+    result[:,2] *= numpy.where(rotations[:,0,2] < rotations[:,2,0], -1, 1)
+    result[:,3] *= numpy.where(rotations[:,1,0] < rotations[:,0,1], -1, 1)
+    return result
+
+
+class ConnectionHeap(object):
+    """Keeps the best connections by quality, at most one per duplicate key"""
+
+    def __init__(self, size, get_key):
+        self.size = size
+        self.get_key = get_key
+        # key -> connection, for all connections that are currently retained
+        self.connections = {}
+        # A min-heap of (quality, counter, key, connection). Entries whose
+        # connection is no longer retained for their key are stale and are
+        # skipped when popped.
+        self.heap = []
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, connection):
+        key = self.get_key(connection)
+        existing = self.connections.get(key)
+        if existing is not None:
+            if existing.quality < connection.quality:
+                self._push(key, connection)
+        elif len(self.connections) < self.size:
+            self._push(key, connection)
+        else:
+            while self.connections.get(self.heap[0][2]) is not self.heap[0][3]:
+                heapq.heappop(self.heap)
+            if self.heap[0][0] < connection.quality:
+                quality, counter, worst_key, worst = heapq.heappop(self.heap)
+                del self.connections[worst_key]
+                self._push(key, connection)
+
+    def extend(self, connections):
+        for connection in connections:
+            self.add(connection)
+
+    def _push(self, key, connection):
+        self.connections[key] = connection
+        heapq.heappush(self.heap, (connection.quality, self.counter, key, connection))
+        self.counter += 1
+        if len(self.heap) > 2*self.size:
+            # get rid of the stale entries
+            self.heap = [
+                entry for entry in self.heap
+                if self.connections.get(entry[2]) is entry[3]
+            ]
+            heapq.heapify(self.heap)
+
+
 class Scanner(object):
-    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance):
+    # The minimum number of connections that are evaluated at once in
+    # streaming mode.
+    stream_batch_size = 10000
+
+    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, num_workers=1, clash_cutoff=None, top_k=None, stream_interval=5.0, rotation_tolerance=None, translation_tolerance=None, cache=None):
         self.send = send
         self.geometry1 = geometry1
         self.geometry2 = geometry2
         self.action_radius = action_radius
         self.hit_tolerance = hit_tolerance
+        self.num_workers = num_workers
+        self.clash_cutoff = clash_cutoff
+        self.top_k = top_k
+        self.stream_interval = stream_interval
+        self.rotation_tolerance = rotation_tolerance
+        self.translation_tolerance = translation_tolerance
+        self.cache = cache
 
         self.egoscan = (geometry2 is None)
         if self.egoscan:
@@ -72,9 +222,13 @@ class Scanner(object):
         return abs(difference) < self.hit_tolerance
 
     def run(self):
+        if self.top_k is not None:
+            self.run_streaming()
+            return
         # find the connections
         self.generate_connections()
         self.compute_transformations()
+        self.reject_clashes()
         self.evaluate_connections()
         self.eliminate_duplicate_connections()
         # send them to the parent process
@@ -85,6 +239,48 @@ class Scanner(object):
             self.send(connection)
         self.send(ProgressMessage("send_con", maximum, maximum))
 
+    def run_streaming(self):
+        # The connections are generated, evaluated and ranked in batches. Only
+        # the best top_k connections are kept and they are sent to the parent
+        # process every stream_interval seconds, each time as one
+        # ResultsMessage.
+        self.connections = []
+        self.compute_environmental_descriptions()
+        heap = ConnectionHeap(self.top_k, self.get_duplicate_key)
+        maximum = len(self.geometry1.environments)
+        self.send(ProgressMessage("comp_env", 0, maximum))
+        progress = 0
+        pending = []
+        last_sent = time.time()
+        for size, connections in self.iter_compared_chunks():
+            pending.extend(connections)
+            progress += size
+            self.send(ProgressMessage("comp_env", progress, maximum))
+            if len(pending) >= self.stream_batch_size or progress == maximum:
+                self.connections = pending
+                self.compute_transformations()
+                self.reject_clashes()
+                self.evaluate_connections()
+                heap.extend(self.connections)
+                pending = []
+                if progress < maximum and time.time() - last_sent > self.stream_interval:
+                    self.send_results(heap)
+                    last_sent = time.time()
+        self.send_results(heap)
+
+    def send_results(self, heap):
+        connections = dict(heap.connections)
+        if self.rotation_tolerance is not None:
+            connections = self.eliminate_equivalent_transformations(connections)
+        if self.egoscan:
+            connections = self.eliminate_inverse_duplicates(connections)
+        self.connections = connections.values()
+        self.connections.sort(key=(lambda c: -c.quality))
+        maximum = len(self.connections)
+        self.send(ProgressMessage("send_con", 0, maximum))
+        self.send(ResultsMessage(self.connections))
+        self.send(ProgressMessage("send_con", maximum, maximum))
+
     #
     # generate_connections
     #
@@ -96,53 +292,67 @@ class Scanner(object):
 
     def compute_environmental_descriptions(self):
         def setup_env(geometry, action_radius):
-            environments = {}
-            def add_to_environments(ia, ib, delta, distance):
-                env_a = environments.get(ia)
-                if env_a is None:
-                    env_a = Environment(ia, geometry.coordinates[ia])
-                    env_a.deltas = []
-                    env_a.distances = []
-                    env_a.neighbors = []
-                    env_a.reverse_neighbors = {}
-                    environments[ia] = env_a
-                env_a.deltas.append(delta)
-                env_a.distances.append(distance)
-                env_a.neighbors.append(ib)
-                env_a.reverse_neighbors[ib] = len(env_a.reverse_neighbors)
-
-            # now compare 'all' distances
+            tables = None
+            if self.cache is not None:
+                tables = self.cache.load(geometry, action_radius)
+            if tables is None:
+                tables = compute_tables(geometry, action_radius)
+                if self.cache is not None:
+                    self.cache.store(geometry, action_radius, tables)
+
+            table = EnvironmentTable(
+                tables["ids"], tables["offsets"], tables["neighbors"],
+                tables["deltas"], tables["distances"], len(geometry.coordinates),
+            )
+            return table
+
+        def compute_tables(geometry, action_radius):
+            # compare 'all' distances. Each pair is added in both directions.
             lookup = geometry.connect_masks.nonzero()[0]
             psi = PairSearchIntra(geometry.coordinates[geometry.connect_masks], action_radius)
+            pairs = []
+            deltas = []
+            distances = []
             for i1, i2, delta, distance in psi:
-                add_to_environments(lookup[i1], lookup[i2],  delta, distance)
-                add_to_environments(lookup[i2], lookup[i1], -delta, distance)
+                pairs.append((i1, i2))
+                deltas.append(delta)
+                distances.append(distance)
+            pairs = lookup[numpy.array(pairs, int).reshape(-1, 2)]
+            deltas = numpy.array(deltas, float).reshape(-1, 3)
+            distances = numpy.array(distances, float)
 
             # At this time we have for each object a set of vectors that
-            # point to other objects within the range of radius. Now we will
-            # compute some aditional information
-            for env in environments.itervalues():
-                env.n = len(env.deltas)
-                env.deltas = numpy.array(env.deltas)
-                env.distances = numpy.array(env.distances)
-                env.neighbors = numpy.array(env.neighbors)
-                env.directions = (env.deltas.transpose() / (env.distances + (env.distances == 0.0))).transpose()
-
-            return environments
+            # point to other objects within the range of radius. These are
+            # stored as flat arrays, sorted by the first point, with the
+            # offsets of each environment. The sort is stable, such that the
+            # neighbors of a point keep the order in which they were found.
+            firsts = pairs.ravel()
+            seconds = pairs[:,::-1].ravel()
+            deltas = numpy.concatenate([deltas, -deltas], axis=1).reshape(-1, 3)
+            distances = distances.repeat(2)
+            order = firsts.argsort(kind="mergesort")
+            ids = numpy.unique(firsts)
+            counts = numpy.bincount(firsts)[ids]
+            offsets = numpy.zeros(len(ids)+1, int)
+            offsets[1:] = counts.cumsum()
+            return {
+                "ids": ids,
+                "offsets": offsets,
+                "neighbors": seconds[order],
+                "deltas": deltas[order],
+                "distances": distances[order],
+            }
 
         def assign_env(geometry, number):
-            environments = setup_env(geometry, self.action_radius)
-
-            def overlap(environment):
-                for distance in environment.distances:
-                    if self.hit(distance):
-                        return True
-                return False
+            table = setup_env(geometry, self.action_radius)
+            geometry.environment_table = table
 
             # eliminate all environments that might overlap with others
+            overlap = numpy.zeros(len(table.ids), bool)
+            overlap[table.rows[self.hit(table.distances)]] = True
             geometry.environments = dict(
-                (id, environment) for id, environment in environments.iteritems()
-                if not overlap(environment)
+                (table.ids[row], Environment(table, row, geometry.coordinates[table.ids[row]]))
+                for row in (~overlap).nonzero()[0]
             )
 
             if len(geometry.environments) == 0:
@@ -169,18 +379,58 @@ class Scanner(object):
     def compare_environments_pairwise(self):
         #self.output("     Number of environment comparisons: %i\n" % (len(self.geometrys[0].environment) * len(self.geometrys[1].environment)))
 
-        environments1 = self.geometry1.environments
-        environments2 = self.geometry2.environments
-        maximum = len(environments1)
-        for progress, environment1 in enumerate(environments1.itervalues()):
+        maximum = len(self.geometry1.environments)
+        self.send(ProgressMessage("comp_env", 0, maximum))
+        progress = 0
+        for size, connections in self.iter_compared_chunks():
+            self.connections.extend(connections)
+            progress += size
             self.send(ProgressMessage("comp_env", progress, maximum))
-            for environment2 in environments2.itervalues():
-                self.compare_environments(environment1, environment2)
-        self.send(ProgressMessage("comp_env", maximum, maximum))
 
         #self.output("     Number of accepted triangles: %i\n" % len(self.connections))
         #self.output("     Average of accepted triangles per environment-pair: %.2f\n" % (len(self.connections) / (len(self.geometrys[0].environment) * len(self.geometrys[1].environment))))
 
+    def iter_compared_chunks(self):
+        # Yields the number of environments of the first geometry that are
+        # compared and the corresponding connections, chunk by chunk.
+        ids1 = self.geometry1.environments.keys()
+        if self.num_workers == 1:
+            for id1 in ids1:
+                yield 1, self.compare_chunk([id1])
+            return
+
+        # The environments of the first geometry are partitioned in small
+        # chunks, a few per worker for the sake of load balancing. The
+        # results are collected in the order of the chunks, such that the
+        # list of connections is the same as in the serial case.
+        global _pool_scanner
+        chunk_size = max(1, len(ids1)/(4*self.num_workers))
+        chunks = [ids1[i:i+chunk_size] for i in xrange(0, len(ids1), chunk_size)]
+        _pool_scanner = self
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            for size, connections in pool.imap(_compare_chunk, chunks):
+                yield size, connections
+        finally:
+            pool.terminate()
+            pool.join()
+            _pool_scanner = None
+
+    def compare_chunk(self, ids1):
+        # Returns the connections between the given environments of the first
+        # geometry and all environments of the second geometry.
+        connections = self.connections
+        self.connections = []
+        environments1 = self.geometry1.environments
+        environments2 = self.geometry2.environments.values()
+        for id1 in ids1:
+            environment1 = environments1[id1]
+            for environment2 in environments2:
+                self.compare_environments(environment1, environment2)
+        result = self.connections
+        self.connections = connections
+        return result
+
     def compare_environments(self, environment1, environment2):
         raise NotImplementedError
 
@@ -198,6 +448,51 @@ class Scanner(object):
     def compute_transformation(self, connection):
         raise NotImplementedError
 
+    #
+    # reject_clashes
+    #
+
+    def reject_clashes(self):
+        # Only the overlap between the repulsive points is computed, which
+        # is a lower bound for the penalty in the quality function. When it
+        # exceeds the cutoff, the connection is rejected without computing
+        # its full quality.
+        if self.clash_cutoff is None:
+            return
+        maximum = len(self.connections)
+        repulsive1 = ~self.geometry1.connect_masks
+        repulsive2 = ~self.geometry2.connect_masks
+        if maximum == 0 or not repulsive1.any() or not repulsive2.any():
+            self.send(ProgressMessage("rej_clash", maximum, maximum))
+            self.send(ProgressMessage("survived", maximum, maximum))
+            return
+
+        evaluator = QualityEvaluator(
+            Geometry(
+                self.geometry1.coordinates[repulsive1],
+                self.geometry1.connect_masks[repulsive1],
+                self.geometry1.radii[repulsive1],
+            ),
+            Geometry(
+                self.geometry2.coordinates[repulsive2],
+                self.geometry2.connect_masks[repulsive2],
+                self.geometry2.radii[repulsive2],
+            ),
+        )
+        survivors = []
+        for progress in xrange(0, maximum, evaluator.batch_size):
+            self.send(ProgressMessage("rej_clash", progress, maximum))
+            batch = self.connections[progress:progress+evaluator.batch_size]
+            penalties = -evaluator.compute_qualities(batch)
+            survivors.extend(
+                connection for connection, penalty
+                in zip(batch, penalties)
+                if penalty <= self.clash_cutoff
+            )
+        self.send(ProgressMessage("rej_clash", maximum, maximum))
+        self.send(ProgressMessage("survived", len(survivors), maximum))
+        self.connections = survivors
+
     #
     # evaluate_connections
     #
@@ -205,9 +500,10 @@ class Scanner(object):
     def evaluate_connections(self):
         maximum = len(self.connections)
         if maximum > 0:
-            for progress, connection in enumerate(self.connections):
+            evaluator = QualityEvaluator(self.geometry1, self.geometry2)
+            for progress in xrange(0, maximum, evaluator.batch_size):
                 self.send(ProgressMessage("eval_con", progress, maximum))
-                connection.compute_quality(self.geometry1, self.geometry2)
+                evaluator.compute_batch(self.connections[progress:progress+evaluator.batch_size])
         self.send(ProgressMessage("eval_con", maximum, maximum))
 
     #
@@ -226,10 +522,7 @@ class Scanner(object):
         maximum = len(self.connections)
         for connection in self.connections:
             self.send(ProgressMessage("elim_dup", progress, maximum))
-            if isinstance(connection.transformation, Rotation):
-                key = (connection.pairs, numpy.linalg.det(connection.transformation.r) > 0)
-            else:
-                key = connection.pairs
+            key = self.get_duplicate_key(connection)
             existing = stage1.get(key)
             if existing is None:
                 progress += 1
@@ -240,33 +533,105 @@ class Scanner(object):
                     stage1[key] = connection
         self.send(ProgressMessage("elim_dup", maximum, maximum))
 
+        if self.rotation_tolerance is not None:
+            stage1 = self.eliminate_equivalent_transformations(stage1)
+
         if self.egoscan:
-            # Stage 2 is only performed when connections between a building block
-            # and exact copies are searched. In that case, it might happen that
-            # two connection are the same when in one of both connections, the
-            # two building blocks are exchanged. The square of the associated
-            # transformation is the identity matrix.
-            stage2 = {}
-            while len(stage1) > 0:
-                self.send(ProgressMessage("elim_dup", len(stage2), len(stage1) + len(stage2)))
-                key, connection = stage1.popitem()
-                if isinstance(connection.transformation, Rotation):
-                    pairs = key[0]
-                else:
-                    pairs = key
-                inverse_pairs = frozenset((second, first) for first, second in connection.pairs)
-                if isinstance(connection.transformation, Rotation):
-                    inverse_key = (inverse_pairs, key[1])
-                else:
-                    inverse_key = inverse_pairs
-                if inverse_key in stage1:
-                    del stage1[inverse_key]
-                    connection.invertible = True
-                stage2[key] = connection
-            self.send(ProgressMessage("elim_dup", len(stage2), len(stage1) + len(stage2)))
+            stage2 = self.eliminate_inverse_duplicates(stage1)
         else:
             stage2 = stage1
 
         self.connections = stage2.values()
 
+    def eliminate_equivalent_transformations(self, stage1):
+        # Connections whose transformations differ less than the tolerances
+        # are duplicates, even when their pairs differ a little. The rotations
+        # are compared as quaternions (only the vector part with a positive
+        # scalar part) and the translations are compared directly. These six
+        # numbers are put in bins whose size is twice the tolerance. Each
+        # retained connection is stored in the 2**6 bins that contain all
+        # points within the tolerance, such that only one bin has to be
+        # checked for later connections. The connections are processed in
+        # order of decreasing quality, so the best one of a group of
+        # equivalent connections is retained.
+        keys = stage1.keys()
+        connections = [stage1[key] for key in keys]
+        maximum = len(connections)
+        if maximum == 0:
+            return stage1
+        rotations = numpy.array([connection.transformation.r for connection in connections])
+        translations = numpy.array([connection.transformation.t for connection in connections])
+        propers = numpy.array([numpy.linalg.det(r) > 0 for r in rotations])
+        rotations[~propers] *= -1
+        quaternions = quaternions_from_matrices(rotations)
+
+        tolerances = numpy.array([self.rotation_tolerance]*3 + [self.translation_tolerance]*3)
+        points = numpy.concatenate([quaternions[:,1:], translations], axis=1)
+        scaled = points/(2*tolerances)
+        cells = numpy.floor(scaled).astype(int)
+        directions = numpy.where(scaled - cells >= 0.5, 1, -1)
+        # the cells of the inverted vector parts, needed for rotations of
+        # about 180 degrees, where the sign of the vector part is arbitrary.
+        flips = numpy.floor(numpy.concatenate([-quaternions[:,1:], translations], axis=1)/(2*tolerances)).astype(int)
+        corners = numpy.array([
+            [(corner >> bit) & 1 for bit in xrange(6)]
+            for corner in xrange(2**6)
+        ])
+
+        def equivalent(index1, index2):
+            if propers[index1] != propers[index2]:
+                return False
+            if (abs(translations[index1] - translations[index2]) >= self.translation_tolerance).any():
+                return False
+            return (
+                (abs(quaternions[index1,1:] - quaternions[index2,1:]) < self.rotation_tolerance).all() or
+                (abs(quaternions[index1,1:] + quaternions[index2,1:]) < self.rotation_tolerance).all()
+            )
 
+        bins = {}
+        result = {}
+        order = numpy.argsort([-connection.quality for connection in connections], kind="mergesort")
+        for progress, index in enumerate(order):
+            self.send(ProgressMessage("elim_trans", progress, maximum))
+            candidates = bins.get((propers[index],) + tuple(cells[index]), [])
+            if quaternions[index,0] < self.rotation_tolerance:
+                candidates = candidates + bins.get((propers[index],) + tuple(flips[index]), [])
+            if any(equivalent(index, other) for other in candidates):
+                continue
+            result[keys[index]] = connections[index]
+            for cell in cells[index] + corners*directions[index]:
+                bins.setdefault((propers[index],) + tuple(cell), []).append(index)
+        self.send(ProgressMessage("elim_trans", maximum, maximum))
+        return result
+
+    def get_duplicate_key(self, connection):
+        if isinstance(connection.transformation, Rotation):
+            return (connection.pairs, numpy.linalg.det(connection.transformation.r) > 0)
+        else:
+            return connection.pairs
+
+    def eliminate_inverse_duplicates(self, stage1):
+        # Stage 2 is only performed when connections between a building block
+        # and exact copies are searched. In that case, it might happen that
+        # two connection are the same when in one of both connections, the
+        # two building blocks are exchanged. The square of the associated
+        # transformation is the identity matrix.
+        stage2 = {}
+        while len(stage1) > 0:
+            self.send(ProgressMessage("elim_dup", len(stage2), len(stage1) + len(stage2)))
+            key, connection = stage1.popitem()
+            if isinstance(connection.transformation, Rotation):
+                pairs = key[0]
+            else:
+                pairs = key
+            inverse_pairs = frozenset((second, first) for first, second in connection.pairs)
+            if isinstance(connection.transformation, Rotation):
+                inverse_key = (inverse_pairs, key[1])
+            else:
+                inverse_key = inverse_pairs
+            connection.invertible = inverse_key in stage1
+            if connection.invertible:
+                del stage1[inverse_key]
+            stage2[key] = connection
+        self.send(ProgressMessage("elim_dup", len(stage2), len(stage1) + len(stage2)))
+        return stage2
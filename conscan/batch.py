@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Headless batch driver for the connection scanner
+
+This module reads building blocks from ZML or XYZ files, selects the
+connecting and repulsive points with the same kind of filter and radius
+expressions as the ScanForConnections action in Zeobuilder and writes the
+ranked connections to a NPZ or JSON file. It does not depend on the GUI, so
+it can be used on machines without X11. See main for the command line.
+"""
+
+
+from conscan.interface import Geometry, Connection, ProgressMessage, ResultsMessage
+from conscan.triangle import TriangleScanner
+from conscan.pair import PairScanner
+from conscan.cache import EnvironmentCache
+
+from molmod import Rotation, MolecularGraph
+from molmod.periodic import periodic
+from molmod.bonds import bonds, BOND_SINGLE, BOND_DOUBLE, BOND_TRIPLE
+from molmod.io import XYZFile
+import molmod.units
+
+from xml.sax.handler import ContentHandler
+import xml.sax, numpy, os, sys, optparse, multiprocessing
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+__all__ = [
+    "Atom", "load_atoms", "read_geometry", "run_job", "write_connections",
+    "main",
+]
+
+
+class Atom(object):
+    """A light-weight replacement for the Atom node in Zeobuilder
+
+    Only the attributes and methods that are commonly used in filter and
+    radius expressions are supported.
+    """
+    def __init__(self, index, number, coordinate, name=None, user_radius=None):
+        self.index = index
+        self.number = number
+        self.coordinate = coordinate
+        if name is None:
+            name = periodic[number].symbol
+        self.name = name
+        self.user_radius = user_radius
+        self.neighbors = []
+
+    def get_radius(self):
+        if self.user_radius is not None:
+            return self.user_radius
+        vdw_radius = periodic[self.number].vdw_radius
+        if vdw_radius is None:
+            return 1.0
+        else:
+            return vdw_radius*0.2
+
+    def num_bonds(self):
+        return len(self.neighbors)
+
+    def iter_neighbors(self):
+        return iter(self.neighbors)
+
+
+class ZMLAtomHandler(ContentHandler):
+    """Extracts the atoms and bonds from a ZML file
+
+    Only the number, name, user_radius and transformation of the atoms are
+    read, together with the transformations of the parent frames. Other
+    model objects are ignored.
+    """
+    def __init__(self):
+        ContentHandler.__init__(self)
+        # a stack with (name, label, model_object_record) for each open tag
+        self.tags = []
+        self.content = []
+        self.records = []
+        self.records_by_id = {}
+
+    def startElement(self, name, attrs):
+        if name == "zml_file":
+            if attrs.getValue("version") != "0.2":
+                raise ValueError("Only ZML format 0.2 is supported.")
+            return
+        label = attrs.get("label")
+        record = None
+        if name == "model_object":
+            parent = self.get_record()
+            record = {
+                "class": str(attrs.getValue("class")),
+                "parent": parent,
+                "r": None, "t": None, "number": None, "name": None,
+                "user_radius": None, "targets": [],
+            }
+            self.records.append(record)
+            self.records_by_id[int(attrs.getValue("id"))] = record
+        elif name == "reference":
+            if len(self.tags) > 0 and self.tags[-1][1] == "targets":
+                self.get_record()["targets"].append(int(attrs.getValue("to")))
+        self.tags.append((name, label, record))
+        self.content = []
+
+    def characters(self, content):
+        self.content.append(content)
+
+    def endElement(self, name):
+        if name == "zml_file":
+            return
+        name, label, record = self.tags.pop()
+        content = "".join(self.content)
+        self.content = []
+        if len(self.tags) == 0:
+            return
+        parent_name, parent_label, parent_record = self.tags[-1]
+        if parent_name == "model_object":
+            if name == "int" and label == "number":
+                parent_record["number"] = int(content)
+            elif name == "float" and label == "user_radius":
+                parent_record["user_radius"] = float(content)
+            elif name == "str" and label == "name":
+                parent_record["name"] = str(content)
+        elif name == "cells" and len(self.tags) >= 3:
+            array_label = parent_label
+            transformation_name, transformation_label, dummy = self.tags[-2]
+            owner_name, owner_label, owner_record = self.tags[-3]
+            if owner_name == "model_object" and transformation_label == "transformation" and \
+               transformation_name in ("translation", "rotation", "transformation"):
+                values = numpy.array([float(item) for item in content.split()])
+                if array_label == "translation_vector":
+                    owner_record["t"] = values
+                elif array_label == "rotation_matrix":
+                    owner_record["r"] = values.reshape(3, 3)
+
+    def get_record(self):
+        for name, label, record in reversed(self.tags):
+            if record is not None:
+                return record
+
+
+def load_zml(filename):
+    handler = ZMLAtomHandler()
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    f = file(filename)
+    try:
+        parser.parse(f)
+    finally:
+        f.close()
+
+    def get_absolute(record, coordinate):
+        while record is not None:
+            if record["r"] is not None:
+                coordinate = numpy.dot(record["r"], coordinate)
+            if record["t"] is not None:
+                coordinate = coordinate + record["t"]
+            record = record["parent"]
+        return coordinate
+
+    atoms = []
+    atoms_by_record = {}
+    for record in handler.records:
+        if record["class"] == "Atom" and record["number"] is not None:
+            if record["t"] is None:
+                record["t"] = numpy.zeros(3, float)
+            atom = Atom(
+                len(atoms), record["number"],
+                get_absolute(record["parent"], record["t"]),
+                record["name"], record["user_radius"],
+            )
+            atoms.append(atom)
+            atoms_by_record[id(record)] = atom
+    for record in handler.records:
+        if record["class"] == "Bond" and len(record["targets"]) == 2:
+            atom1, atom2 = [
+                atoms_by_record.get(id(handler.records_by_id.get(target)))
+                for target in record["targets"]
+            ]
+            if atom1 is not None and atom2 is not None:
+                atom1.neighbors.append(atom2)
+                atom2.neighbors.append(atom1)
+    return atoms
+
+
+def load_xyz(filename):
+    molecule = XYZFile(filename).get_molecule()
+    graph = MolecularGraph.from_geometry(molecule)
+    atoms = [
+        Atom(index, number, coordinate)
+        for index, (number, coordinate)
+        in enumerate(zip(molecule.numbers, molecule.coordinates))
+    ]
+    for index, atom in enumerate(atoms):
+        atom.neighbors = [atoms[neighbor] for neighbor in graph.neighbors[index]]
+    return atoms
+
+
+def load_atoms(filename):
+    """Return a list of Atom objects, with bonds, from a ZML or XYZ file
+
+    The coordinates are in atomic units.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".zml":
+        atoms = load_zml(filename)
+    elif extension == ".xyz":
+        atoms = load_xyz(filename)
+    else:
+        raise ValueError("Unsupported file format: %s" % filename)
+    if len(atoms) == 0:
+        raise ValueError("No atoms found in %s" % filename)
+    return atoms
+
+
+class Expression(object):
+    """An expression of the variable node, like those in Zeobuilder
+
+    The same names are available as in zeobuilder.expressions.Expression,
+    except that Atom is the light-weight replacement of the Atom node.
+    """
+
+    l = {
+        "periodic": periodic,
+        "bonds": bonds,
+        "BOND_SINGLE": BOND_SINGLE,
+        "BOND_DOUBLE": BOND_DOUBLE,
+        "BOND_TRIPLE": BOND_TRIPLE,
+        "Atom": Atom,
+    }
+    for key, val in molmod.units.__dict__.iteritems():
+        if isinstance(val, float):
+            l[key] = val
+
+    def __init__(self, code):
+        self.code = code
+        self.compiled = compile("(%s)" % code, "<string>", "eval")
+
+    def __call__(self, node):
+        g = {"__builtins__": __builtins__, "node": node}
+        g.update(self.l)
+        return eval(self.compiled, g)
+
+
+def read_geometry(atoms, connect_description, repulse_description):
+    """Construct a Geometry from a list of atoms
+
+    The descriptions are (filter, radius) tuples of expression strings. The
+    index of the atom of each point in the geometry is returned too.
+    """
+    connect_filter, connect_radius = [Expression(code) for code in connect_description]
+    repulse_filter, repulse_radius = [Expression(code) for code in repulse_description]
+    indexes = []
+    connect_masks = []
+    radii = []
+    for atom in atoms:
+        if connect_filter(atom):
+            indexes.append(atom.index)
+            connect_masks.append(True)
+            radii.append(connect_radius(atom))
+        elif repulse_filter(atom):
+            indexes.append(atom.index)
+            connect_masks.append(False)
+            radii.append(repulse_radius(atom))
+    if len(indexes) == 0:
+        raise ValueError("No connecting or repulsive points are selected.")
+    return Geometry(
+        numpy.array([atoms[index].coordinate for index in indexes], float),
+        numpy.array(connect_masks, bool),
+        numpy.array(radii, float),
+    ), numpy.array(indexes, int)
+
+
+def write_connections(filename, connections, indexes1, indexes2):
+    """Write the connections to a NPZ or JSON file
+
+    The connections must be sorted. Pairs refer to the atom indexes in the
+    input files.
+    """
+    pairs = [
+        sorted((int(indexes1[first]), int(indexes2[second])) for first, second in connection.pairs)
+        for connection in connections
+    ]
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".npz":
+        offsets = numpy.zeros(len(connections)+1, int)
+        offsets[1:] = numpy.cumsum([len(p) for p in pairs])
+        numpy.savez_compressed(filename,
+            qualities=numpy.array([connection.quality for connection in connections], float),
+            rotations=numpy.array([connection.transformation.r for connection in connections], float).reshape(-1, 3, 3),
+            translations=numpy.array([connection.transformation.t for connection in connections], float).reshape(-1, 3),
+            invertible=numpy.array([connection.invertible for connection in connections], bool),
+            pair_offsets=offsets,
+            pairs=numpy.array([pair for p in pairs for pair in p], int).reshape(-1, 2),
+        )
+    elif extension == ".json":
+        f = file(filename, "w")
+        try:
+            json.dump([{
+                "quality": float(connection.quality),
+                "rotation": connection.transformation.r.tolist(),
+                "translation": connection.transformation.t.tolist(),
+                "invertible": bool(connection.invertible),
+                "pairs": p,
+            } for connection, p in zip(connections, pairs)], f, indent=1)
+        finally:
+            f.close()
+    else:
+        raise ValueError("Unsupported output format: %s" % filename)
+
+
+class Collector(object):
+    def __init__(self, verbose):
+        self.verbose = verbose
+        self.connections = []
+
+    def __call__(self, message):
+        if isinstance(message, Connection):
+            self.connections.append(message)
+        elif isinstance(message, ResultsMessage):
+            self.connections = message.connections
+        elif isinstance(message, ProgressMessage) and self.verbose:
+            if message.progress == message.maximum:
+                print >> sys.stderr, "%10s %i" % (message.label, message.maximum)
+
+
+defaults = {
+    "block2": None,
+    "connect_filter": "True",
+    "connect_radius": "node.get_radius()",
+    "repulse_filter": "True",
+    "repulse_radius": "node.get_radius()",
+    "action_radius": 7.0,
+    "hit_tolerance": 0.1,
+    "allow_rotations": True,
+    "allow_inversions": True,
+    "minimum_triangle_size": 0.1,
+    "clash_cutoff": None,
+    "top_k": None,
+    "rotation_tolerance": None,
+    "translation_tolerance": 0.1,
+    "cache_dir": None,
+    "num_workers": 1,
+    "verbose": False,
+}
+
+
+def run_job(job):
+    """Run a scan for one pair of building blocks
+
+    The job is a dictionary with the keys in defaults, and block1 and output.
+    Lengths are in angstrom. Returns the number of connections written.
+    """
+    options = dict(defaults)
+    options.update(job)
+    angstrom = molmod.units.angstrom
+    descriptions = (
+        (options["connect_filter"], options["connect_radius"]),
+        (options["repulse_filter"], options["repulse_radius"]),
+    )
+    geometry1, indexes1 = read_geometry(load_atoms(options["block1"]), *descriptions)
+    if options["block2"] is None:
+        geometry2 = None
+        indexes2 = indexes1
+    else:
+        geometry2, indexes2 = read_geometry(load_atoms(options["block2"]), *descriptions)
+
+    if options["cache_dir"] is None:
+        cache = None
+    else:
+        cache = EnvironmentCache(options["cache_dir"])
+    if options["translation_tolerance"] is None:
+        translation_tolerance = None
+    else:
+        translation_tolerance = options["translation_tolerance"]*angstrom
+    kwargs = dict(
+        num_workers=options["num_workers"],
+        clash_cutoff=options["clash_cutoff"],
+        top_k=options["top_k"],
+        rotation_tolerance=options["rotation_tolerance"],
+        translation_tolerance=translation_tolerance,
+        cache=cache,
+    )
+    collector = Collector(options["verbose"])
+    if options["allow_rotations"]:
+        scanner = TriangleScanner(
+            collector, geometry1, geometry2,
+            options["action_radius"]*angstrom,
+            options["hit_tolerance"]*angstrom,
+            options["allow_inversions"],
+            (options["minimum_triangle_size"]*angstrom)**2,
+            **kwargs
+        )
+    else:
+        scanner = PairScanner(
+            collector, geometry1, geometry2,
+            options["action_radius"]*angstrom,
+            options["hit_tolerance"]*angstrom,
+            Rotation.identity(),
+            **kwargs
+        )
+    scanner.run()
+
+    connections = sorted(collector.connections, key=(lambda c: -c.quality))
+    write_connections(options["output"], connections, indexes1, indexes2)
+    return len(connections)
+
+
+def _run_job_safe(job):
+    # Used in the process pool, such that one failing job does not stop the
+    # others.
+    try:
+        return job["output"], run_job(job), None
+    except Exception, e:
+        return job["output"], None, "%s: %s" % (e.__class__.__name__, e)
+
+
+def load_manifest(filename, options):
+    """Read a list of jobs from a JSON file
+
+    Relative filenames are interpreted with respect to the directory of the
+    manifest. The given options are used as defaults for all jobs. The jobs
+    run in the workers of a process pool, which can not start a pool of their
+    own, so num_workers is always one.
+    """
+    f = file(filename)
+    try:
+        jobs = json.load(f)
+    finally:
+        f.close()
+    directory = os.path.dirname(os.path.abspath(filename))
+    result = []
+    for item in jobs:
+        job = dict(options)
+        job.update((str(key), value) for key, value in item.iteritems())
+        for key in "block1", "block2", "output":
+            if job.get(key) is not None:
+                job[key] = os.path.join(directory, job[key])
+        job["num_workers"] = 1
+        result.append(job)
+    return result
+
+
+usage = """Usage: %prog [options] block1 [block2] output
+       %prog [options] --manifest jobs.json
+
+Scans for connections between two building blocks, or between a building
+block and a copy of itself when block2 is omitted. The building blocks are
+read from ZML or XYZ files and the ranked connections are written to a NPZ
+or JSON file, depending on the extension of output.
+
+A manifest is a JSON file with a list of jobs. Each job is an object with
+at least the keys block1 and output, optionally block2 and any of the long
+option names below, with underscores instead of dashes. The jobs run in
+parallel. All lengths are in angstrom."""
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--manifest", help="Run all jobs in a JSON manifest file.")
+    parser.add_option("--connect-filter", default=defaults["connect_filter"],
+        help="Expression for the connecting points. [default=%default]")
+    parser.add_option("--connect-radius", default=defaults["connect_radius"],
+        help="Radius expression for the connecting points. [default=%default]")
+    parser.add_option("--repulse-filter", default=defaults["repulse_filter"],
+        help="Expression for the repulsive points. [default=%default]")
+    parser.add_option("--repulse-radius", default=defaults["repulse_radius"],
+        help="Radius expression for the repulsive points. [default=%default]")
+    parser.add_option("--action-radius", type="float", default=defaults["action_radius"],
+        help="[default=%default]")
+    parser.add_option("--hit-tolerance", type="float", default=defaults["hit_tolerance"],
+        help="[default=%default]")
+    parser.add_option("--fixed-rotation", action="store_false", dest="allow_rotations",
+        default=True, help="Only look for translations, using the pair scanner.")
+    parser.add_option("--no-inversions", action="store_false", dest="allow_inversions",
+        default=True, help="Do not allow inversion rotations.")
+    parser.add_option("--minimum-triangle-size", type="float",
+        default=defaults["minimum_triangle_size"], help="[default=%default]")
+    parser.add_option("--clash-cutoff", type="float",
+        help="Reject connections whose repulsive overlap exceeds this penalty.")
+    parser.add_option("--top-k", type="int", help="Only keep the best connections.")
+    parser.add_option("--rotation-tolerance", type="float",
+        help="Merge connections whose quaternions differ less than this.")
+    parser.add_option("--translation-tolerance", type="float",
+        default=defaults["translation_tolerance"], help="[default=%default]")
+    parser.add_option("--cache-dir", help="Directory for the environment cache.")
+    parser.add_option("-j", "--processes", type="int", default=1,
+        help="The number of processes. Jobs in a manifest run in parallel, "
+        "otherwise the environments of one scan are compared in parallel. "
+        "[default=%default]")
+    parser.add_option("-v", "--verbose", action="store_true", default=False)
+    (options, args) = parser.parse_args(argv)
+
+    job_options = dict(
+        (key, getattr(options, key)) for key in defaults
+        if key not in ("block2", "num_workers")
+    )
+    if options.manifest is not None:
+        if len(args) > 0:
+            parser.error("No arguments are expected with --manifest.")
+        jobs = load_manifest(options.manifest, job_options)
+        pool = multiprocessing.Pool(options.processes)
+        try:
+            failed = 0
+            for output, count, error in pool.imap(_run_job_safe, jobs):
+                if error is None:
+                    print "%s: %i connections" % (output, count)
+                else:
+                    print >> sys.stderr, "%s: %s" % (output, error)
+                    failed += 1
+        finally:
+            pool.terminate()
+            pool.join()
+        if failed > 0:
+            sys.exit(1)
+    else:
+        if len(args) == 2:
+            block1, output = args
+            block2 = None
+        elif len(args) == 3:
+            block1, block2, output = args
+        else:
+            parser.error("Expecting two or three arguments.")
+        job = dict(job_options)
+        job.update(block1=block1, block2=block2, output=output, num_workers=options.processes)
+        count = run_job(job)
+        print "%s: %i connections" % (output, count)
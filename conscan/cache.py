@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import numpy, os, hashlib
+
+
+__all__ = ["EnvironmentCache"]
+
+
+class EnvironmentCache(object):
+    """A persistent cache of the environment tables of geometries
+
+    The tables of one geometry are stored in a compressed NumPy file whose
+    name is a hash of the coordinates, the connect masks, the radii and the
+    action radius. When the total size of the cache exceeds max_size bytes,
+    the least recently used files are removed.
+    """
+
+    version = 1
+
+    def __init__(self, directory, max_size=100*1024**2):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_filename(self, geometry, action_radius):
+        h = hashlib.sha1()
+        h.update("conscan environments %i\n" % self.version)
+        h.update(numpy.asarray(geometry.coordinates, float).tostring())
+        h.update(numpy.asarray(geometry.connect_masks, bool).tostring())
+        h.update(numpy.asarray(geometry.radii, float).tostring())
+        h.update(repr(float(action_radius)))
+        return os.path.join(self.directory, "%s.npz" % h.hexdigest())
+
+    def load(self, geometry, action_radius):
+        """Return the cached tables as a dictionary, or None if not found"""
+        filename = self.get_filename(geometry, action_radius)
+        try:
+            f = numpy.load(filename)
+            try:
+                tables = dict((name, f[name]) for name in f.files)
+            finally:
+                f.close()
+            # mark the file as recently used
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return tables
+
+    def store(self, geometry, action_radius, tables):
+        """Write the tables to the cache and remove the least recently used files"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filename = self.get_filename(geometry, action_radius)
+        # write to a temporary file first, such that concurrent scans never
+        # see an incomplete file.
+        tmp_filename = "%s.%i.tmp" % (filename, os.getpid())
+        f = file(tmp_filename, "wb")
+        try:
+            numpy.savez_compressed(f, **tables)
+        finally:
+            f.close()
+        os.rename(tmp_filename, filename)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        total = sum(size for mtime, size, filename in entries)
+        # the most recent file is always kept
+        for mtime, size, filename in entries[:-1]:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
@@ -37,7 +37,10 @@ from molmod import PairSearchInter
 import numpy, sys, copy
 
 
-__all__  = ["Geometry", "Connection", "ProgressMessage"]
+__all__  = [
+    "Geometry", "Connection", "QualityEvaluator", "ProgressMessage",
+    "ResultsMessage"
+]
 
 
 class Geometry(object):
@@ -89,6 +92,128 @@ class Connection(object):
         self.pairs = frozenset(pairs)
 
 
+class QualityEvaluator(object):
+    """Computes the quality of many connections between two geometries at once
+
+    A cell list of the first geometry is built only once. For a batch of
+    connections, the second geometry is transformed as one stacked array and
+    all close pairs are found and scored with a few array operations. The
+    pairs are the same as those of Connection.compute_quality. The qualities
+    are the same up to rounding errors, because the terms are not added in
+    the order of the pair search of compute_quality.
+    """
+
+    # All displacements of a cell to its neighboring cells
+    cell_offsets = numpy.array([
+        (i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
+    ], int)
+
+    def __init__(self, geometry1, geometry2, max_points=100000):
+        """
+        Arguments:
+          geometry1  --  the geometry that is kept fixed
+          geometry2  --  the geometry that is transformed by the connections
+          max_points  --  the maximum number of transformed coordinates that
+                          is processed in one batch
+        """
+        self.geometry1 = geometry1
+        self.geometry2 = geometry2
+        self.cutoff = max(geometry1.radii.max(), geometry2.radii.max())
+        self.batch_size = max(1, max_points/len(geometry2.coordinates))
+        # the cell list of geometry1
+        self.origin = geometry1.coordinates.min(axis=0)
+        cells = self.get_cells(geometry1.coordinates)
+        self.shape = cells.max(axis=0) + 1
+        keys = self.get_keys(cells)
+        self.order = keys.argsort(kind="mergesort")
+        self.sorted_keys = keys[self.order]
+
+    def get_cells(self, coordinates):
+        return numpy.floor((coordinates - self.origin)/self.cutoff).astype(int)
+
+    def get_keys(self, cells):
+        return (cells[:,0]*self.shape[1] + cells[:,1])*self.shape[2] + cells[:,2]
+
+    def compute(self, connections):
+        """Assign the quality and the overlapping pairs to all connections"""
+        for begin in xrange(0, len(connections), self.batch_size):
+            self.compute_batch(connections[begin:begin+self.batch_size])
+
+    def compute_batch(self, connections):
+        """Assign the quality and the overlapping pairs to a batch of connections"""
+        connection_indexes, indexes1, indexes2, terms, connect = self.compute_terms(connections)
+        qualities = numpy.bincount(connection_indexes, terms, len(connections))
+        connection_indexes = connection_indexes[connect]
+        ends = connection_indexes.searchsorted(numpy.arange(len(connections)), "right")
+        pairs = zip(indexes1[connect].tolist(), indexes2[connect].tolist())
+        begin = 0
+        for connection, quality, end in zip(connections, qualities, ends):
+            connection.quality = quality
+            connection.pairs = frozenset(pairs[begin:end])
+            begin = end
+
+    def compute_qualities(self, connections):
+        """Return the qualities of a batch of connections, without side effects"""
+        connection_indexes, indexes1, indexes2, terms, connect = self.compute_terms(connections)
+        return numpy.bincount(connection_indexes, terms, len(connections))
+
+    def compute_terms(self, connections):
+        """Find all overlapping pairs for a batch of connections
+
+        Returns connection_indexes, indexes1, indexes2, terms, connect. All
+        arrays have one element per overlapping pair and they are sorted by
+        connection and by atom indexes. The last one is a mask for the pairs
+        of two connecting points.
+        """
+        geometry1 = self.geometry1
+        geometry2 = self.geometry2
+        size2 = len(geometry2.coordinates)
+        points = numpy.concatenate([
+            connection.transformation*geometry2.coordinates
+            for connection in connections
+        ])
+
+        # look up the candidate neighbors of all points in the 27 surrounding
+        # cells.
+        cells = self.get_cells(points)
+        all_points = []
+        all_lows = []
+        all_highs = []
+        for offset in self.cell_offsets:
+            neighbor_cells = cells + offset
+            inside = ((neighbor_cells >= 0) & (neighbor_cells < self.shape)).all(axis=1).nonzero()[0]
+            keys = self.get_keys(neighbor_cells[inside])
+            all_points.append(inside)
+            all_lows.append(self.sorted_keys.searchsorted(keys, "left"))
+            all_highs.append(self.sorted_keys.searchsorted(keys, "right"))
+        all_points = numpy.concatenate(all_points)
+        all_lows = numpy.concatenate(all_lows)
+        counts = numpy.concatenate(all_highs) - all_lows
+        total = counts.sum()
+        ends = counts.cumsum()
+        point_indexes = all_points.repeat(counts)
+        indexes1 = self.order[numpy.arange(total) - (ends - counts).repeat(counts) + all_lows.repeat(counts)]
+
+        # compute the distances and select the overlapping pairs
+        deltas = points[point_indexes] - geometry1.coordinates[indexes1]
+        distances = numpy.sqrt((deltas**2).sum(axis=1))
+        connection_indexes = point_indexes/size2
+        indexes2 = point_indexes%size2
+        radii = geometry1.radii[indexes1] + geometry2.radii[indexes2]
+        mask = (distances < self.cutoff) & (distances < radii)
+        order = numpy.lexsort((indexes2[mask], indexes1[mask], connection_indexes[mask]))
+        indexes1 = indexes1[mask][order]
+        indexes2 = indexes2[mask][order]
+        connection_indexes = connection_indexes[mask][order]
+        x = distances[mask][order]/radii[mask][order]
+        connect = geometry1.connect_masks[indexes1] & geometry2.connect_masks[indexes2]
+        # x**2 on an array is replaced by x*x, which is not always identical
+        # to the scalar x**2 in compute_quality. numpy.power is.
+        terms = 1-numpy.power(x, 2.0)
+        terms[~connect] *= -2
+        return connection_indexes, indexes1, indexes2, terms, connect
+
+
 class ProgressMessage(object):
     def __init__(self, label, progress, maximum):
         self.label = label
@@ -96,3 +221,10 @@ class ProgressMessage(object):
         self.maximum = maximum
 
 
+class ResultsMessage(object):
+    """The current list of best connections, sorted by decreasing quality
+
+    Each message replaces the connections in the previous one.
+    """
+    def __init__(self, connections):
+        self.connections = connections
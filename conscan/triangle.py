@@ -43,6 +43,32 @@ import copy, numpy
 __all__ = ["TriangleConnection", "Triangle", "TriangleScanner"]
 
 
+def rotation_matrices(angles, axes):
+    """Return an array of rotation matrices, one for each angle and axis
+
+    This is the vectorized counterpart of Rotation.from_properties without
+    inversion. The axes are normalized first.
+    """
+    axes = axes/numpy.sqrt((axes**2).sum(axis=1)).reshape(-1, 1)
+    x, y, z = axes.transpose()
+    c = numpy.cos(angles)
+    s = numpy.sin(angles)
+    C = 1 - c
+    return numpy.array([
+        [x*x*C + c, x*y*C - z*s, x*z*C + y*s],
+        [y*x*C + z*s, y*y*C + c, y*z*C - x*s],
+        [z*x*C - y*s, z*y*C + x*s, z*z*C + c],
+    ]).transpose(2, 0, 1)
+
+
+def orthogonal_vectors(vectors):
+    """Return a unit vector orthogonal to each of the given vectors"""
+    smallest = abs(vectors).argmin(axis=1)
+    units = numpy.identity(3)[smallest]
+    result = numpy.cross(vectors, units)
+    return result/numpy.sqrt((result**2).sum(axis=1)).reshape(-1, 1)
+
+
 class TriangleConnection(Connection):
     def __init__(self, pairs, minimum_area):
         Connection.__init__(self, set([
@@ -80,16 +106,127 @@ class Triangle(object):
 
 
 class TriangleScanner(Scanner):
-    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, allow_inversions, minimum_trianlge_area):
-        Scanner.__init__(self, send, geometry1, geometry2, action_radius, hit_tolerance)
+    engines = ["vectorized", "reference"]
+
+    def __init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, allow_inversions, minimum_trianlge_area, engine="vectorized", **kwargs):
+        Scanner.__init__(self, send, geometry1, geometry2, action_radius, hit_tolerance, **kwargs)
         self.allow_inversions = allow_inversions
         self.minimum_trianlge_area = minimum_trianlge_area
+        if engine not in self.engines:
+            raise ValueError("Unknown engine: %s" % engine)
+        self.engine = engine
 
     #
     # generate_connections
     #
 
+    def compute_environmental_descriptions(self):
+        Scanner.compute_environmental_descriptions(self)
+        if self.engine == "vectorized":
+            self.prepare_geometry(self.geometry1)
+            if not self.egoscan:
+                self.prepare_geometry(self.geometry2)
+
+    def prepare_geometry(self, geometry):
+        """Precompute the lookup tables for compare_environments_vectorized.
+
+        Each environment gets its distances sorted once. The geometry gets a
+        dense table with the distances between all pairs of connecting points
+        that are within the action radius (-1 elsewhere). Rows of points that
+        have no usable environment are left empty.
+        """
+        size = geometry.connect_masks.sum()
+        geometry.compact = geometry.connect_masks.cumsum() - 1
+        geometry.has_environment = numpy.zeros(len(geometry.coordinates), bool)
+        geometry.third_sides = numpy.zeros((size, size), float) - 1
+        for environment in geometry.environments.itervalues():
+            environment.order = environment.distances.argsort(kind="mergesort")
+            environment.sorted_distances = environment.distances[environment.order]
+            geometry.has_environment[environment.id] = True
+        table = geometry.environment_table
+        firsts = table.ids[table.rows]
+        mask = geometry.has_environment[firsts]
+        geometry.third_sides[
+            geometry.compact[firsts[mask]],
+            geometry.compact[table.neighbors[mask]]
+        ] = table.distances[mask]
+
     def compare_environments(self, environment1, environment2):
+        if self.engine == "vectorized":
+            self.compare_environments_vectorized(environment1, environment2)
+        else:
+            self.compare_environments_reference(environment1, environment2)
+
+    def compare_environments_vectorized(self, environment1, environment2):
+        # avoiding duplicates part 1
+        indexes1 = (environment1.id < environment1.neighbors).nonzero()[0]
+        if len(indexes1) == 0 or environment2.n == 0:
+            return
+        distances1 = environment1.distances[indexes1]
+
+        # find all pairs of distances that match within the hit tolerance. A
+        # slightly wider window is taken in the sorted distances, such that
+        # the exact criterion of the hit method can be applied afterwards.
+        margin = 2*self.hit_tolerance
+        lows = environment2.sorted_distances.searchsorted(distances1 - margin, "left")
+        highs = environment2.sorted_distances.searchsorted(distances1 + margin, "right")
+        counts = highs - lows
+        total = counts.sum()
+        if total == 0:
+            return
+        ends = counts.cumsum()
+        positions = numpy.arange(total) - (ends - counts).repeat(counts) + lows.repeat(counts)
+        matches1 = indexes1.repeat(counts)
+        matches2 = environment2.order[positions]
+        mask = abs(environment1.distances[matches1] - environment2.distances[matches2]) < self.hit_tolerance
+        matches1 = matches1[mask]
+        matches2 = matches2[mask]
+        if len(matches1) < 2:
+            return
+        # restore the order in which the reference implementation finds the
+        # matching pairs
+        order = numpy.lexsort((matches2, matches1))
+        points1 = environment1.neighbors[matches1[order]]
+        points2 = environment2.neighbors[matches2[order]]
+
+        # the pairs of matching distances can be further examined for the
+        # third side of the triangle, all at once.
+        geometry1 = self.geometry1
+        geometry2 = self.geometry2
+        valid = geometry1.has_environment[points1] & geometry2.has_environment[points2]
+        compact1 = geometry1.compact[points1]
+        compact2 = geometry2.compact[points2]
+        third_sides1 = geometry1.third_sides[compact1][:,compact1]
+        third_sides2 = geometry2.third_sides[compact2][:,compact2]
+        mask = (
+            # if two sides of one of the triangles coincide, skip this combination
+            (points1.reshape(-1,1) != points1) &
+            # avoiding duplicates part 2
+            (points2.reshape(-1,1) < points2) &
+            # the third side must be present in both geometries ...
+            valid.reshape(-1,1) & valid &
+            (third_sides1 >= 0) & (third_sides2 >= 0) &
+            # ... and match within the hit tolerance.
+            (abs(third_sides1 - third_sides2) < self.hit_tolerance)
+        )
+
+        environments1 = geometry1.environments
+        environments2 = geometry2.environments
+        minimum_area = self.minimum_trianlge_area
+        new_connections = (
+            TriangleConnection(
+                [
+                    (environments1[points1[index1]], environments2[points2[index1]]),
+                    (environments1[points1[index2]], environments2[points2[index2]]),
+                    (environment1, environment2)
+                ], minimum_area
+            ) for index1, index2 in zip(*mask.nonzero())
+        )
+        self.connections.extend(
+            connection for connection in new_connections if connection.valid
+        )
+
+    def compare_environments_reference(self, environment1, environment2):
         #print "*** COMPARING: %3i with %3i" % (environment1.id, environment2.id)
         # first do a distance compare test
         matching_pairs = []
@@ -116,8 +253,9 @@ class TriangleScanner(Scanner):
                 third_sides = [-1.0, -1.0]
                 for k, geometry in enumerate([self.geometry1, self.geometry2]):
                     pointa = geometry.environments[pair1[k]]
-                    if pair2[k] in pointa.neighbors:
-                        third_sides[k] = pointa.distances[pointa.reverse_neighbors[pair2[k]]]
+                    index = pointa.find(pair2[k])
+                    if index >= 0:
+                        third_sides[k] = pointa.distances[index]
                     else:
                         third_sides = None
                         break
@@ -248,7 +386,76 @@ class TriangleScanner(Scanner):
 
         return t4*r3*r2*t1
 
+    def compute_transformation_arrays(self, connections):
+        """Return the rotation matrices and translation vectors of the connections
+
+        This is the vectorized counterpart of compute_transformation. The
+        same three steps are taken for all triangle pairs at once: the normal
+        of triangle2 is rotated onto the normal of triangle1, then the
+        triangles are superposed by a rotation about that normal and finally
+        the centers are matched. The coordinates of the triangles are not
+        modified.
+        """
+        coordinates1 = numpy.array([connection.triangle1.coordinates for connection in connections])
+        coordinates2 = numpy.array([connection.triangle2.coordinates for connection in connections])
+        centers1 = numpy.array([connection.triangle1.center for connection in connections])
+        centers2 = numpy.array([connection.triangle2.center for connection in connections])
+        normals1 = numpy.array([connection.triangle1.normal for connection in connections])
+        normals2 = numpy.array([connection.triangle2.normal for connection in connections])
+
+        # r2: make the two triangles coplanar
+        axes = numpy.cross(normals2, normals1)
+        parallel = (axes**2).sum(axis=1) < 1e-8
+        axes[parallel] = orthogonal_vectors(normals2[parallel])
+        angles = numpy.arccos((normals1*normals2).sum(axis=1).clip(-1, 1))
+        r2 = rotation_matrices(angles, axes)
+
+        # r3: the rotation about the normal of triangle1 that superposes the
+        # centered triangles. The cosine and the sine are computed as in
+        # compute_transformation, but without bringing the triangles in the
+        # x-y plane.
+        deltas1 = coordinates1 - centers1.reshape(-1, 1, 3)
+        deltas2 = numpy.einsum("nij,nkj->nki", r2, coordinates2 - centers2.reshape(-1, 1, 3))
+        c = (deltas1*deltas2).sum(axis=2).sum(axis=1)
+        s = (normals1.reshape(-1, 1, 3)*numpy.cross(deltas2, deltas1)).sum(axis=2).sum(axis=1)
+        r3 = rotation_matrices(numpy.arctan2(s, c), normals1)
+
+        rotations = numpy.einsum("nij,njk->nik", r3, r2)
+        translations = centers1 - numpy.einsum("nij,nj->ni", rotations, centers2)
+        return rotations, translations
+
     def compute_transformations(self):
+        if self.engine == "reference":
+            self.compute_transformations_reference()
+            return
+        connections = self.connections
+        maximum = len(connections)
+        self.send(ProgressMessage("calc_trans", 0, maximum))
+        if maximum > 0:
+            rotations, translations = self.compute_transformation_arrays(connections)
+            for connection, r, t in zip(connections, rotations, translations):
+                connection.set_transformation(Complete(r, t))
+        self.send(ProgressMessage("calc_trans", maximum, maximum))
+        if self.allow_inversions:
+            # derive the connections with inversion rotations, based on those
+            # without inversion rotations. The mirror plane contains the
+            # center of triangle1 and is orthogonal to its normal.
+            self.send(ProgressMessage("mirror", 0, maximum))
+            if maximum > 0:
+                centers1 = numpy.array([connection.triangle1.center for connection in connections])
+                normals1 = numpy.array([connection.triangle1.normal for connection in connections])
+                mirrors = numpy.identity(3) - 2*normals1.reshape(-1, 3, 1)*normals1.reshape(-1, 1, 3)
+                rotations = numpy.einsum("nij,njk->nik", mirrors, rotations)
+                translations = numpy.einsum("nij,nj->ni", mirrors, translations - centers1) + centers1
+                new_connections = []
+                for connection, r, t in zip(connections, rotations, translations):
+                    new = copy.copy(connection)
+                    new.set_transformation(Complete(r, t))
+                    new_connections.append(new)
+                self.connections.extend(new_connections)
+            self.send(ProgressMessage("mirror", maximum, maximum))
+
+    def compute_transformations_reference(self):
         Scanner.compute_transformations(self)
         if self.allow_inversions:
             # derive the connections with inversion rotations, based on those
@@ -267,5 +474,3 @@ class TriangleScanner(Scanner):
                 new_connections.append(new)
             self.connections.extend(new_connections)
             self.send(ProgressMessage("mirror", maximum, maximum))
-
-
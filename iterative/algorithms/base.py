@@ -32,13 +32,73 @@
 #--
 
 
-__all__ = ["Status", "Algorithm"]
+import numpy
+
+
+__all__ = ["Status", "StateBuffer", "Algorithm"]
 
 
 class Status(object):
     pass
 
 
+class StateBuffer(object):
+    """A memory-mapped file that holds the most recent status of an algorithm.
+
+    The buffer is shared between the process that runs the algorithm and the
+    process that displays its progress, such that the state vector does not
+    have to be pickled at each iteration. The first four numbers are the
+    sequence counter, the step, the value and the progress, followed by the
+    state vector. The writer increments the sequence counter before and after
+    each update. A reader only accepts a copy when the counter was even and
+    did not change while copying.
+    """
+    header_size = 4
+
+    def __init__(self, filename, size, create=False):
+        if create:
+            mode = "w+"
+        else:
+            mode = "r+"
+        self.filename = filename
+        self.data = numpy.memmap(filename, float, mode, shape=(self.header_size+size,))
+        self.state = self.data[self.header_size:]
+
+    def write(self, status):
+        sequence = self.data[0]
+        self.data[0] = sequence + 1
+        self.data[1] = status.step
+        self.data[2] = status.value
+        self.data[3] = status.progress
+        self.state[:] = status.state
+        self.data[0] = sequence + 2
+
+    def read(self, max_trials=100):
+        """Return a status object with a consistent copy of the buffer
+
+        None is returned when nothing has been written yet or when the writer
+        kept interfering with the reader.
+        """
+        for trial in xrange(max_trials):
+            sequence = self.data[0]
+            if sequence % 2 == 1:
+                continue
+            if sequence == 0:
+                return None
+            result = Status()
+            result.step = int(self.data[1])
+            result.value = self.data[2]
+            result.progress = self.data[3]
+            result.state = self.state.copy()
+            if self.data[0] == sequence:
+                result.sequence = int(sequence)/2
+                return result
+
+    def close(self):
+        del self.state
+        del self.data
+
+
 class Algorithm(object):
     def __init__(self, root_expression, stop_criterion):
         self.root_expression = root_expression
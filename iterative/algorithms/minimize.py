@@ -34,12 +34,14 @@
 
 from base import Algorithm
 from iterative.stop_criteria import SmallStep
+from iterative.expressions.base import ShakeError
 
 import math, numpy, sys
 
 
 __all__ = [
-    "Minimize", "SteepestDescent", "ConjugateGradient", "DefaultMinimize"
+    "Minimize", "SteepestDescent", "ConjugateGradient", "LBFGS",
+    "TruncatedNewton", "DefaultMinimize"
 ]
 
 
@@ -117,18 +119,25 @@ class ConjugateGradient(Minimize):
 
         self.delta_gradient = numpy.zeros(self.gradient.shape, float)
         self.backup = numpy.zeros(self.root_expression.state.shape, float)
+        self.analytic_curvature = self.root_expression.has_hessian_vector()
 
     def iterate(self):
-        # obtain the 'second order derivative in the search direction' numerically,
-        # ~= numpy.dot(direction, numpy.dot(hessian, direction))
-        epsilon = 1e-12
-        self.backup[:] = self.root_expression.state
-        self.root_expression.state[:] += self.direction/numpy.linalg.norm(self.direction)*epsilon
-        self.root_expression.clear_derivatives()
-        self.root_expression.add_derivatives()
-        self.delta_gradient[:] = self.root_expression.derivatives
-        curvature = numpy.dot(self.direction, (self.delta_gradient-self.gradient))/epsilon
-        self.root_expression.state[:] = self.backup
+        # obtain the 'second order derivative in the search direction',
+        # numpy.dot(direction, numpy.dot(hessian, direction))/norm(direction)
+        if self.analytic_curvature:
+            # the derivatives were computed at the current state
+            self.root_expression.compute_hessian_vector(self.direction, self.delta_gradient)
+            curvature = numpy.dot(self.direction, self.delta_gradient)/numpy.linalg.norm(self.direction)
+        else:
+            # numerically, with an extra evaluation of the derivatives
+            epsilon = 1e-12
+            self.backup[:] = self.root_expression.state
+            self.root_expression.state[:] += self.direction/numpy.linalg.norm(self.direction)*epsilon
+            self.root_expression.clear_derivatives()
+            self.root_expression.add_derivatives()
+            self.delta_gradient[:] = self.root_expression.derivatives
+            curvature = numpy.dot(self.direction, (self.delta_gradient-self.gradient))/epsilon
+            self.root_expression.state[:] = self.backup
 
         if curvature <= 0:
             step = -self.gradient/numpy.linalg.norm(self.gradient)
@@ -163,7 +172,223 @@ class ConjugateGradient(Minimize):
         return False
 
 
-DefaultMinimize = ConjugateGradient
+class LBFGS(Minimize):
+    """Limited-memory BFGS minimization with a Wolfe line search
+
+    The gradients are computed by the root expression, i.e. they are
+    projected on the constraints when constrain_derivatives is set, and each
+    trial state is brought back on the constraints with shake. The quasi
+    Newton direction is constructed from the differences in state and
+    gradient of the last few iterations. The inverse Hessian of the first
+    iteration is diagonal, with max_step**2 on the diagonal. The line search
+    starts from the step size of the recent iterations.
+    """
+
+    def __init__(self, root_expression, max_step, step_threshold, memory=10, max_trials=20):
+        Minimize.__init__(self, root_expression, max_step, step_threshold)
+        self.memory = memory
+        self.max_trials = max_trials
+        # parameters of the Wolfe conditions
+        self.c1 = 1e-4
+        self.c2 = 0.9
+
+    def initialize(self):
+        Minimize.initialize(self)
+        self.root_expression.add_outputs()
+        self.value = self.root_expression.outputs[0]
+        self.gradient = self.compute_gradient()
+        # a list of (state difference, gradient difference, 1/dot product)
+        self.history = []
+        self.step_sizes = []
+
+    def compute_gradient(self):
+        self.root_expression.clear_derivatives()
+        self.root_expression.add_derivatives()
+        return self.root_expression.derivatives.copy()
+
+    def get_direction(self):
+        # the two-loop recursion
+        q = self.gradient.copy()
+        alphas = []
+        for s, y, rho in reversed(self.history):
+            alpha = rho*numpy.dot(s, q)
+            q -= alpha*y
+            alphas.append(alpha)
+        scale = self.max_step**2
+        if len(self.history) > 0:
+            s, y, rho = self.history[-1]
+            scale = scale*numpy.dot(s, y)/numpy.dot(y, scale*y)
+        r = scale*q
+        for (s, y, rho), alpha in zip(self.history, reversed(alphas)):
+            beta = rho*numpy.dot(y, r)
+            r += s*(alpha - beta)
+        return -r
+
+    def iterate(self):
+        direction = self.get_direction()
+        if numpy.dot(direction, self.gradient) >= 0:
+            # not a descent direction, start over
+            self.history = []
+            direction = -self.gradient*self.max_step**2
+        self.limit_step(direction)
+        return self.line_search_wolfe(direction)
+
+    def line_search_wolfe(self, direction):
+        """Find a step size along direction that meets the Wolfe conditions
+
+        The interval of acceptable step sizes is bracketed by doubling and
+        bisection. Returns True when no step larger than the threshold
+        decreases the output value.
+        """
+        root_expression = self.root_expression
+        self.status.num_shakes = 0
+        original_state = root_expression.state.copy()
+        original_value = self.value
+        original_gradient = self.gradient
+
+        # the largest step size that does not exceed max_step
+        largest = 1.0/numpy.linalg.norm(direction/self.max_step)
+        if len(self.step_sizes) > 0:
+            step_size = min(largest, numpy.median(self.step_sizes))
+        else:
+            step_size = largest
+        lower = 0.0
+        upper = None
+        # the best step that satisfies the sufficient decrease condition
+        best = None
+
+        for trial in xrange(self.max_trials):
+            step = step_size*direction
+            if self.stop_criterion(step):
+                break
+            root_expression.state[:] = original_state + step
+            try:
+                self.status.num_shakes += root_expression.shake()
+            except ShakeError:
+                upper = step_size
+                step_size = 0.5*(lower + upper)
+                continue
+            root_expression.clear_outputs()
+            root_expression.add_outputs()
+            value = root_expression.outputs[0]
+            # the constraints may change the actual step
+            actual_step = root_expression.state - original_state
+            slope = numpy.dot(original_gradient, actual_step)
+            if value > original_value + self.c1*slope or value >= original_value:
+                upper = step_size
+            else:
+                gradient = self.compute_gradient()
+                best = (step_size, root_expression.state.copy(), value, gradient)
+                if numpy.dot(gradient, actual_step) >= self.c2*slope:
+                    break
+                lower = step_size
+                if upper is None and step_size >= largest:
+                    break
+            if upper is None:
+                step_size = min(2*step_size, largest)
+            else:
+                step_size = 0.5*(lower + upper)
+
+        if best is None:
+            root_expression.state[:] = original_state
+            root_expression.outputs[0] = original_value
+            self.status.progress = self.stop_criterion.get_fraction()
+            self.status.value = original_value
+            return True
+
+        step_size, state, self.value, self.gradient = best
+        root_expression.state[:] = state
+        root_expression.outputs[0] = self.value
+        self.step_sizes = self.step_sizes[-4:] + [step_size]
+
+        s = state - original_state
+        y = self.gradient - original_gradient
+        sy = numpy.dot(s, y)
+        if sy > 1e-10*numpy.linalg.norm(s)*numpy.linalg.norm(y):
+            self.history.append((s, y, 1.0/sy))
+            del self.history[:-self.memory]
+
+        stop = self.stop_criterion(s)
+        self.status.progress = self.stop_criterion.get_fraction()
+        self.status.value = self.value
+        return stop
+
+
+class TruncatedNewton(Minimize):
+    """Newton minimization with approximate solutions of the Newton equations
+
+    The root expression must support Hessian-vector products, see
+    Root.has_hessian_vector. In each iteration, the Newton equations are
+    solved approximately with preconditioned conjugate gradients, using only
+    Hessian-vector products and no extra gradient evaluations. The
+    preconditioner is diagonal, with max_step**2 on the diagonal, and the
+    search directions are kept on the tangent space of the constraints. The
+    inner iterations stop at negative curvature or when the residual is small
+    compared to the gradient. Near the minimum, the tolerance becomes
+    proportional to the norm of the gradient, which gives quadratic
+    convergence. The step is limited and accepted by the line search.
+    """
+
+    def __init__(self, root_expression, max_step, step_threshold, max_inner=None):
+        Minimize.__init__(self, root_expression, max_step, step_threshold)
+        self.max_inner = max_inner
+
+    def initialize(self):
+        Minimize.initialize(self)
+        if not self.root_expression.has_hessian_vector():
+            raise TypeError("Truncated Newton minimization requires Hessian-vector products of all sub expressions.")
+        self.compute_gradient()
+
+    def compute_gradient(self):
+        self.root_expression.clear_derivatives()
+        self.root_expression.add_derivatives()
+        self.gradient = self.root_expression.derivatives.copy()
+
+    def get_newton_step(self):
+        root_expression = self.root_expression
+        preconditioner = self.max_step**2
+        max_inner = self.max_inner
+        if max_inner is None:
+            max_inner = len(self.gradient)
+        gradient_norm = numpy.linalg.norm(self.gradient)
+        tolerance = min(0.5, gradient_norm)*gradient_norm
+
+        step = numpy.zeros(self.gradient.shape, float)
+        residual = -self.gradient
+        direction = preconditioner*residual
+        root_expression.project(direction)
+        rz = numpy.dot(residual, direction)
+        product = numpy.zeros(self.gradient.shape, float)
+        for inner in xrange(max_inner):
+            root_expression.compute_hessian_vector(direction, product)
+            curvature = numpy.dot(direction, product)
+            if curvature <= 0:
+                if inner == 0:
+                    # preconditioned steepest descent
+                    step = direction
+                break
+            alpha = rz/curvature
+            step += alpha*direction
+            residual -= alpha*product
+            if numpy.linalg.norm(residual) < tolerance:
+                break
+            z = preconditioner*residual
+            root_expression.project(z)
+            new_rz = numpy.dot(residual, z)
+            direction *= new_rz/rz
+            direction += z
+            rz = new_rz
+        return step
+
+    def iterate(self):
+        step = self.get_newton_step()
+        stop = self.line_search(step)
+        if stop: return True
+        self.compute_gradient()
+        return False
+
+
+DefaultMinimize = LBFGS
 
 
 
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from base import Status
+
+import numpy, cPickle, multiprocessing
+
+
+__all__ = [
+    "random_rotation", "random_translation", "perturbed_copies",
+    "run_single_start", "MultiStart",
+]
+
+
+def random_rotation(random_state):
+    # a uniformly distributed unit quaternion gives a uniform random rotation
+    a, b, c, d = random_state.normal(0, 1, 4)
+    norm = numpy.sqrt(a*a + b*b + c*c + d*d)
+    a, b, c, d = a/norm, b/norm, c/norm, d/norm
+    return numpy.array([
+        [a*a+b*b-c*c-d*d, 2*(b*c-a*d), 2*(b*d+a*c)],
+        [2*(b*c+a*d), a*a-b*b+c*c-d*d, 2*(c*d-a*b)],
+        [2*(b*d-a*c), 2*(c*d+a*b), a*a-b*b-c*c+d*d],
+    ], float)
+
+
+def random_translation(random_state, radius):
+    # uniformly distributed in a sphere with the given radius
+    direction = random_state.normal(0, 1, 3)
+    direction /= numpy.linalg.norm(direction)
+    return direction*radius*random_state.uniform(0, 1)**(1.0/3)
+
+
+def perturbed_copies(minimize, num_starts, radius, random_state):
+    """Return num_starts independent copies of an algorithm
+
+    The algorithm must not be parsed yet, i.e. parse_input must not have been
+    called on its root expression. The first copy starts from the original
+    state. In the other copies, each state variable is rotated randomly and
+    translated within the given radius.
+    """
+    pickled = cPickle.dumps(minimize, -1)
+    result = []
+    for index in xrange(num_starts):
+        copy = cPickle.loads(pickled)
+        if index > 0:
+            for variable in copy.root_expression.state_variables:
+                variable.perturb(
+                    random_rotation(random_state),
+                    random_translation(random_state, radius),
+                )
+        result.append(copy)
+    return result
+
+
+def run_single_start(minimize):
+    """Run one minimization and return its final Status
+
+    The status gets an extra attribute transformations with the result of
+    extract_state for each state variable of the root expression.
+    """
+    root_expression = minimize.root_expression
+    root_expression.parse_input()
+    def report(status):
+        pass
+    minimize.run(report)
+    root_expression.clear_outputs()
+    root_expression.add_outputs()
+    status = Status()
+    status.step = minimize.status.step
+    status.value = root_expression.outputs[0]
+    status.state = root_expression.state.copy()
+    status.transformations = [
+        variable.extract_state(variable.state_index, status.state)
+        for variable in root_expression.state_variables
+    ]
+    return status
+
+
+def _run_single_start_indexed(args):
+    index, minimize = args
+    status = run_single_start(minimize)
+    status.start = index
+    return status
+
+
+class MultiStart(object):
+    """Minimize the same cost function from several perturbed initial states
+
+    The individual minimizations are distributed over a pool of processes.
+    The run method reports a Status after each finished minimization, with
+    the best result so far, and returns all final results ranked by their
+    cost function value. The states of different starts are not comparable
+    when the variables keep a reference orientation (e.g. ExponentialFrame),
+    hence one should rely on the transformations attribute of the results.
+    """
+    def __init__(self, minimize, num_starts, radius, num_processes=None, seed=None):
+        self.minimize = minimize
+        self.num_starts = num_starts
+        self.radius = radius
+        self.num_processes = num_processes
+        self.seed = seed
+
+    def run(self, report=None):
+        random_state = numpy.random.RandomState(self.seed)
+        jobs = list(enumerate(perturbed_copies(
+            self.minimize, self.num_starts, self.radius, random_state
+        )))
+        if self.num_processes == 1:
+            iter_results = (_run_single_start_indexed(job) for job in jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(self.num_processes)
+            iter_results = pool.imap_unordered(_run_single_start_indexed, jobs)
+
+        results = []
+        try:
+            for result in iter_results:
+                results.append(result)
+                if report is not None:
+                    best = min(results, key=(lambda r: r.value))
+                    status = Status()
+                    status.step = len(results)
+                    status.value = best.value
+                    status.state = best.state
+                    status.transformations = best.transformations
+                    status.progress = float(len(results))/self.num_starts
+                    report(status)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        results.sort(key=(lambda r: (r.value, r.start)))
+        return results
@@ -65,6 +65,8 @@ class SanityError(Exception):
 
 class Base(object):
     output_dimension = 0
+    # set to True when add_hessian_vector is implemented
+    has_hessian_vector = False
 
     def __init__(self):
         assert self.output_dimension == None or self.output_dimension > 0, "The output_dimension of an expression must be strictly positive."
@@ -76,6 +78,14 @@ class Base(object):
     def add_derivatives(self):
         raise NotImplementedError
 
+    def add_hessian_vector(self, direction, product):
+        """Add the product of the Hessian and a direction in state space
+
+        Both direction and product are vectors with the size of the state of
+        the root expression. This is optional, see has_hessian_vector.
+        """
+        raise NotImplementedError
+
 
 #
 # Mixin classes
@@ -234,7 +244,6 @@ class Root(Base, RootMixin):
 
         # assign state indices to the variables
         state_index = 0
-        excess_index = 0
         self.unconstrained_variables = set(self.state_variables)
         for cluster in self.constraint_clusters:
             cluster.state_index = state_index
@@ -246,12 +255,23 @@ class Root(Base, RootMixin):
             cluster.output_dimension = sum([constraint.output_dimension for constraint in cluster.rules])
             cluster.inputs = self.state[cluster.state_index: cluster.state_index + cluster.input_dimension]
             cluster.state_derivatives = self.derivatives[cluster.state_index: cluster.state_index + cluster.input_dimension]
-            cluster.outputs = numpy.zeros(cluster.output_dimension, float)
-            cluster.constraint_derivatives = numpy.zeros((cluster.output_dimension, cluster.input_dimension), float)
+
+        # clusters with the same dimensions share their arrays, such that
+        # they can be treated all at once.
+        groups = {}
+        for cluster in self.constraint_clusters:
+            key = (cluster.output_dimension, cluster.input_dimension)
+            groups.setdefault(key, []).append(cluster)
+        self.constraint_groups = [
+            ConstraintGroup(clusters) for key, clusters in sorted(groups.iteritems())
+        ]
+
+        for cluster in self.constraint_clusters:
             output_index = 0
             for constraint in cluster.rules:
                 constraint.sanity_check()
                 constraint.connect_outputs(output_index, cluster.outputs)
+                constraint.connect_multipliers(output_index, cluster.multipliers)
                 constraint.connect_derivatives([
                     cluster.constraint_derivatives[
                         output_index: output_index + constraint.output_dimension,
@@ -291,40 +311,164 @@ class Root(Base, RootMixin):
         for helper in self.helpers[::-1]:
             helper.transform_derivatives()
         if self.constrain_derivatives:
-            for cluster in self.constraint_clusters:
-                for constraint in cluster.rules:
-                    constraint.clear()
-                    constraint.add_derivatives()
-                # project the derivative vector on the space spanned by the
-                # tangents (derivatives) of the constraint functions.
-                ortho_move = numpy.dot(cluster.constraint_derivatives, numpy.transpose(cluster.constraint_derivatives))
-                x,resids,rank,s = numpy.linalg.lstsq(cluster.constraint_derivatives.transpose(), cluster.state_derivatives)
-                cluster.state_derivatives[:] -= numpy.dot(cluster.constraint_derivatives.transpose(), x)
+            for group in self.constraint_groups:
+                group.factorize(self.state)
+                group.multipliers[:] = group.project(self.derivatives)
+
+    def has_hessian_vector(self):
+        # helpers do not support Hessian-vector products yet
+        if len(self.helpers) > 0:
+            return False
+        for expression in self.termini + self.constraints:
+            if not expression.has_hessian_vector:
+                return False
+        return True
+
+    def project(self, vector):
+        # project a vector in state space on the tangent space of the
+        # constraints, at the state where the derivatives were computed
+        if self.constrain_derivatives:
+            for group in self.constraint_groups:
+                group.project(vector)
+
+    def compute_hessian_vector(self, direction, product):
+        """Compute the product of the Hessian and a direction in state space
+
+        This must be called after add_derivatives, at the same state. When
+        constrain_derivatives is set, the result is the projected Hessian of
+        the Lagrangian, output - multipliers*constraints, where the Lagrange
+        multipliers are those of the projection of the derivatives. This is
+        the curvature of the output along the constraints.
+        """
+        product[:] = 0.0
+        for terminus in self.termini:
+            terminus.add_hessian_vector(direction, product)
+        if self.constrain_derivatives:
+            for constraint in self.constraints:
+                constraint.add_hessian_vector(direction, product)
+            self.project(product)
 
     def shake(self):
-        # returns the mean number of shakes per constraint cluster
+        # returns the total number of shakes of all constraint clusters
         if len(self.constraint_clusters) == 0: return 0
         total_num_shakes = 0
-        # nr stands for newton-raphson
-        for cluster in self.constraint_clusters:
-            num_shakes = 0
-            while True:
-                converged = True
-                for constraint in cluster.rules:
-                    constraint.clear()
-                    constraint.add_outputs()
-                    converged &= constraint.converged()
-                if converged: break
-                for constraint in cluster.rules:
-                    constraint.add_derivatives()
-
-                ortho_move = numpy.dot(cluster.constraint_derivatives, numpy.transpose(cluster.constraint_derivatives))
-                delta_mu = -numpy.linalg.solve(ortho_move, cluster.outputs)
-                cluster.inputs += numpy.dot(numpy.transpose(cluster.constraint_derivatives), delta_mu)
-                num_shakes += 1
-                if num_shakes > self.max_num_shakes:
-                    raise ShakeError("The number of NR corrections exceeded the given limit (%i). This probably means that the step size is too large." % (self.max_num_shakes))
-            total_num_shakes += num_shakes
+        for group in self.constraint_groups:
+            total_num_shakes += group.shake(self.state, self.max_num_shakes)
+        return total_num_shakes
+
+
+class ConstraintGroup(object):
+    """Constraint clusters with the same dimensions, treated as one array
+
+    The outputs and the constraint derivatives of all clusters are slices of
+    three-dimensional arrays. The Newton-Raphson corrections in shake and the
+    projection of the derivatives solve a small linear system for each
+    cluster. These systems are solved all at once, with the inverses of the
+    matrices C C^T, where C are the constraint derivatives. The derivatives
+    and the inverses are only recomputed when the state has changed.
+
+    When each cluster has one constraint of the same class, and that class
+    has the methods add_outputs_batch and add_derivatives_batch, the outputs
+    and derivatives of all clusters are computed at once too.
+    """
+    def __init__(self, clusters):
+        self.clusters = clusters
+        self.output_dimension = clusters[0].output_dimension
+        self.input_dimension = clusters[0].input_dimension
+        size = len(clusters)
+        self.outputs = numpy.zeros((size, self.output_dimension), float)
+        self.multipliers = numpy.zeros((size, self.output_dimension), float)
+        self.constraint_derivatives = numpy.zeros((size, self.output_dimension, self.input_dimension), float)
+        self.state_indices = numpy.array([
+            numpy.arange(cluster.state_index, cluster.state_index + self.input_dimension)
+            for cluster in clusters
+        ], int)
+        for index, cluster in enumerate(clusters):
+            cluster.outputs = self.outputs[index]
+            cluster.multipliers = self.multipliers[index]
+            cluster.constraint_derivatives = self.constraint_derivatives[index]
+        self.inverses = None
+        # the inputs of the clusters for which the derivatives and the
+        # inverses were computed
+        self.factorized_inputs = None
+
+        self.constraints = None
+        if all(len(cluster.rules) == 1 for cluster in clusters):
+            constraints = [cluster.rules[0] for cluster in clusters]
+            cls = constraints[0].__class__
+            if hasattr(cls, "add_outputs_batch") and all(constraint.__class__ is cls for constraint in constraints):
+                self.constraints = constraints
+                self.thresholds2 = numpy.array([constraint.convergence_threshold2 for constraint in constraints])
+
+    def add_outputs(self, mask=None):
+        # returns a mask with the clusters that are not converged yet
+        if self.constraints is not None:
+            self.outputs[:] = 0.0
+            self.constraints[0].add_outputs_batch(self.constraints, self.outputs)
+            result = (self.outputs**2).sum(axis=1)/self.output_dimension >= self.thresholds2
+            if mask is not None:
+                result &= mask
+            return result
+        result = numpy.zeros(len(self.clusters), bool)
+        for index, cluster in enumerate(self.clusters):
+            if mask is not None and not mask[index]:
+                continue
+            converged = True
+            # only the outputs are cleared, the derivatives are kept for
+            # factorize.
+            cluster.outputs[:] = 0.0
+            for constraint in cluster.rules:
+                constraint.add_outputs()
+                converged &= constraint.converged()
+            result[index] = not converged
+        return result
+
+    def add_derivatives(self):
+        self.constraint_derivatives[:] = 0.0
+        if self.constraints is not None:
+            self.constraints[0].add_derivatives_batch(self.constraints, self.constraint_derivatives)
+            return
+        for cluster in self.clusters:
+            for constraint in cluster.rules:
+                constraint.add_derivatives()
+
+    def factorize(self, state):
+        # computes the derivatives and the inverses of C C^T for all clusters
+        inputs = state[self.state_indices]
+        if self.factorized_inputs is not None and (self.factorized_inputs == inputs).all():
+            return
+        self.add_derivatives()
+        products = numpy.einsum("nij,nkj->nik", self.constraint_derivatives, self.constraint_derivatives)
+        try:
+            self.inverses = numpy.linalg.inv(products)
+        except numpy.linalg.LinAlgError:
+            self.inverses = numpy.array([numpy.linalg.pinv(product) for product in products])
+        self.factorized_inputs = inputs
+
+    def project(self, derivatives):
+        # project the derivative vector on the space spanned by the tangents
+        # (derivatives) of the constraint functions. The Lagrange
+        # multipliers are returned.
+        cluster_derivatives = derivatives[self.state_indices]
+        c = self.constraint_derivatives
+        mu = numpy.einsum("nij,nj->ni", self.inverses, numpy.einsum("nij,nj->ni", c, cluster_derivatives))
+        derivatives[self.state_indices] = cluster_derivatives - numpy.einsum("nji,nj->ni", c, mu)
+        return mu
+
+    def shake(self, state, max_num_shakes):
+        # returns the total number of corrections of all clusters
+        total_num_shakes = 0
+        num_shakes = 0
+        mask = self.add_outputs()
+        while mask.any():
+            self.factorize(state)
+            delta_mu = -numpy.einsum("nij,nj->ni", self.inverses[mask], self.outputs[mask])
+            state[self.state_indices[mask]] += numpy.einsum("nji,nj->ni", self.constraint_derivatives[mask], delta_mu)
+            num_shakes += 1
+            total_num_shakes += mask.sum()
+            if num_shakes > max_num_shakes:
+                raise ShakeError("The number of NR corrections exceeded the given limit (%i). This probably means that the step size is too large." % (max_num_shakes))
+            mask = self.add_outputs(mask)
         return total_num_shakes
 
 
@@ -352,6 +496,9 @@ class Helper(RootMixin, TerminusMixin):
     #def transform_derivatives(self):
     #    raise NotImplementedError
 
+    #def transform_hessian_vector(self, direction, product):
+    #    raise NotImplementedError
+
 
 class Terminus(Base, TerminusMixin):
     def __init__(self):
@@ -374,6 +521,9 @@ class Constraint(Base, TerminusMixin):
     def connect_derivatives(self, derivatives):
         self.derivatives = derivatives
 
+    def connect_multipliers(self, output_index, multipliers):
+        self.multipliers = multipliers[output_index: output_index + self.output_dimension]
+
     def clear(self):
         self.outputs[:] = 0.0
         for matrix in self.derivatives:
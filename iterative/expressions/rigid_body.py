@@ -33,12 +33,12 @@
 
 
 from base import Terminus, Constraint, Helper
-from iterative.variables.rigid_body import Frame, Translation
+from iterative.variables.rigid_body import Frame, Translation, ExponentialFrame
 
 import numpy
 
 
-__all__ = ["Orthonormality", "NoFrame", "Spring"]
+__all__ = ["Orthonormality", "NoFrame", "Spring", "SpringNetwork"]
 
 
 class Error(Exception):
@@ -47,6 +47,7 @@ class Error(Exception):
 
 class Orthonormality(Constraint):
     output_dimension = 6
+    has_hessian_vector = True
 
     def register_input_variable(self, variable):
         assert isinstance(variable, Frame), "An orthonormality constraint only supports a Frame variable."
@@ -88,13 +89,74 @@ class Orthonormality(Constraint):
                         value_counter += 1
 
 
+    # The rows of the outputs and of the derivatives, see add_outputs
+    pairs = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+
+    def add_hessian_vector(self, direction, product):
+        # the curvature of -multipliers*outputs, see Root.compute_hessian_vector
+        variable = self.input_variables[0]
+        begin = variable.state_index
+        delta_rotation = direction[begin: begin+9].reshape(3, 3)
+        result = numpy.zeros((3, 3), float)
+        for row, (a, b) in enumerate(self.pairs):
+            result[:,a] -= self.multipliers[row]*delta_rotation[:,b]
+            result[:,b] -= self.multipliers[row]*delta_rotation[:,a]
+        product[begin: begin+9] += result.ravel()
+
+    @classmethod
+    def add_outputs_batch(cls, constraints, outputs):
+        """Add the outputs of many orthonormality constraints at once
+
+        Arguments:
+          constraints  --  a list of Orthonormality instances
+          outputs  --  an array with one row of six outputs per constraint
+        """
+        rotation_matrices = numpy.array([constraint.input_variables[0].rotation_matrix for constraint in constraints])
+        for row, (a, b) in enumerate(cls.pairs):
+            outputs[:,row] += (rotation_matrices[:,:,a]*rotation_matrices[:,:,b]).sum(axis=1) - (a == b)
+
+    @classmethod
+    def add_derivatives_batch(cls, constraints, derivatives):
+        """Add the derivatives of many orthonormality constraints at once
+
+        Arguments:
+          constraints  --  a list of Orthonormality instances
+          derivatives  --  an array with one 6x12 matrix per constraint, the
+                           derivatives towards the state of its Frame
+        """
+        rotation_matrices = numpy.array([constraint.input_variables[0].rotation_matrix for constraint in constraints])
+        matrix_derivatives = derivatives[:,:,:9].reshape(-1, 6, 3, 3)
+        for row, (a, b) in enumerate(cls.pairs):
+            matrix_derivatives[:,row,:,a] += rotation_matrices[:,:,b]
+            matrix_derivatives[:,row,:,b] += rotation_matrices[:,:,a]
+        derivatives[:,:,:9] = matrix_derivatives.reshape(-1, 6, 9)
+
+
 class NoFrame(object):
     def apply_vector(self, c):
         return c
 
 
+def get_variable_slice(variable, vector):
+    return vector[variable.state_index: variable.state_index + variable.dimension]
+
+
+def compute_column_changes(deltas, norms, rest_lengths, delta_deltas):
+    # The changes of the derivatives towards the relative vectors, when the
+    # relative vectors change by delta_deltas. The arguments are arrays with
+    # one row or element per spring.
+    safe_norms = norms + (norms == 0)
+    ratios = rest_lengths/safe_norms
+    units = deltas/safe_norms.reshape(-1, 1)
+    return (
+        2*(1 - ratios).reshape(-1, 1)*delta_deltas +
+        2*ratios.reshape(-1, 1)*units*(units*delta_deltas).sum(axis=1).reshape(-1, 1)
+    )
+
+
 class Spring(Terminus):
     output_dimension = 1
+    has_hessian_vector = True
 
     def __init__(self, rest_length=0.0):
         Terminus.__init__(self)
@@ -105,8 +167,8 @@ class Spring(Terminus):
         self.rest_length = rest_length
 
     def register_input_variable(self, variable, coordinate):
-        if not (isinstance(variable, Frame) or isinstance(variable, Translation) or isinstance(variable, NoFrame)):
-            raise Error("Expression requires iterative.var.Frame or iterative.var.Translation as variable")
+        if not (isinstance(variable, Frame) or isinstance(variable, Translation) or isinstance(variable, ExponentialFrame) or isinstance(variable, NoFrame)):
+            raise Error("Expression requires iterative.var.Frame, iterative.var.Translation or iterative.var.ExponentialFrame as variable")
         self.coordinates.append(coordinate)
         self.frames.append(variable)
         if not isinstance(variable, NoFrame):
@@ -144,21 +206,165 @@ class Spring(Terminus):
                 else:
                     alpha_column = 2 * delta*(norm - self.rest_length)
 
-            current_index = 0
             if not isinstance(fa, NoFrame):
-                if isinstance(fa, Frame):
-                    for alpha in range(3):
-                        fa.derivatives[current_index:current_index+3] += alpha_column[alpha] * ca
-                        current_index += 3
-                fa.derivatives[current_index:current_index+3] += alpha_column
+                fa.add_transformation_derivatives(numpy.outer(alpha_column, ca), alpha_column)
 
         frame1, frame2 = self.frames
         coordinate1, coordinate2 = self.coordinates
         helper(frame1, frame2, coordinate1, coordinate2)
         helper(frame2, frame1, coordinate2, coordinate1)
 
+    def add_hessian_vector(self, direction, product):
+        frame1, frame2 = self.frames
+        coordinate1, coordinate2 = self.coordinates
+        end_points = [(frame1, coordinate1, 1), (frame2, coordinate2, -1)]
+        delta = frame1.apply_vector(coordinate1) - frame2.apply_vector(coordinate2)
+        norm = numpy.linalg.norm(delta)
+        delta_change = numpy.zeros(3, float)
+        for frame, coordinate, sign in end_points:
+            if not isinstance(frame, NoFrame):
+                delta_rotation, delta_translation = frame.get_transformation_tangent(get_variable_slice(frame, direction))
+                delta_change += sign*(numpy.dot(delta_rotation, coordinate) + delta_translation)
+        if self.rest_length == 0.0:
+            alpha_column = 2 * delta
+        elif norm > 0:
+            alpha_column = 2 * delta*(norm - self.rest_length)/norm
+        else:
+            alpha_column = 2 * delta*(norm - self.rest_length)
+        alpha_change = compute_column_changes(
+            delta.reshape(1, 3), numpy.array([norm]),
+            numpy.array([self.rest_length]), delta_change.reshape(1, 3)
+        )[0]
+        for frame, coordinate, sign in end_points:
+            if not isinstance(frame, NoFrame):
+                frame.add_transformation_curvature(
+                    sign*numpy.outer(alpha_column, coordinate),
+                    sign*numpy.outer(alpha_change, coordinate),
+                    sign*alpha_change,
+                    get_variable_slice(frame, direction),
+                    get_variable_slice(frame, product),
+                )
 
 
+class SpringNetwork(Terminus):
+    """The total energy of many springs, computed with array operations
 
+    This is equivalent to a Spring expression for each spring, but the end
+    points, frame indices and rest lengths of all springs are stored in flat
+    arrays. The energy and the gradient are computed at once for the whole
+    network.
+    """
+    output_dimension = 1
+    has_hessian_vector = True
 
+    def __init__(self):
+        Terminus.__init__(self)
+        # the distinct frames, in the order of registration
+        self.frames = []
+        self.frame_indices = {}
+        self.springs = []
 
+    def get_frame_index(self, variable):
+        # Returns -1 for NoFrame, i.e. for end points with fixed coordinates.
+        if isinstance(variable, NoFrame):
+            return -1
+        if not (isinstance(variable, Frame) or isinstance(variable, Translation) or isinstance(variable, ExponentialFrame)):
+            raise Error("Expression requires iterative.var.Frame, iterative.var.Translation or iterative.var.ExponentialFrame as variable")
+        index = self.frame_indices.get(variable)
+        if index is None:
+            index = len(self.frames)
+            self.frames.append(variable)
+            self.frame_indices[variable] = index
+            Terminus.register_input_variable(self, variable)
+        return index
+
+    def add_spring(self, variable1, coordinate1, variable2, coordinate2, rest_length=0.0):
+        if rest_length < 0.0:
+            raise Error("The rest length of a spring must be zero or positive.")
+        index1 = self.get_frame_index(variable1)
+        index2 = self.get_frame_index(variable2)
+        if index1 >= 0:
+            variable1.add_mass(coordinate1)
+        if index2 >= 0:
+            variable2.add_mass(coordinate2)
+        self.springs.append((index1, coordinate1, index2, coordinate2, rest_length))
+
+    def sanity_check(self):
+        if len(self.springs) == 0:
+            raise Error("A SpringNetwork expression needs at least one spring.")
+        Terminus.sanity_check(self)
+
+    def connect_outputs(self, outputs):
+        Terminus.connect_outputs(self, outputs)
+        # The fixed end points refer to an extra frame at the end of the
+        # list, with a unit rotation and no translation.
+        num_frames = len(self.frames)
+        self.indices1 = numpy.array([spring[0] for spring in self.springs], int)
+        self.indices1[self.indices1 < 0] = num_frames
+        self.coordinates1 = numpy.array([spring[1] for spring in self.springs], float)
+        self.indices2 = numpy.array([spring[2] for spring in self.springs], int)
+        self.indices2[self.indices2 < 0] = num_frames
+        self.coordinates2 = numpy.array([spring[3] for spring in self.springs], float)
+        self.rest_lengths = numpy.array([spring[4] for spring in self.springs], float)
+
+    def compute_deltas(self):
+        rotations = numpy.array([frame.rotation_matrix for frame in self.frames] + [numpy.identity(3)])
+        translations = numpy.array([frame.translation_vector for frame in self.frames] + [numpy.zeros(3)])
+        points1 = (rotations[self.indices1]*self.coordinates1.reshape(-1, 1, 3)).sum(axis=2) + translations[self.indices1]
+        points2 = (rotations[self.indices2]*self.coordinates2.reshape(-1, 1, 3)).sum(axis=2) + translations[self.indices2]
+        deltas = points1 - points2
+        return deltas, numpy.sqrt((deltas**2).sum(axis=1))
+
+    def add_outputs(self):
+        deltas, norms = self.compute_deltas()
+        self.outputs[0] += ((norms - self.rest_lengths)**2).sum()
+
+    def compute_columns(self, deltas, norms):
+        # the derivatives towards the first end points, see Spring
+        factors = 2*(norms - self.rest_lengths)/(norms + (norms == 0))
+        factors[self.rest_lengths == 0.0] = 2
+        return deltas*factors.reshape(-1, 1)
+
+    def sum_per_frame(self, columns):
+        # For each end point, the derivatives towards the rotation matrix and
+        # the translation vector of its frame are put in one row of twelve
+        # elements. The rows are added per frame with bincount.
+        num_frames = len(self.frames)
+        indices = numpy.concatenate([self.indices1, self.indices2])
+        coordinates = numpy.concatenate([self.coordinates1, self.coordinates2])
+        columns = numpy.concatenate([columns, -columns])
+        rows = numpy.concatenate([
+            (columns.reshape(-1, 3, 1)*coordinates.reshape(-1, 1, 3)).reshape(-1, 9),
+            columns,
+        ], axis=1)
+        keys = (indices.reshape(-1, 1)*12 + numpy.arange(12)).ravel()
+        return numpy.bincount(keys, rows.ravel(), (num_frames+1)*12).reshape(-1, 12)
+
+    def add_derivatives(self):
+        deltas, norms = self.compute_deltas()
+        derivatives = self.sum_per_frame(self.compute_columns(deltas, norms))
+        for frame, frame_derivatives in zip(self.frames, derivatives):
+            frame.add_transformation_derivatives(frame_derivatives[:9].reshape(3, 3), frame_derivatives[9:])
+
+    def add_hessian_vector(self, direction, product):
+        deltas, norms = self.compute_deltas()
+        # the first order changes of the transformations of the frames
+        num_frames = len(self.frames)
+        delta_rotations = numpy.zeros((num_frames+1, 3, 3), float)
+        delta_translations = numpy.zeros((num_frames+1, 3), float)
+        for index, frame in enumerate(self.frames):
+            delta_rotations[index], delta_translations[index] = frame.get_transformation_tangent(get_variable_slice(frame, direction))
+        delta_deltas = (
+            (delta_rotations[self.indices1]*self.coordinates1.reshape(-1, 1, 3)).sum(axis=2) + delta_translations[self.indices1]
+           -(delta_rotations[self.indices2]*self.coordinates2.reshape(-1, 1, 3)).sum(axis=2) - delta_translations[self.indices2]
+        )
+        derivatives = self.sum_per_frame(self.compute_columns(deltas, norms))
+        delta_derivatives = self.sum_per_frame(compute_column_changes(deltas, norms, self.rest_lengths, delta_deltas))
+        for frame, frame_derivatives, frame_delta_derivatives in zip(self.frames, derivatives, delta_derivatives):
+            frame.add_transformation_curvature(
+                frame_derivatives[:9].reshape(3, 3),
+                frame_delta_derivatives[:9].reshape(3, 3),
+                frame_delta_derivatives[9:],
+                get_variable_slice(frame, direction),
+                get_variable_slice(frame, product),
+            )
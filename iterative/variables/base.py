@@ -60,6 +60,31 @@ class Variable(object):
     def extract_state(self, state_index, state):
         raise NotImplementedError
 
+    def get_transformation_tangent(self, direction):
+        """Return the changes of the rotation matrix and translation vector
+
+        The changes are first order in a small change of the state of this
+        variable, given by direction.
+        """
+        raise NotImplementedError
+
+    def add_transformation_curvature(self, rotation_derivatives, delta_rotation_derivatives, delta_translation_derivatives, direction, product):
+        """Add a Hessian-vector product in terms of the transformation
+
+        The first argument contains the derivatives of the output towards the
+        rotation matrix. The next two arguments are the changes of the
+        derivatives towards the rotation matrix and the translation vector,
+        when the state changes by direction. The result is added to product.
+        """
+        raise NotImplementedError
+
+    def perturb(self, rotation_matrix, translation_vector):
+        """Move the initial state by a rigid body transformation
+
+        This must be called before the variable is connected to the state.
+        """
+        raise NotImplementedError
+
 
 class Helper(Variable):
     def __init__(self, *input_variables):
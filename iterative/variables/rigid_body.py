@@ -37,7 +37,7 @@ from base import Variable, Helper, SanityError
 import numpy
 
 
-__all__ = ["Frame", "Translation"]
+__all__ = ["Frame", "Translation", "ExponentialFrame"]
 
 
 class Frame(Variable):
@@ -75,9 +75,25 @@ class Frame(Variable):
     def extract_state(self, state_index, state):
         return numpy.reshape(state[state_index: state_index+9], (3,3)), state[state_index+9: state_index+12]
 
+    def perturb(self, rotation_matrix, translation_vector):
+        self.rotation_matrix = numpy.dot(rotation_matrix, self.rotation_matrix)
+        self.translation_vector = self.translation_vector + translation_vector
+
     def apply_vector(self, vector):
         return numpy.dot(self.rotation_matrix, vector) + self.translation_vector
 
+    def add_transformation_derivatives(self, rotation_derivatives, translation_derivatives):
+        self.derivatives[0: 9] += rotation_derivatives.ravel()
+        self.derivatives[9: 12] += translation_derivatives
+
+    def get_transformation_tangent(self, direction):
+        return direction[0: 9].reshape(3, 3), direction[9: 12]
+
+    def add_transformation_curvature(self, rotation_derivatives, delta_rotation_derivatives, delta_translation_derivatives, direction, product):
+        # the state is linear in the transformation
+        product[0: 9] += delta_rotation_derivatives.ravel()
+        product[9: 12] += delta_translation_derivatives
+
 
 class Translation(Variable):
     dimension = 3
@@ -106,9 +122,162 @@ class Translation(Variable):
     def extract_state(self, state_index, state):
         return state[state_index: state_index+3]
 
+    def perturb(self, rotation_matrix, translation_vector):
+        # the rotation is fixed
+        self.translation_vector = self.translation_vector + translation_vector
+
+    def apply_vector(self, vector):
+        return numpy.dot(self.rotation_matrix, vector) + self.translation_vector
+
+    def add_transformation_derivatives(self, rotation_derivatives, translation_derivatives):
+        # the rotation is fixed
+        self.derivatives[:] += translation_derivatives
+
+    def get_transformation_tangent(self, direction):
+        return numpy.zeros((3, 3), float), direction
+
+    def add_transformation_curvature(self, rotation_derivatives, delta_rotation_derivatives, delta_translation_derivatives, direction, product):
+        product[:] += delta_translation_derivatives
+
+
+def axial(matrix):
+    # the antisymmetric part of a matrix as a vector, used for the derivatives
+    # towards the rotation vector
+    return numpy.array([
+        matrix[1,2] - matrix[2,1],
+        matrix[2,0] - matrix[0,2],
+        matrix[0,1] - matrix[1,0],
+    ])
+
+
+def skew(vector):
+    return numpy.array([
+        [0.0, -vector[2], vector[1]],
+        [vector[2], 0.0, -vector[0]],
+        [-vector[1], vector[0], 0.0],
+    ], float)
+
+
+class ExponentialFrame(Variable):
+    """A rigid body transformation without constraints
+
+    The state consists of a rotation vector w and a translation vector. The
+    rotation matrix is exp([w]x)*R0, where R0 is the initial rotation matrix
+    and [w]x is the cross product matrix of w. The rotation vector starts at
+    zero. Unlike Frame, this variable needs no Orthonormality constraint.
+    """
+    dimension = 6
+
+    def __init__(self, rotation_matrix, translation_vector):
+        Variable.__init__(self)
+        self.reference_rotation = rotation_matrix.copy()
+        self.translation_vector = translation_vector
+        self.inertia_tensor = numpy.zeros((3,3), float)
+        self.inertia_mass = numpy.zeros(3, float)
+
+    def add_mass(self, coordinate):
+        self.inertia_tensor += numpy.dot(coordinate, coordinate) - numpy.outer(coordinate, coordinate)
+        self.inertia_mass += 1
+
+    def sanity_check(self):
+        Variable.sanity_check(self)
+        if self.reference_rotation.shape != (3,3):
+            raise SanityError("The rotation_matrix must be a 3x3 matrix. The given array hase shape %s." % self.reference_rotation.shape)
+        if self.translation_vector.shape != (3,):
+            raise SanityError("The translation_vector must be a vector of length 3. The given array has  shape=%s." % self.translation_vector.shape)
+
+    def connect(self, state, derivatives, mass):
+        Variable.connect(self, state, derivatives, mass)
+        self.state[0: 3] = 0.0
+        self.state[3: 6] = self.translation_vector
+        self.translation_vector = self.state[3: 6]
+        self.mass[0: 3] = self.inertia_tensor.diagonal()
+        self.mass[3: 6] = self.inertia_mass
+        self.inertia_mass = self.mass[3: 6]
+
+    def get_coefficients(self, rotation_vector):
+        # Returns sin(a)/a, (1-cos(a))/a**2 and (a-sin(a))/a**3, where a is
+        # the rotation angle. Taylor series are used for small angles.
+        angle2 = numpy.dot(rotation_vector, rotation_vector)
+        if angle2 < 1e-8:
+            return 1 - angle2/6, 0.5 - angle2/24, 1.0/6 - angle2/120
+        angle = numpy.sqrt(angle2)
+        return (
+            numpy.sin(angle)/angle,
+            (1 - numpy.cos(angle))/angle2,
+            (angle - numpy.sin(angle))/(angle2*angle),
+        )
+
+    def compute_rotation_matrix(self, rotation_vector):
+        a, b, c = self.get_coefficients(rotation_vector)
+        w = skew(rotation_vector)
+        return numpy.dot(numpy.identity(3) + a*w + b*numpy.dot(w, w), self.reference_rotation)
+
+    def get_rotation_matrix(self):
+        return self.compute_rotation_matrix(self.state[0: 3])
+
+    rotation_matrix = property(get_rotation_matrix)
+
+    def extract_state(self, state_index, state):
+        return self.compute_rotation_matrix(state[state_index: state_index+3]), state[state_index+3: state_index+6]
+
+    def perturb(self, rotation_matrix, translation_vector):
+        self.reference_rotation = numpy.dot(rotation_matrix, self.reference_rotation)
+        self.translation_vector = self.translation_vector + translation_vector
+
     def apply_vector(self, vector):
         return numpy.dot(self.rotation_matrix, vector) + self.translation_vector
 
+    def get_jacobian(self, rotation_vector):
+        # the left Jacobian of the exponential map
+        a, b, c = self.get_coefficients(rotation_vector)
+        w = skew(rotation_vector)
+        return numpy.identity(3) + b*w + c*numpy.dot(w, w)
+
+    def add_transformation_derivatives(self, rotation_derivatives, translation_derivatives):
+        # A small change in the rotation vector, d, changes the rotation
+        # matrix by [J d]x R, where J is the left Jacobian of the exponential
+        # map. The derivatives towards J d follow from the antisymmetric part
+        # of R G^T, where G are the derivatives towards the rotation matrix.
+        jacobian = self.get_jacobian(self.state[0: 3])
+        gradient = axial(numpy.dot(self.rotation_matrix, rotation_derivatives.transpose()))
+        self.derivatives[0: 3] += numpy.dot(jacobian.transpose(), gradient)
+        self.derivatives[3: 6] += translation_derivatives
 
+    def get_transformation_tangent(self, direction):
+        jacobian = self.get_jacobian(self.state[0: 3])
+        return numpy.dot(skew(numpy.dot(jacobian, direction[0: 3])), self.rotation_matrix), direction[3: 6]
 
+    def get_jacobian_change(self, rotation_vector, delta):
+        # the change of the left Jacobian when the rotation vector changes by
+        # delta. The derivatives of the coefficients b and c towards the
+        # square of the angle use Taylor series for small angles.
+        angle2 = numpy.dot(rotation_vector, rotation_vector)
+        if angle2 < 1e-8:
+            db, dc = -1.0/24 + angle2/360, -1.0/120 + angle2/2520
+        else:
+            angle = numpy.sqrt(angle2)
+            sin, cos = numpy.sin(angle), numpy.cos(angle)
+            db = (0.5*angle*sin - (1 - cos))/angle2**2
+            dc = ((1 - cos)*angle - 3*(angle - sin))/(2*angle2**2*angle)
+        a, b, c = self.get_coefficients(rotation_vector)
+        w = skew(rotation_vector)
+        v = skew(delta)
+        dangle2 = 2*numpy.dot(rotation_vector, delta)
+        return dangle2*db*w + b*v + dangle2*dc*numpy.dot(w, w) + c*(numpy.dot(v, w) + numpy.dot(w, v))
 
+    def add_transformation_curvature(self, rotation_derivatives, delta_rotation_derivatives, delta_translation_derivatives, direction, product):
+        # Change of J^T axial(R G^T) due to changes in J, R and G
+        rotation_vector = self.state[0: 3]
+        rotation_matrix = self.rotation_matrix
+        jacobian = self.get_jacobian(rotation_vector)
+        delta_rotation = numpy.dot(skew(numpy.dot(jacobian, direction[0: 3])), rotation_matrix)
+        product[0: 3] += numpy.dot(
+            self.get_jacobian_change(rotation_vector, direction[0: 3]).transpose(),
+            axial(numpy.dot(rotation_matrix, rotation_derivatives.transpose()))
+        )
+        product[0: 3] += numpy.dot(jacobian.transpose(), axial(
+            numpy.dot(delta_rotation, rotation_derivatives.transpose()) +
+            numpy.dot(rotation_matrix, delta_rotation_derivatives.transpose())
+        ))
+        product[3: 6] += delta_translation_derivatives
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+# Run from the root of the source tree:
+#
+#   python profile/bench_conscan.py
+#
+# Compares the timings of the connection scanner on the examples of
+# test/test_conscan with and without rejection of clashes.
+
+
+from conscan import Geometry, TriangleScanner, PairScanner
+
+from molmod import MolecularGraph
+from molmod.periodic import periodic
+from molmod.io import XYZFile
+
+import numpy, time
+
+
+def get_precursor_model():
+    m = XYZFile("test/input/mfi_precursor.xyz").get_molecule()
+    mgraph = MolecularGraph.from_geometry(m)
+    connect_masks = numpy.array([
+        number == 8 and len(mgraph.neighbors[index]) == 1
+        for index, number in enumerate(m.numbers)
+    ], bool)
+    radii = numpy.array([
+        periodic[number].vdw_radius * {True: 0.3, False: 1.0}[connect_mask]
+        for number, connect_mask in zip(m.numbers, connect_masks)
+    ], float)
+    return Geometry(m.coordinates, connect_masks, radii)
+
+
+class Sender(object):
+    def __init__(self):
+        self.connections = 0
+
+    def __call__(self, message):
+        if not hasattr(message, "label"):
+            self.connections += 1
+
+
+def run(label, Scanner, *args, **kwargs):
+    sender = Sender()
+    scanner = Scanner(sender, *args, **kwargs)
+    timings = []
+    for method in (
+        scanner.generate_connections, scanner.compute_transformations,
+        scanner.reject_clashes, scanner.evaluate_connections,
+        scanner.eliminate_duplicate_connections
+    ):
+        begin = time.clock()
+        method()
+        timings.append(time.clock() - begin)
+    print "%30s  %8.3f  %8.3f  %8.3f  %8.3f  %8.3f  %8.3f  %6i" % (
+        (label,) + tuple(timings) + (sum(timings), len(scanner.connections))
+    )
+
+
+if __name__ == "__main__":
+    geometry = get_precursor_model()
+    print "%30s  %8s  %8s  %8s  %8s  %8s  %8s  %6s" % (
+        "", "generate", "transf", "clashes", "evaluate", "dupes", "total", "result"
+    )
+    for clash_cutoff in None, 2.0, 1.0:
+        run(
+            "triangle, clash_cutoff=%s" % clash_cutoff, TriangleScanner,
+            geometry, None, 5.0, 0.1, True, 0.001**2, clash_cutoff=clash_cutoff,
+        )
+    for clash_cutoff in None, 2.0, 1.0:
+        run(
+            "pair, clash_cutoff=%s" % clash_cutoff, PairScanner,
+            geometry, None, 10.0, 0.1, None, clash_cutoff=clash_cutoff,
+        )
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+# Run from the root of the source tree:
+#
+#   python profile/bench_iterative.py
+#
+# Compares the minimization algorithms of the iterative package on the spring
+# problem in test/input/springs.zml, with and without rotations of the
+# frames. Rotations are represented by Frame variables with orthonormality
+# constraints and by ExponentialFrame variables.
+
+
+from conscan.batch import ZMLAtomHandler
+
+import iterative
+
+import numpy, time, xml.sax
+
+
+class SpringHandler(ZMLAtomHandler):
+    """Also reads the rest lengths of the springs in a ZML file"""
+
+    def startElement(self, name, attrs):
+        ZMLAtomHandler.startElement(self, name, attrs)
+        if name == "model_object":
+            self.records[-1]["rest_length"] = None
+
+    def endElement(self, name):
+        if name != "zml_file" and len(self.tags) >= 2:
+            tag_name, label, record = self.tags[-1]
+            parent_name, parent_label, parent_record = self.tags[-2]
+            if parent_name == "model_object" and tag_name == "float" and label == "rest_length":
+                parent_record["rest_length"] = float("".join(self.content))
+        ZMLAtomHandler.endElement(self, name)
+
+
+def load_spring_problem(filename):
+    handler = SpringHandler()
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    f = file(filename)
+    parser.parse(f)
+    f.close()
+    # (rotation matrix, translation vector) of each frame in the universe,
+    # the end points of the springs with the index of the frame (-1 for the
+    # universe) and the rest lengths.
+    frames = []
+    frame_indices = {}
+    springs = []
+    for record in handler.records:
+        if record["class"] == "Frame" and record["parent"]["class"] == "Universe":
+            frame_indices[id(record)] = len(frames)
+            frames.append((record["r"], record["t"]))
+    for record in handler.records:
+        if record["class"] == "Spring":
+            end_points = []
+            for target in record["targets"]:
+                atom = handler.records_by_id[target]
+                end_points.append((frame_indices.get(id(atom["parent"]), -1), atom["t"]))
+            rest_length = record["rest_length"]
+            if rest_length is None:
+                rest_length = 0.0
+            springs.append((end_points, rest_length))
+    return frames, springs
+
+
+def define_cost_function(frames, springs, allow_rotation, exponential=False):
+    cost_function = iterative.expr.Root(1, 10, True)
+    variables = []
+    max_step = []
+    for r, t in frames:
+        if allow_rotation and exponential:
+            variable = iterative.var.ExponentialFrame(r.copy(), t.copy())
+            cost_function.register_state_variable(variable)
+            max_step.extend([0.1, 0.1, 0.1, 1.0, 1.0, 1.0])
+        elif allow_rotation:
+            variable = iterative.var.Frame(r.copy(), t.copy())
+            cost_function.register_state_variable(variable)
+            constraint = iterative.expr.Orthonormality(1e-10)
+            constraint.register_input_variable(variable)
+            max_step.extend([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0])
+        else:
+            variable = iterative.var.Translation(r.copy(), t.copy())
+            cost_function.register_state_variable(variable)
+            max_step.extend([1.0, 1.0, 1.0])
+        variables.append(variable)
+    spring_network = iterative.expr.SpringNetwork()
+    for ((index1, coordinate1), (index2, coordinate2)), rest_length in springs:
+        spring_network.add_spring(
+            variables[index1] if index1 >= 0 else iterative.expr.NoFrame(), coordinate1,
+            variables[index2] if index2 >= 0 else iterative.expr.NoFrame(), coordinate2,
+            rest_length,
+        )
+    cost_function.parse_input()
+    return cost_function, numpy.array(max_step, float)
+
+
+def benchmark(Algorithm, frames, springs, allow_rotation, exponential=False):
+    cost_function, max_step = define_cost_function(frames, springs, allow_rotation, exponential)
+    counters = {"outputs": 0, "derivatives": 0, "hessian_vector": 0}
+    def count(name, method):
+        def wrapper(*args):
+            counters[name] += 1
+            method(*args)
+        return wrapper
+    cost_function.add_outputs = count("outputs", cost_function.add_outputs)
+    cost_function.add_derivatives = count("derivatives", cost_function.add_derivatives)
+    cost_function.compute_hessian_vector = count("hessian_vector", cost_function.compute_hessian_vector)
+
+    status = []
+    minimize = Algorithm(cost_function, max_step, max_step*1e-8)
+    begin = time.time()
+    minimize.run(status.append)
+    duration = time.time() - begin
+    name = Algorithm.__name__
+    if exponential:
+        name += " (exp)"
+    print "%24s %6i %6i %6i %6i %12.6e %8.3f" % (
+        name, len(status), counters["outputs"], counters["derivatives"],
+        counters["hessian_vector"], status[-1].value, duration,
+    )
+
+
+def main():
+    frames, springs = load_spring_problem("test/input/springs.zml")
+    for allow_rotation in True, False:
+        print "allow_rotation = %s" % allow_rotation
+        print "%24s %6s %6s %6s %6s %12s %8s" % ("algorithm", "steps", "values", "grads", "hvps", "value", "time [s]")
+        for Algorithm in iterative.alg.SteepestDescent, iterative.alg.ConjugateGradient, iterative.alg.LBFGS, iterative.alg.TruncatedNewton:
+            benchmark(Algorithm, frames, springs, allow_rotation)
+            if allow_rotation:
+                # the unconstrained rotation vector parametrization
+                benchmark(Algorithm, frames, springs, allow_rotation, True)
+        print
+
+
+if __name__ == "__main__":
+    main()
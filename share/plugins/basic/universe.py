@@ -372,22 +372,33 @@ class Universe(GLPeriodicContainer, FrameAxes):
 
                 if self.box_visible: vb.call_list(self.box_list)
 
-                # repeat the draw list for all the unit cell images.
-                if self.clipping:
-                    repetitions = (self.repetitions + 2) * self.cell.active + 1 - self.cell.active
-                else:
-                    repetitions = self.repetitions * self.cell.active + 1 - self.cell.active
-                for position in iter_all_positions(repetitions):
+                # Repeat the draw list for all the unit cell images. The
+                # batched nodes draw their own images, see BatchTile, so they
+                # are only drawn in the image without translation.
+                for t in self.get_image_translations():
+                    primary = (t == 0).all()
                     vb.push_matrix()
-                    t = numpy.dot(self.cell.matrix, numpy.array(position) - self.cell.active * self.clipping)
                     vb.translate(*t)
+                    if not primary: vb.begin_periodic_image()
                     vb.call_list(self.draw_list)
+                    if not primary: vb.end_periodic_image()
                     vb.pop_matrix()
 
                 vb.pop_name()
             vb.end_list()
             self.total_list_valid = True
 
+    def get_image_translations(self):
+        # the translations of the periodic images that are drawn
+        if self.clipping:
+            repetitions = (self.repetitions + 2) * self.cell.active + 1 - self.cell.active
+        else:
+            repetitions = self.repetitions * self.cell.active + 1 - self.cell.active
+        return numpy.array([
+            numpy.dot(self.cell.matrix, numpy.array(position) - self.cell.active * self.clipping)
+            for position in iter_all_positions(repetitions)
+        ], float)
+
     def revalidate_bounding_box(self):
         GLPeriodicContainer.revalidate_bounding_box(self)
         FrameAxes.extend_bounding_box(self, self.bounding_box)
@@ -51,11 +51,11 @@ import zeobuilder.actions.primitive as primitive
 import zeobuilder.gui.fields as fields
 import zeobuilder.authors as authors
 
-from conscan import Geometry, ProgressMessage, Connection
+from conscan import Geometry, ProgressMessage, ResultsMessage, Connection
 
 from molmod import Rotation, Translation, angstrom
 
-import gtk, numpy, weakref
+import gtk, numpy, weakref, multiprocessing, os
 
 
 class ConscanResults(ReferentBase):
@@ -366,6 +366,11 @@ class ConscanReportDialog(ChildProcessDialog):
                 pb.set_fraction(0.0)
         elif isinstance(instance, Connection):
             self.connections.append(instance)
+        elif isinstance(instance, ResultsMessage):
+            # Only the latest list of best connections is kept. From now on,
+            # the user may accept it before the scan is finished.
+            self.connections = instance.connections
+            self.allow_response()
 
 
 class ConnectionPointDescription(fields.composed.ComposedInTable):
@@ -454,6 +459,35 @@ class ScanForConnections(ImmediateWithMemory):
                         low=0.0,
                         low_inclusive=False,
                     ),
+                    fields.faulty.Int(
+                        label_text="Number of processes",
+                        attribute_name="num_workers",
+                        minimum=1,
+                    ),
+                    fields.optional.CheckOptional(fields.faulty.Float(
+                        label_text="Reject clashes with a penalty above",
+                        attribute_name="clash_cutoff",
+                        low=0.0,
+                    )),
+                    fields.optional.CheckOptional(fields.faulty.Int(
+                        label_text="Only keep the best connections, at most",
+                        attribute_name="top_k",
+                        minimum=1,
+                    )),
+                    fields.optional.CheckOptional(fields.group.Table(fields=[
+                        fields.faulty.Float(
+                            label_text="Rotation tolerance (quaternion)",
+                            attribute_name="rotation_tolerance",
+                            low=0.0,
+                            low_inclusive=False,
+                        ),
+                        fields.faulty.Length(
+                            label_text="Translation tolerance",
+                            attribute_name="translation_tolerance",
+                            low=0.0,
+                            low_inclusive=False,
+                        ),
+                    ], label_text="Merge connections with similar transformations")),
                     fields.group.Table(fields=[
                         fields.optional.RadioOptional(slave=fields.group.Table(fields=[
                             fields.edit.CheckButton(
@@ -485,8 +519,11 @@ class ScanForConnections(ImmediateWithMemory):
         ("comp_env", "Comparing environments"),
         ("calc_trans", "Calculating transformations"),
         ("mirror", "Adding inversions"),
+        ("rej_clash", "Rejecting clashes"),
+        ("survived", "Connections without clashes"),
         ("eval_con", "Evaluating connections"),
         ("elim_dup", "Eliminating duplicates"),
+        ("elim_trans", "Eliminating similar transformations"),
         ("send_con", "Receiving solutions"),
     ])
 
@@ -494,8 +531,11 @@ class ScanForConnections(ImmediateWithMemory):
         ("calc_env", "Calculating environments"),
         ("comp_env", "Comparing environments"),
         ("calc_trans", "Calculating transformations"),
+        ("rej_clash", "Rejecting clashes"),
+        ("survived", "Connections without clashes"),
         ("eval_con", "Evaluating connections"),
         ("elim_dup", "Eliminating duplicates"),
+        ("elim_trans", "Eliminating similar transformations"),
         ("send_con", "Receiving solutions"),
     ])
 
@@ -522,11 +562,14 @@ class ScanForConnections(ImmediateWithMemory):
         result.connect_description2 = (Expression("True"), Expression("node.get_radius()"))
         result.repulse_description2 = (Expression("True"), Expression("node.get_radius()"))
         result.action_radius = 7*angstrom
-        result.distance_tolerance = 0.1*angstrom
+        result.translation_tolerance = 0.1*angstrom
         result.hit_tolerance = 0.1*angstrom
         result.allow_inversions = True
         result.minimum_triangle_size = 0.1*angstrom
         result.rotation_tolerance = 0.05
+        result.num_workers = multiprocessing.cpu_count()
+        result.clash_cutoff = Undefined(2.0)
+        result.top_k = Undefined(1000)
         result.rotation2 = Undefined(rotation2)
         return result
 
@@ -611,6 +654,22 @@ class ScanForConnections(ImmediateWithMemory):
             inp["geometry2"] = None
         inp["action_radius"] = self.parameters.action_radius
         inp["hit_tolerance"] = self.parameters.hit_tolerance
+        inp["num_workers"] = self.parameters.num_workers
+        inp["cache_dir"] = os.path.join(context.user_dir, "conscan_cache")
+        if isinstance(self.parameters.clash_cutoff, Undefined):
+            inp["clash_cutoff"] = None
+        else:
+            inp["clash_cutoff"] = self.parameters.clash_cutoff
+        if isinstance(self.parameters.rotation_tolerance, Undefined):
+            inp["rotation_tolerance"] = None
+            inp["translation_tolerance"] = None
+        else:
+            inp["rotation_tolerance"] = self.parameters.rotation_tolerance
+            inp["translation_tolerance"] = self.parameters.translation_tolerance
+        if isinstance(self.parameters.top_k, Undefined):
+            inp["top_k"] = None
+        else:
+            inp["top_k"] = self.parameters.top_k
         if not isinstance(self.parameters.allow_inversions, Undefined):
             inp["allow_rotations"] = True
             inp["allow_inversions"] = self.parameters.allow_inversions
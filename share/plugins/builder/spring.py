@@ -55,7 +55,7 @@ from molmod import Complete, Translation, angstrom
 
 import iterative
 
-import numpy, gtk, sys, time
+import numpy, gtk, sys, time, os, tempfile
 
 
 __all__ = ["Spring"]
@@ -207,7 +207,7 @@ class OptimizationReportDialog(ChildProcessDialog, GladeWrapper):
         self.init_proxies(["la_num_iter", "la_rms_error", "progress_bar"])
         self.state_indices = None
 
-    def run(self, minimize, involved_frames, update_interval, update_steps, num_springs):
+    def run(self, minimize, involved_frames, update_interval, update_steps, num_springs, multi_start=None):
         self.la_num_iter.set_text("0")
         self.la_rms_error.set_text(express_measure(0.0, "Length"))
         self.progress_bar.set_fraction(0.0)
@@ -222,12 +222,26 @@ class OptimizationReportDialog(ChildProcessDialog, GladeWrapper):
         self.last_step = 0
         self.status = None
 
-        result = ChildProcessDialog.run(self,
-            [context.get_share_filename("helpers/iterative")],
-            self.minimize, pickle=True
+        fd, filename = tempfile.mkstemp(prefix="zeobuilder_state_")
+        os.close(fd)
+        self.state_buffer = iterative.alg.StateBuffer(
+            filename, minimize.root_expression.state_dimension, create=True
         )
+        try:
+            result = ChildProcessDialog.run(self,
+                [context.get_share_filename("helpers/iterative")],
+                {
+                    "algorithm": self.minimize,
+                    "state_buffer": filename,
+                    "multi_start": multi_start,
+                }, pickle=True
+            )
+        finally:
+            self.state_buffer.close()
+            os.remove(filename)
 
         # just to avoid confusion
+        del self.state_buffer
         del self.minimize
         del self.involved_frames
         del self.update_interval
@@ -252,21 +266,41 @@ class OptimizationReportDialog(ChildProcessDialog, GladeWrapper):
             return
         self.update_gui()
 
+    def get_transformations(self):
+        if hasattr(self.status, "transformations"):
+            # the multi start results carry their own transformations
+            return self.status.transformations
+        if self.status.state is None:
+            # fetch the most recent state from the shared buffer, only when
+            # the frames are actually redrawn.
+            latest = self.state_buffer.read()
+            if latest is None:
+                return None
+            self.status = latest
+        return [
+            variable.extract_state(state_index, self.status.state)
+            for state_index, variable
+            in zip(self.state_indices, self.minimize.root_expression.state_variables)
+        ]
+
     def update_gui(self):
-        if self.status is not None:
-            self.la_num_iter.set_text("%i" % self.status.step)
-            self.la_rms_error.set_text(express_measure(numpy.sqrt(self.status.value/self.num_springs), "Length"))
-            self.progress_bar.set_text("%i%%" % int(self.status.progress*100))
-            self.progress_bar.set_fraction(self.status.progress)
-            for state_index, frame, variable in zip(self.state_indices, self.involved_frames, self.minimize.root_expression.state_variables):
-                if isinstance(variable, iterative.var.Frame):
-                    r, t = variable.extract_state(state_index, self.status.state)
-                    frame.set_transformation(Complete(r, t))
-                elif isinstance(variable, iterative.var.Translation):
-                    t = variable.extract_state(state_index, self.status.state)
-                    new_transformation = frame.transformation.copy_with(t=t)
-                    frame.set_transformation(new_transformation)
-            context.application.main.drawing_area.queue_draw()
+        if self.status is None:
+            return
+        transformations = self.get_transformations()
+        if transformations is None:
+            return
+        self.la_num_iter.set_text("%i" % self.status.step)
+        self.la_rms_error.set_text(express_measure(numpy.sqrt(self.status.value/self.num_springs), "Length"))
+        self.progress_bar.set_text("%i%%" % int(self.status.progress*100))
+        self.progress_bar.set_fraction(self.status.progress)
+        for transformation, frame, variable in zip(transformations, self.involved_frames, self.minimize.root_expression.state_variables):
+            if isinstance(variable, iterative.var.Frame) or isinstance(variable, iterative.var.ExponentialFrame):
+                r, t = transformation
+                frame.set_transformation(Complete(r, t))
+            elif isinstance(variable, iterative.var.Translation):
+                new_transformation = frame.transformation.copy_with(t=transformation)
+                frame.set_transformation(new_transformation)
+        context.application.main.drawing_area.queue_draw()
 
     def on_receive(self, instance):
         if isinstance(instance, iterative.alg.Status):
@@ -341,6 +375,17 @@ class OptimizeSprings(ImmediateWithMemory):
                 attribute_name="update_steps",
                 minimum=1
             ),
+            fields.faulty.Int(
+                label_text="Number of (randomly perturbed) starts",
+                attribute_name="num_starts",
+                minimum=1
+            ),
+            fields.faulty.Length(
+                label_text="Perturbation radius",
+                attribute_name="perturbation_radius",
+                low=0.0,
+                low_inclusive=True,
+            ),
         ]),
         ((gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL), (gtk.STOCK_OK, gtk.RESPONSE_OK)),
     )
@@ -368,6 +413,8 @@ class OptimizeSprings(ImmediateWithMemory):
         result.allow_rotation = True
         result.update_interval = 0.4
         result.update_steps = 1
+        result.num_starts = 1
+        result.perturbation_radius = 2*angstrom
         return result
 
     def do(self):
@@ -389,14 +436,13 @@ class OptimizeSprings(ImmediateWithMemory):
             if frame is None:
                 pass
             elif self.parameters.allow_rotation and isinstance(frame.transformation, Complete):
-                variable = iterative.var.Frame(
+                # six degrees of freedom without orthonormality constraints
+                variable = iterative.var.ExponentialFrame(
                     frame.transformation.r,
                     frame.transformation.t,
                 )
                 cost_function.register_state_variable(variable)
-                constraint = iterative.expr.Orthonormality(1e-10)
-                constraint.register_input_variable(variable)
-                max_step.extend([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0])
+                max_step.extend([0.1, 0.1, 0.1, 1.0, 1.0, 1.0])
             elif isinstance(frame.transformation, Translation):
                 variable = iterative.var.Translation(
                     frame.transformation.r,
@@ -407,19 +453,25 @@ class OptimizeSprings(ImmediateWithMemory):
             else:
                 raise UserError("The involved frames shoud be at least capable of being translated.")
 
+        spring_network = iterative.expr.SpringNetwork()
         for spring, frames in springs.iteritems():
-            spring_term = iterative.expr.Spring(spring.rest_length)
+            end_points = []
             for target, frame in frames.iteritems():
                 if frame is None:
-                    spring_term.register_input_variable(
+                    end_points.append((
                         iterative.expressions.NoFrame(),
                         target.get_frame_up_to(parent).t
-                    )
+                    ))
                 else:
-                    spring_term.register_input_variable(
+                    end_points.append((
                         cost_function.state_variables[variable_indices[frame]],
                         target.get_frame_up_to(frame).t
-                    )
+                    ))
+            (variable1, coordinate1), (variable2, coordinate2) = end_points
+            spring_network.add_spring(
+                variable1, coordinate1, variable2, coordinate2,
+                spring.rest_length
+            )
 
         max_step = numpy.array(max_step, float)
         minimize = iterative.alg.DefaultMinimize(
@@ -428,12 +480,21 @@ class OptimizeSprings(ImmediateWithMemory):
             max_step*1e-8,
         )
 
+        if self.parameters.num_starts > 1:
+            multi_start = {
+                "num_starts": self.parameters.num_starts,
+                "radius": self.parameters.perturbation_radius,
+            }
+        else:
+            multi_start = None
+
         result = self.report_dialog.run(
             minimize,
             involved_frames,
             self.parameters.update_interval,
             self.parameters.update_steps,
             len(springs),
+            multi_start,
         )
         if result != gtk.RESPONSE_OK:
             for frame, transformation in old_transformations:
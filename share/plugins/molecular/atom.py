@@ -56,6 +56,7 @@ import numpy
 class Atom(GLGeometricBase, UserColorMixin):
     info = ModelObjectInfo("plugins/molecular/atom.svg")
     authors = [authors.toon_verstraelen]
+    batchable = True
 
     #
     # State
@@ -141,6 +142,12 @@ class Atom(GLGeometricBase, UserColorMixin):
         vb = context.application.vis_backend
         vb.draw_sphere(self.get_radius(), self.quality)
 
+    def add_instances(self, batch):
+        batch.add_sphere(
+            self.transformation.t, self.get_radius(), self.get_color(),
+            self.quality
+        )
+
     #
     # Revalidation
     #
@@ -44,6 +44,7 @@ import zeobuilder.gui.fields as fields
 import zeobuilder.authors as authors
 
 from molmod.bonds import bonds, BOND_SINGLE, BOND_DOUBLE, BOND_TRIPLE, BOND_HYBRID, BOND_HYDROGEN
+from molmod import Rotation
 
 import numpy, gtk
 
@@ -51,6 +52,7 @@ import numpy, gtk
 class Bond(Vector):
     info = ModelObjectInfo("plugins/molecular/bond.svg")
     authors = [authors.toon_verstraelen]
+    batchable = True
 
     #
     # State
@@ -148,6 +150,32 @@ class Bond(Vector):
         vb.set_color(*end.get_color())
         vb.draw_cone(half_radius, self.end_radius, half_length, self.quality)
 
+    def add_instances(self, batch):
+        # the same cones as in draw, in the frame of the parent
+        self.calc_vector_dimensions()
+        if self.length <= 0: return
+        half_length = 0.5 * (self.end_position - self.begin_position)
+        if half_length <= 0: return
+        half_radius = 0.5 * (self.begin_radius + self.end_radius)
+
+        begin = self.children[0].target
+        end = self.children[1].target
+
+        if isinstance(self.orientation, Rotation):
+            rotation = self.orientation.r
+        else:
+            rotation = numpy.identity(3, float)
+        axis = rotation[:,2]
+        base = self.orientation.t + axis*self.begin_position
+        batch.add_cone(
+            base, rotation, half_length, self.begin_radius, half_radius,
+            begin.get_color(), self.quality
+        )
+        batch.add_cone(
+            base + axis*half_length, rotation, half_length, half_radius,
+            self.end_radius, end.get_color(), self.quality
+        )
+
     #
     # Revalidation
     #
@@ -33,13 +33,17 @@
 
 
 
-from conscan import Geometry, Connection, ProgressMessage, TriangleScanner, PairScanner
+from conscan import Geometry, Connection, QualityEvaluator, ProgressMessage, \
+    ResultsMessage, TriangleScanner, PairScanner, EnvironmentCache, \
+    EnvironmentTable
+from conscan.batch import load_atoms, read_geometry, load_manifest, main as batch_main
 
 from molmod import Rotation, MolecularGraph
 from molmod.periodic import periodic
+from molmod.bonds import bonds, BOND_SINGLE
 from molmod.io import XYZFile
 
-import numpy as np, random
+import numpy as np, random, copy, os, shutil, json
 
 
 
@@ -66,6 +70,8 @@ class Sender(object):
             print "=~-~"*20
         if isinstance(message, Connection):
             self.connections.append(message)
+        elif isinstance(message, ResultsMessage):
+            self.connections = message.connections
 
 
 def get_simple_model1():
@@ -247,3 +253,275 @@ def test_pair_ego_precursor_rot():
     scanner.run()
 
 
+
+def test_triangle_engines_precursor():
+    geometry = Geometry(*get_precursor_model())
+    results = []
+    for engine in TriangleScanner.engines:
+        sender = Sender()
+        scanner = TriangleScanner(
+            send=sender,
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            allow_inversions=False,
+            minimum_trianlge_area=0.001**2,
+            engine=engine,
+        )
+        scanner.generate_connections()
+        results.append([sorted(connection.pairs) for connection in scanner.connections])
+    assert len(results[0]) > 0
+    assert results[0] == results[1]
+
+def test_triangle_transformations_precursor():
+    geometry = Geometry(*get_precursor_model())
+    scanner = TriangleScanner(
+        send=Sender(),
+        geometry1=geometry,
+        geometry2=None,
+        action_radius=5.0,
+        hit_tolerance=0.1,
+        allow_inversions=True,
+        minimum_trianlge_area=0.001**2,
+    )
+    scanner.generate_connections()
+    connections = scanner.connections
+    results = []
+    for engine in TriangleScanner.engines:
+        scanner.engine = engine
+        scanner.connections = copy.deepcopy(connections)
+        scanner.compute_transformations()
+        results.append([connection.transformation for connection in scanner.connections])
+    assert len(results[0]) == 2*len(connections)
+    assert len(results[0]) == len(results[1])
+    for transformation1, transformation2 in zip(*results):
+        assert abs(transformation1.r - transformation2.r).max() < 1e-6
+        assert abs(transformation1.t - transformation2.t).max() < 1e-6
+
+
+def test_pair_parallel_precursor():
+    geometry = Geometry(*get_precursor_model())
+    results = []
+    for num_workers in 1, 3:
+        sender = Sender()
+        scanner = PairScanner(
+            send=sender,
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            rotation2=None,
+            num_workers=num_workers,
+        )
+        scanner.generate_connections()
+        results.append([sorted(connection.pairs) for connection in scanner.connections])
+    assert len(results[0]) > 0
+    assert results[0] == results[1]
+
+def test_quality_evaluator_precursor():
+    geometry = Geometry(*get_precursor_model())
+    scanner = TriangleScanner(
+        send=Sender(),
+        geometry1=geometry,
+        geometry2=None,
+        action_radius=5.0,
+        hit_tolerance=0.1,
+        allow_inversions=True,
+        minimum_trianlge_area=0.001**2,
+    )
+    scanner.generate_connections()
+    scanner.compute_transformations()
+    connections = scanner.connections
+    references = copy.deepcopy(connections)
+    for reference in references:
+        reference.compute_quality(geometry, geometry)
+    evaluator = QualityEvaluator(geometry, geometry, max_points=10000)
+    evaluator.compute(connections)
+    for connection, reference in zip(connections, references):
+        assert abs(connection.quality - reference.quality) < 1e-10
+        assert connection.pairs == reference.pairs
+
+def test_reject_clashes_precursor():
+    geometry = Geometry(*get_precursor_model())
+    clash_cutoff = 1.0
+    scanner = TriangleScanner(
+        send=Sender(),
+        geometry1=geometry,
+        geometry2=None,
+        action_radius=5.0,
+        hit_tolerance=0.1,
+        allow_inversions=True,
+        minimum_trianlge_area=0.001**2,
+        clash_cutoff=clash_cutoff,
+    )
+    scanner.generate_connections()
+    scanner.compute_transformations()
+    connections = scanner.connections
+    scanner.reject_clashes()
+    survivors = set(id(connection) for connection in scanner.connections)
+    assert len(survivors) < len(connections)
+    for connection in connections:
+        if id(connection) not in survivors:
+            # the positive terms in the quality are at most one per pair
+            connection.compute_quality(geometry, geometry)
+            assert connection.quality < len(connection.pairs) - clash_cutoff
+
+
+def test_triangle_streaming_simple():
+    geometry1 = Geometry(*get_simple_model1())
+    geometry2 = Geometry(*get_simple_model2())
+    qualities = []
+    for top_k in None, 1:
+        sender = Sender()
+        scanner = TriangleScanner(
+            send=sender,
+            geometry1=geometry1,
+            geometry2=geometry2,
+            action_radius=10.0,
+            hit_tolerance=0.1,
+            allow_inversions=True,
+            minimum_trianlge_area=0.001**2,
+            top_k=top_k,
+        )
+        scanner.run()
+        qualities.append([connection.quality for connection in sender.connections])
+    assert len(qualities[1]) == 1
+    assert qualities[1][0] == max(qualities[0])
+
+def test_equivalent_transformations_precursor():
+    geometry = Geometry(*get_precursor_model())
+    rotation_tolerance = 0.05
+    translation_tolerance = 0.2
+    sender = Sender()
+    scanner = TriangleScanner(
+        send=sender,
+        geometry1=geometry,
+        geometry2=None,
+        action_radius=5.0,
+        hit_tolerance=0.1,
+        allow_inversions=True,
+        minimum_trianlge_area=0.001**2,
+        rotation_tolerance=rotation_tolerance,
+        translation_tolerance=translation_tolerance,
+    )
+    scanner.run()
+    connections = sender.connections
+    assert len(connections) > 0
+    for index1, connection1 in enumerate(connections):
+        for connection2 in connections[:index1]:
+            t1 = connection1.transformation
+            t2 = connection2.transformation
+            if abs(t1.t - t2.t).max() < translation_tolerance and \
+               abs(t1.r - t2.r).max() < 0.1*rotation_tolerance:
+                assert False
+
+def test_environment_cache_precursor():
+    geometry = Geometry(*get_precursor_model())
+    cache = EnvironmentCache("test/output/conscan_cache")
+    if os.path.isdir(cache.directory):
+        shutil.rmtree(cache.directory)
+    results = []
+    for i in xrange(2):
+        sender = Sender()
+        scanner = PairScanner(
+            send=sender,
+            geometry1=geometry,
+            geometry2=None,
+            action_radius=5.0,
+            hit_tolerance=0.1,
+            rotation2=None,
+            cache=cache,
+        )
+        scanner.run()
+        assert len(os.listdir(cache.directory)) == 1
+        results.append(sorted(sorted(connection.pairs) for connection in sender.connections))
+    assert results[0] == results[1]
+    assert cache.load(geometry, 4.0) is None
+
+
+def test_environment_table_precursor():
+    geometry = Geometry(*get_precursor_model())
+    scanner = PairScanner(
+        send=Sender(),
+        geometry1=geometry,
+        geometry2=None,
+        action_radius=5.0,
+        hit_tolerance=0.1,
+        rotation2=None,
+    )
+    scanner.compute_environmental_descriptions()
+    table = geometry.environment_table
+    assert isinstance(table, EnvironmentTable)
+    assert table.offsets[-1] == len(table.neighbors)
+    for environment in geometry.environments.itervalues():
+        for index, neighbor in enumerate(environment.neighbors):
+            assert environment.find(neighbor) == index
+            delta = geometry.coordinates[neighbor] - environment.coordinate
+            assert abs(environment.deltas[index] - delta).max() < 1e-10
+            assert abs(environment.distances[index] - np.linalg.norm(delta)) < 1e-10
+        assert environment.find(environment.id) == -1
+
+
+def test_batch_load_atoms():
+    atoms = load_atoms("test/input/precursor.zml")
+    assert len(atoms) == 126
+    assert atoms[0].number == 14
+    assert abs(atoms[0].coordinate - [-8.35761614355, -2.30397298874, 0.561343145402]).max() < 1e-10
+    geometry, indexes = read_geometry(atoms, ("node.number==14", "0.5"), ("node.number==8", "1.0"))
+    assert geometry.connect_masks.sum() == sum(atom.number == 14 for atom in atoms)
+    assert (geometry.radii[geometry.connect_masks] == 0.5).all()
+    for index, coordinate in zip(indexes, geometry.coordinates):
+        assert (atoms[index].coordinate == coordinate).all()
+
+
+def test_batch_expression_names():
+    # the same names as in the expressions of Zeobuilder
+    atoms = load_atoms("test/input/precursor.zml")
+    geometry, indexes = read_geometry(
+        atoms,
+        ("node.number==14", "bonds.get_length(node.number, 8, BOND_SINGLE)"),
+        ("node.number==8 and BOND_SINGLE != BOND_DOUBLE != BOND_TRIPLE", "1.0"),
+    )
+    length = bonds.get_length(14, 8, BOND_SINGLE)
+    assert length is not None
+    assert (geometry.radii[geometry.connect_masks] == length).all()
+
+
+def test_batch_precursor():
+    options = [
+        "--connect-filter", "node.number==14", "--connect-radius", "0.5",
+        "--repulse-filter", "node.number==8",
+    ]
+    batch_main(options + ["test/input/precursor.zml", "test/output/conscan_batch.npz"])
+    f = np.load("test/output/conscan_batch.npz")
+    qualities = f["qualities"]
+    assert len(qualities) > 0
+    assert (qualities[1:] <= qualities[:-1]).all()
+    assert f["rotations"].shape == (len(qualities), 3, 3)
+    assert f["pair_offsets"][-1] == len(f["pairs"])
+
+    f = file("test/output/conscan_batch_manifest.json", "w")
+    json.dump([
+        {"block1": "../input/precursor.zml", "output": "conscan_batch.json"},
+        {"block1": "../input/precursor.zml", "output": "conscan_batch_top.json", "top_k": 5},
+    ], f)
+    f.close()
+    batch_main(options + ["--manifest", "test/output/conscan_batch_manifest.json", "-j", "2"])
+    f = file("test/output/conscan_batch.json")
+    connections = json.load(f)
+    f.close()
+    assert len(connections) == len(qualities)
+    assert abs(np.array([c["quality"] for c in connections]) - qualities).max() < 1e-10
+
+
+def test_batch_manifest_num_workers():
+    f = file("test/output/conscan_batch_workers.json", "w")
+    json.dump([
+        {"block1": "../input/precursor.zml", "output": "a.json"},
+        {"block1": "../input/precursor.zml", "output": "b.json", "num_workers": 4},
+    ], f)
+    f.close()
+    jobs = load_manifest("test/output/conscan_batch_workers.json", {"num_workers": 2, "top_k": None})
+    assert [job["num_workers"] for job in jobs] == [1, 1]
+    assert jobs[1]["output"] == os.path.join(os.path.abspath("test/output"), "b.json")
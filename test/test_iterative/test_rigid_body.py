@@ -34,7 +34,7 @@
 
 import iterative
 
-import numpy
+import numpy, os, tempfile
 
 
 def define_cost_function1():
@@ -127,6 +127,54 @@ def define_cost_function2():
     return cost_function
 
 
+def define_cost_function3(use_network, exponential=False):
+    cost_function = iterative.expr.Root(1, 5, True)
+
+    rotation_matrix = numpy.array([
+        [ 1.0,  0.0,  0.0],
+        [ 0.0,  1.0,  0.0],
+        [ 0.0,  0.0,  1.0],
+    ], float)
+    if exponential:
+        frame1 = iterative.var.ExponentialFrame(rotation_matrix, numpy.array([1.0, 0.0, 0.0], float))
+        cost_function.register_state_variable(frame1)
+    else:
+        frame1 = iterative.var.Frame(rotation_matrix, numpy.array([1.0, 0.0, 0.0], float))
+        cost_function.register_state_variable(frame1)
+        constraint1 = iterative.expr.Orthonormality(1e-6)
+        constraint1.register_input_variable(frame1)
+
+    frame2 = iterative.var.Translation(
+        numpy.array([
+            [ 0.0, -1.0 , 0.0],
+            [ 1.0,  0.0,  0.0],
+            [ 0.0,  0.0,  1.0],
+        ], float),
+        numpy.array([0.0, 0.0, -3.0], float)
+    )
+    cost_function.register_state_variable(frame2)
+
+    springs = [
+        (frame1, numpy.array([ 0.0,  2.0,  1.2]), frame2, numpy.array([-3.0,  2.0,  1.2]), 0.5),
+        (frame1, numpy.array([-1.0,  0.5,  0.0]), frame2, numpy.array([ 0.0, -1.2,  0.5]), 0.0),
+        (frame2, numpy.array([ 0.7, -2.0, -0.3]), frame1, numpy.array([ 1.5,  0.0, -2.7]), 0.5),
+        (iterative.expr.NoFrame(), numpy.array([ 0.7, -2.0, -0.3]), frame1, numpy.array([ 1.5,  0.0, -2.7]), 0.2),
+        (frame2, numpy.array([ 0.2,  0.1, -0.3]), iterative.expr.NoFrame(), numpy.array([ 1.5,  1.0,  2.7]), 0.0),
+    ]
+    if use_network:
+        network = iterative.expr.SpringNetwork()
+        for spring in springs:
+            network.add_spring(*spring)
+    else:
+        for variable1, coordinate1, variable2, coordinate2, rest_length in springs:
+            spring = iterative.expr.Spring(rest_length)
+            spring.register_input_variable(variable1, coordinate1)
+            spring.register_input_variable(variable2, coordinate2)
+
+    cost_function.parse_input()
+    return cost_function
+
+
 def report(status):
     pass
     #print status.step, status.value
@@ -157,6 +205,28 @@ def test_minimize_noincrease1_conjugate_gradient():
     minimize.run(report)
 
 
+def test_minimize_noincrease1_lbfgs():
+    cost_function = define_cost_function1()
+
+    minimize = iterative.alg.LBFGS(
+        cost_function,
+        numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0]*2, float),
+        1e-5,
+    )
+    minimize.run(report)
+
+
+def test_minimize_noincrease1_truncated_newton():
+    cost_function = define_cost_function1()
+
+    minimize = iterative.alg.TruncatedNewton(
+        cost_function,
+        numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0]*2, float),
+        1e-5,
+    )
+    minimize.run(report)
+
+
 def test_minimize_noincrease2_steepest_descent():
     cost_function = define_cost_function2()
 
@@ -179,6 +249,216 @@ def test_minimize_noincrease2_conjugate_gradient():
     minimize.run(report)
 
 
+def test_minimize_noincrease2_lbfgs():
+    cost_function = define_cost_function2()
+
+    minimize = iterative.alg.LBFGS(
+        cost_function,
+        numpy.array([1.0, 1.0, 1.0]*2, float),
+        1e-5,
+    )
+    minimize.run(report)
+
+
+def test_minimize_noincrease2_truncated_newton():
+    cost_function = define_cost_function2()
+
+    minimize = iterative.alg.TruncatedNewton(
+        cost_function,
+        numpy.array([1.0, 1.0, 1.0]*2, float),
+        1e-5,
+    )
+    minimize.run(report)
+
+
+def test_minimize_noincrease3_conjugate_gradient():
+    cost_function = define_cost_function3(True)
+
+    minimize = iterative.alg.ConjugateGradient(
+        cost_function,
+        numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float),
+        1e-5,
+    )
+    minimize.run(report)
+
+
+def test_minimize_lbfgs_steepest_descent():
+    values = []
+    for Algorithm in iterative.alg.SteepestDescent, iterative.alg.LBFGS:
+        cost_function = define_cost_function3(True)
+        minimize = Algorithm(
+            cost_function,
+            numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float),
+            1e-5,
+        )
+        minimize.run(report)
+        cost_function.clear_outputs()
+        cost_function.add_outputs()
+        values.append(cost_function.outputs[0])
+        for cluster in cost_function.constraint_clusters:
+            for constraint in cluster.rules:
+                constraint.clear()
+                constraint.add_outputs()
+                assert constraint.converged()
+    assert abs(values[0] - values[1]) < 1e-4
+
+
+def test_minimize_truncated_newton_lbfgs():
+    for exponential in False, True:
+        if exponential:
+            max_step = [0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+        else:
+            max_step = [0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+        values = []
+        for Algorithm in iterative.alg.LBFGS, iterative.alg.TruncatedNewton:
+            cost_function = define_cost_function3(True, exponential)
+            minimize = Algorithm(cost_function, numpy.array(max_step, float), 1e-6)
+            minimize.run(report)
+            cost_function.clear_outputs()
+            cost_function.add_outputs()
+            values.append(cost_function.outputs[0])
+        assert abs(values[0] - values[1]) < 1e-4
+
+
+def test_hessian_vector():
+    numpy.random.seed(3)
+    def compute_gradient(expr):
+        expr.clear()
+        expr.add_outputs()
+        expr.add_derivatives()
+        return expr.derivatives.copy()
+    for use_network in False, True:
+        for exponential in False, True:
+            for constrain_derivatives in False, True:
+                expr = define_cost_function3(use_network, exponential)
+                expr.constrain_derivatives = constrain_derivatives
+                assert expr.has_hessian_vector()
+                if exponential:
+                    expr.state[:3] = [0.3, -0.2, 0.5]
+                compute_gradient(expr)
+                direction = numpy.random.normal(0, 1, len(expr.state))
+                expr.project(direction)
+                product = numpy.zeros(len(expr.state), float)
+                expr.compute_hessian_vector(direction, product)
+                # compare with finite differences of the derivatives
+                state = expr.state.copy()
+                epsilon = 1e-6
+                expr.state[:] = state + epsilon*direction
+                gradient_plus = compute_gradient(expr)
+                expr.state[:] = state - epsilon*direction
+                gradient_min = compute_gradient(expr)
+                expr.state[:] = state
+                compute_gradient(expr)
+                numerical = (gradient_plus - gradient_min)/(2*epsilon)
+                expr.project(numerical)
+                assert abs(numerical - product).max() < 1e-6*abs(product).max()
+
+
+def test_exponential_frame_derivatives():
+    for use_network in False, True:
+        expr = define_cost_function3(use_network, True)
+        expr.state[:3] = [0.3, -0.2, 0.5]
+        expr.clear()
+        expr.add_outputs()
+        expr.add_derivatives()
+        value = expr.outputs[0]
+        derivatives = expr.derivatives.copy()
+        epsilon = 1e-6
+        for index in xrange(len(expr.state)):
+            expr.state[index] += epsilon
+            expr.clear_outputs()
+            expr.add_outputs()
+            expr.state[index] -= epsilon
+            numerical = (expr.outputs[0] - value)/epsilon
+            assert abs(numerical - derivatives[index]) < 1e-4*max(1, abs(numerical))
+
+
+def test_minimize_exponential_frame():
+    values = []
+    for exponential in False, True:
+        cost_function = define_cost_function3(True, exponential)
+        if exponential:
+            max_step = [0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+        else:
+            max_step = [0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+        minimize = iterative.alg.LBFGS(cost_function, numpy.array(max_step, float), 1e-6)
+        minimize.run(report)
+        cost_function.clear_outputs()
+        cost_function.add_outputs()
+        values.append(cost_function.outputs[0])
+        rotation_matrix = cost_function.state_variables[0].rotation_matrix
+        assert abs(numpy.dot(rotation_matrix.transpose(), rotation_matrix) - numpy.identity(3)).max() < 1e-5
+    assert abs(values[0] - values[1]) < 1e-4
+
+
+def test_state_buffer():
+    cost_function = define_cost_function3(True)
+    minimize = iterative.alg.LBFGS(
+        cost_function,
+        numpy.array([0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float),
+        1e-5,
+    )
+    fd, filename = tempfile.mkstemp(prefix="zeobuilder_state_")
+    os.close(fd)
+    try:
+        reader = iterative.alg.StateBuffer(filename, cost_function.state_dimension, create=True)
+        writer = iterative.alg.StateBuffer(filename, cost_function.state_dimension)
+        assert reader.read() is None
+        steps = []
+        def report(status):
+            writer.write(status)
+            latest = reader.read()
+            assert latest.sequence == status.step
+            assert latest.value == status.value
+            assert (latest.state == status.state).all()
+            assert latest.state is not status.state
+            steps.append(latest.step)
+        minimize.run(report)
+        assert steps == range(1, len(steps)+1)
+        writer.close()
+        reader.close()
+    finally:
+        os.remove(filename)
+
+
+def test_multi_start():
+    max_step = numpy.array([0.1, 0.1, 0.1, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0], float)
+    single = iterative.alg.run_single_start(iterative.alg.LBFGS(define_cost_function3(True, True), max_step, 1e-6))
+    ranked = []
+    for num_processes in 1, 2:
+        minimize = iterative.alg.LBFGS(define_cost_function3(True, True), max_step, 1e-6)
+        multi_start = iterative.alg.MultiStart(minimize, 5, 2.0, num_processes, seed=1)
+        results = multi_start.run(report)
+        assert len(results) == 5
+        assert sorted(result.start for result in results) == range(5)
+        values = [result.value for result in results]
+        assert values == sorted(values)
+        for result in results:
+            if result.start == 0:
+                assert abs(result.value - single.value) < 1e-10
+        assert len(results[0].transformations) == 2
+        ranked.append(values)
+    assert abs(numpy.array(ranked[0]) - numpy.array(ranked[1])).max() < 1e-10
+
+
+def test_spring_network():
+    results = []
+    for use_network in False, True:
+        expr = define_cost_function3(use_network)
+        expr.constrain_derivatives = False
+        expr.clear()
+        expr.add_outputs()
+        expr.add_derivatives()
+        results.append((
+            expr.outputs[0],
+            numpy.concatenate([variable.derivatives for variable in expr.state_variables]),
+            numpy.concatenate([variable.mass for variable in expr.state_variables]),
+        ))
+    assert abs(results[0][0] - results[1][0]) < 1e-10
+    assert abs(results[0][1] - results[1][1]).max() < 1e-10
+    assert abs(results[0][2] - results[1][2]).max() < 1e-10
+
+
 def test_constraint_derivatives():
     expr = define_cost_function1()
 
@@ -204,3 +484,26 @@ def test_constraint_derivatives():
         overlap = (numpy.dot(cluster.constraint_derivatives, cluster.state_derivatives)**2).sum()
         assert overlap < 1e-5
 
+
+def test_orthonormality_batch():
+    expr = define_cost_function1()
+    constraints = [cluster.rules[0] for cluster in expr.constraint_clusters]
+    for constraint in constraints:
+        constraint.input_variables[0].rotation_matrix += 0.05*numpy.random.normal(0, 1, (3, 3))
+
+    outputs = numpy.zeros((len(constraints), 6), float)
+    derivatives = numpy.zeros((len(constraints), 6, 12), float)
+    iterative.expr.Orthonormality.add_outputs_batch(constraints, outputs)
+    iterative.expr.Orthonormality.add_derivatives_batch(constraints, derivatives)
+    for index, constraint in enumerate(constraints):
+        constraint.clear()
+        constraint.add_outputs()
+        constraint.add_derivatives()
+        assert abs(outputs[index] - constraint.outputs).max() < 1e-12
+        assert abs(derivatives[index] - constraint.derivatives[0]).max() < 1e-12
+
+    expr.shake()
+    for constraint in constraints:
+        constraint.clear()
+        constraint.add_outputs()
+        assert constraint.converged()
@@ -38,8 +38,9 @@ from zeobuilder import context
 from zeobuilder.actions.composed import Parameters
 from zeobuilder.expressions import Expression
 import zeobuilder.actions.primitive as primitive
+from zeobuilder.gui.visual.batch import InstanceBatch
 
-from molmod import angstrom, Translation
+from molmod import angstrom, Translation, Rotation
 from molmod.bonds import BOND_SINGLE
 
 import numpy
@@ -478,3 +479,59 @@ def test_com_praxes_diatomic():
         CenterOfMassAndPrincipalAxes()
     run_application(fn)
 
+
+class ConeRecorder(object):
+    """Records the cones drawn by a node, in the frame of its parent"""
+    def __init__(self):
+        self.r = numpy.identity(3, float)
+        self.t = numpy.zeros(3, float)
+        self.color = None
+        self.cones = []
+
+    def transform(self, transformation):
+        if isinstance(transformation, Translation):
+            self.t = self.t + numpy.dot(self.r, transformation.t)
+        if isinstance(transformation, Rotation):
+            self.r = numpy.dot(self.r, transformation.r)
+
+    def translate(self, x, y, z):
+        self.t = self.t + numpy.dot(self.r, [x, y, z])
+
+    def set_color(self, r, g, b, a=1.0):
+        self.color = (r, g, b, a)
+
+    def draw_cone(self, radius1, radius2, length, quality):
+        self.cones.append((self.t, self.r, length, radius1, radius2, self.color, quality))
+
+def test_bond_instances():
+    def fn():
+        context.application.model.file_open("test/input/precursor.zml")
+        Bond = context.application.plugins.get_node("Bond")
+        Frame = context.application.plugins.get_node("Frame")
+        bonds = []
+        for node in context.application.model.universe.children:
+            if isinstance(node, Frame):
+                bonds.extend(child for child in node.children if isinstance(child, Bond))
+        assert len(bonds) > 0
+        vis_backend = context.application.vis_backend
+        try:
+            for bond in bonds:
+                recorder = ConeRecorder()
+                context.application.vis_backend = recorder
+                bond.draw()
+                batch = InstanceBatch()
+                bond.add_instances(batch)
+                assert len(recorder.cones) == 2
+                assert batch.cones.keys() == [bond.quality]
+                bases, rotations, lengths, radii1, radii2, colors, names = batch.cones[bond.quality]
+                for index, (base, rotation, length, radius1, radius2, color, quality) in enumerate(recorder.cones):
+                    assert quality == bond.quality
+                    assert abs(bases[index] - base).max() < 1e-10
+                    assert abs(rotations[index] - rotation).max() < 1e-10
+                    assert abs(lengths[index] - length) < 1e-10
+                    assert abs(radii1[index] - radius1) < 1e-10
+                    assert abs(radii2[index] - radius2) < 1e-10
+                    assert (colors[index] == color).all()
+        finally:
+            context.application.vis_backend = vis_backend
+    run_application(fn)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from common import *
+
+from zeobuilder.render import parse_rotation, get_model_name, make_jobs
+from zeobuilder.gui.visual.offscreen import write_png
+
+from molmod import angstrom, deg
+
+import numpy, optparse, struct, zlib
+
+
+def test_write_png():
+    numpy.random.seed(3)
+    image = numpy.random.randint(0, 256, (5, 7, 3)).astype(numpy.uint8)
+    write_png("test/output/tmp.png", image)
+    f = file("test/output/tmp.png", "rb")
+    data = f.read()
+    f.close()
+    assert data[:8] == "\x89PNG\r\n\x1a\n"
+    # split the file in chunks and check the checksums
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        size, = struct.unpack("!I", data[pos:pos+4])
+        tag = data[pos+4:pos+8]
+        chunk_data = data[pos+8:pos+8+size]
+        crc, = struct.unpack("!I", data[pos+8+size:pos+12+size])
+        assert crc == zlib.crc32(tag + chunk_data) & 0xffffffff
+        chunks.append((tag, chunk_data))
+        pos += 12 + size
+    assert pos == len(data)
+    assert [tag for tag, chunk_data in chunks] == ["IHDR", "IDAT", "IEND"]
+    # width, height, 8 bits per sample, RGB, no interlacing
+    assert struct.unpack("!IIBBBBB", chunks[0][1]) == (7, 5, 8, 2, 0, 0, 0)
+    assert chunks[2][1] == ""
+    # each row starts with filter type zero
+    raw = zlib.decompress(chunks[1][1])
+    assert len(raw) == 5*(1 + 7*3)
+    for index, row in enumerate(image):
+        begin = index*(1 + 7*3)
+        assert raw[begin] == "\0"
+        assert raw[begin+1:begin+1+7*3] == row.tostring()
+
+
+def test_parse_rotation():
+    axis, angle = parse_rotation("0,0,1,90")
+    assert axis == [0.0, 0.0, 1.0]
+    assert abs(angle - 90*deg) < 1e-10
+    axis, angle = parse_rotation("1.5,-2,0.5,-30")
+    assert axis == [1.5, -2.0, 0.5]
+    assert abs(angle + 30*deg) < 1e-10
+    for description in "0,0,1", "0,0,0,10", "a,b,c,d", "", "1,2,3,4,5":
+        try:
+            parse_rotation(description)
+            assert False, "Expecting a ValueError for '%s'." % description
+        except ValueError:
+            pass
+
+
+def test_get_model_name():
+    assert get_model_name("test/input/tpa.zml") == "tpa"
+    assert get_model_name("tpa.xyz.gz") == "tpa"
+    assert get_model_name("/tmp/lau.zml.bz2") == "lau"
+    assert get_model_name("models/sod") == "sod"
+    assert get_model_name("precursor.v2.zml") == "precursor.v2"
+
+
+def test_make_jobs():
+    options = optparse.Values({
+        "output": "images/%(name)s-%(frame)02i.png",
+        "rotation": "1,0,0,45",
+        "frames": 4,
+        "turn": 180.0,
+        "viewer_distance": 50.0,
+        "opening_angle": 30.0,
+        "window_size": 20.0,
+        "window_depth": 100.0,
+    })
+    jobs = make_jobs(["test/input/tpa.zml", "test/input/sod.zml.gz"], options)
+    assert len(jobs) == 8
+    # the frames of a model are consecutive
+    assert [job["filename"] for job in jobs] == ["test/input/tpa.zml"]*4 + ["test/input/sod.zml.gz"]*4
+    assert [job["output"] for job in jobs] == [
+        "images/tpa-00.png", "images/tpa-01.png", "images/tpa-02.png", "images/tpa-03.png",
+        "images/sod-00.png", "images/sod-01.png", "images/sod-02.png", "images/sod-03.png",
+    ]
+    for index, job in enumerate(jobs):
+        assert abs(job["turn"] - 45*deg*(index % 4)) < 1e-10
+        assert job["axis"] == [1.0, 0.0, 0.0]
+        assert abs(job["angle"] - 45*deg) < 1e-10
+        assert abs(job["viewer_distance"] - 50*angstrom) < 1e-10
+        assert abs(job["opening_angle"] - 30*deg) < 1e-10
+        assert abs(job["window_size"] - 20*angstrom) < 1e-10
+        assert abs(job["window_depth"] - 100*angstrom) < 1e-10
+    options.rotation = "0,0,0,45"
+    try:
+        make_jobs(["test/input/tpa.zml"], options)
+        assert False, "Expecting a ValueError."
+    except ValueError:
+        pass
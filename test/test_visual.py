@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+from common import *
+
+from zeobuilder import context
+from zeobuilder.gui.visual.batch import sphere_mesh, circle_mesh, \
+    disk_mesh, InstanceBatch
+
+from molmod import angstrom, deg, Translation, Rotation, Complete, UnitCell
+
+import numpy
+
+
+def get_triangle_normals(vertices, triangles):
+    # not normalized, zero for degenerate triangles
+    a, b, c = vertices[triangles[:,0]], vertices[triangles[:,1]], vertices[triangles[:,2]]
+    return numpy.cross(b - a, c - a), (a + b + c)/3
+
+
+def test_sphere_mesh():
+    for quality in 4, 7, 12:
+        vertices, triangles = sphere_mesh(quality)
+        # the vertices are also the normals
+        assert abs(numpy.sqrt((vertices**2).sum(axis=1)) - 1).max() < 1e-10
+        normals, centers = get_triangle_normals(vertices, triangles)
+        areas = numpy.sqrt((normals**2).sum(axis=1))
+        # only the triangles at the poles are degenerate
+        assert (areas > 1e-10).sum() == 2*quality*max(quality/2, 2) - 2*quality
+        # counter-clockwise when seen from the outside
+        assert ((normals*centers).sum(axis=1)[areas > 1e-10] > 0).all()
+
+
+def test_circle_mesh():
+    for quality in 3, 8, 15:
+        cosines, sines, triangles = circle_mesh(quality)
+        assert len(cosines) == quality + 1
+        assert abs(cosines**2 + sines**2 - 1).max() < 1e-10
+        vertices = numpy.zeros((2*len(cosines), 3), float)
+        vertices[:,0] = numpy.concatenate([cosines, cosines])
+        vertices[:,1] = numpy.concatenate([sines, sines])
+        vertices[len(cosines):,2] = 1
+        normals, centers = get_triangle_normals(vertices, triangles)
+        centers[:,2] = 0
+        assert len(triangles) == 2*quality
+        assert ((normals*centers).sum(axis=1) > 0).all()
+        assert abs(normals[:,2]).max() < 1e-10
+
+
+def test_disk_mesh():
+    for quality in 3, 8, 15:
+        vertices, triangles = disk_mesh(quality)
+        assert len(triangles) == quality
+        assert (vertices[0] == 0).all()
+        assert abs(vertices[:,2]).max() == 0
+        normals, centers = get_triangle_normals(vertices, triangles)
+        assert (normals[:,2] > 0).all()
+        # the triangles cover the disk exactly once
+        assert abs(0.5*normals[:,2].sum() - 0.5*quality*numpy.sin(2*numpy.pi/quality)) < 1e-10
+
+
+def get_random_batch(size):
+    numpy.random.seed(5)
+    batch = InstanceBatch()
+    for name in xrange(size):
+        batch.name = name
+        color = numpy.random.uniform(0, 1, 4)
+        if name % 3 == 0:
+            rotation = numpy.linalg.qr(numpy.random.normal(0, 1, (3, 3)))[0]
+            batch.add_cone(
+                numpy.random.uniform(-20, 20, 3), rotation,
+                numpy.random.uniform(0.5, 3), numpy.random.uniform(0.1, 1),
+                numpy.random.uniform(0.1, 1), color, 8 + name % 2
+            )
+        else:
+            batch.add_sphere(
+                numpy.random.uniform(-20, 20, 3), numpy.random.uniform(0.1, 1),
+                color, 10 + 5*(name % 2)
+            )
+    return batch
+
+
+def get_instances(batch):
+    # a dictionary with (quality, fields) for each name
+    result = {}
+    for kind, groups in ("sphere", batch.spheres), ("cone", batch.cones):
+        for quality, group in groups.iteritems():
+            for index, name in enumerate(group[-1]):
+                assert name not in result
+                result[name] = (kind, quality, [field[index] for field in group[:-1]])
+    return result
+
+
+def test_batch_split():
+    batch = get_random_batch(300)
+    tile_size = 7.0
+    tiles = batch.split(tile_size)
+    assert len(tiles) > 1
+    assert sum(len(tile) for tile in tiles.itervalues()) == len(batch)
+    # the same instances
+    instances = get_instances(batch)
+    tile_instances = {}
+    for key, tile in tiles.iteritems():
+        for name, (kind, quality, fields) in get_instances(tile).iteritems():
+            assert name not in tile_instances
+            tile_instances[name] = (kind, quality, fields)
+            # the center is in the tile
+            if kind == "sphere":
+                center = fields[0]
+            else:
+                center = fields[0] + fields[1][:,2]*0.5*fields[2]
+            assert tuple(numpy.floor(center/tile_size).astype(int)) == key
+    assert sorted(instances) == sorted(tile_instances)
+    for name, (kind, quality, fields) in instances.iteritems():
+        tile_kind, tile_quality, tile_fields = tile_instances[name]
+        assert kind == tile_kind
+        assert quality == tile_quality
+        for field, tile_field in zip(fields, tile_fields):
+            assert (field == tile_field).all()
+    # the same corners
+    corners = numpy.array([tile.corners for tile in tiles.itervalues()])
+    assert (corners[:,0].min(axis=0) == batch.corners[0]).all()
+    assert (corners[:,1].max(axis=0) == batch.corners[1]).all()
+    assert max(tile.max_radius for tile in tiles.itervalues()) == batch.max_radius
+
+
+def test_batch_remove():
+    batch = get_random_batch(30)
+    selected = batch.subset([3, 4, 5])
+    assert sorted(selected.get_names()) == [3, 4, 5]
+    batch.remove([3, 4, 5])
+    assert len(batch) == 27
+    assert 4 not in batch.get_names()
+    batch.extend(selected)
+    assert (batch.get_names() == numpy.arange(30)).all()
+
+
+def call_with_gl(fn, *args):
+    # compiling lists requires the gl context
+    drawing_area = context.application.main.drawing_area
+    drawable = drawing_area.get_gl_drawable()
+    assert drawable.gl_begin(drawing_area.get_gl_context())
+    try:
+        return fn(*args)
+    finally:
+        drawable.gl_end()
+
+
+def revalidate_scene():
+    assert call_with_gl(context.application.scene.revalidate)
+
+
+def test_revalidation_order():
+    def fn():
+        scene = context.application.scene
+        revalidate_scene()
+        calls = []
+        def make_revalidation(label):
+            def revalidation():
+                calls.append(label)
+            return revalidation
+        first = make_revalidation("first")
+        second = make_revalidation("second")
+        shallow = make_revalidation("shallow")
+        deep = make_revalidation("deep")
+        deeper = make_revalidation("deeper")
+        scene.add_revalidation(first)
+        scene.add_revalidation(shallow, 1)
+        scene.add_revalidation(deeper, 3)
+        scene.add_revalidation(second)
+        scene.add_revalidation(deep, 2)
+        # scheduled revalidations are not added twice
+        scene.add_revalidation(first)
+        scene.add_revalidation(deep, 2)
+        revalidate_scene()
+        assert calls == ["deeper", "deep", "shallow", "first", "second"]
+    run_application(fn)
+
+
+def test_revalidation_bounding_boxes():
+    def fn():
+        context.application.model.file_open("test/input/precursor.zml")
+        revalidate_scene()
+        universe = context.application.model.universe
+        Frame = context.application.plugins.get_node("Frame")
+        Atom = context.application.plugins.get_node("Atom")
+        frame = [node for node in universe.children if isinstance(node, Frame)][0]
+        atom = [node for node in frame.children if isinstance(node, Atom)][0]
+        # The parents are invalidated before the atom, but their bounding
+        # boxes must be computed after the one of the atom.
+        atom.set_user_radius(10*angstrom)
+        revalidate_scene()
+        def assert_contains(outer, inner):
+            assert (outer.corners[0] <= inner.corners[0] + 1e-10).all()
+            assert (outer.corners[1] >= inner.corners[1] - 1e-10).all()
+        assert_contains(frame.bounding_box, atom.get_bounding_box_in_parent_frame())
+        assert_contains(universe.bounding_box, frame.get_bounding_box_in_parent_frame())
+    run_application(fn)
+
+
+def get_box_corners(corners, frame):
+    # the eight corners of a box in a frame, in model coordinates
+    return [
+        frame*numpy.array([corners[i,0], corners[j,1], corners[k,2]])
+        for i in 0, 1 for j in 0, 1 for k in 0, 1
+    ]
+
+
+def look_at(center, distance):
+    # put the eye at the given distance from a point in model coordinates,
+    # looking along the negative z-axis
+    camera = context.application.camera
+    scene = context.application.scene
+    camera.rotation_center = Translation(center - scene.model_center.t)
+    camera.eye = Translation([0, 0, distance - camera.znear])
+
+
+def get_first_frame():
+    universe = context.application.model.universe
+    Frame = context.application.plugins.get_node("Frame")
+    return [node for node in universe.children if isinstance(node, Frame)][0]
+
+
+def test_lod_levels():
+    def fn():
+        context.application.model.file_open("test/input/precursor.zml")
+        scene = context.application.scene
+        camera = context.application.camera
+        camera.opening_angle = 60*deg
+        camera.window_depth = 2000*angstrom
+        revalidate_scene()
+        frame = get_first_frame()
+        assert len(frame.batch_tiles) > 0
+        # the eye is put on an atom, which is then inside its tile
+        Atom = context.application.plugins.get_node("Atom")
+        atom = [node for node in frame.children if isinstance(node, Atom)][0]
+        center = atom.get_absolute_frame().t
+        width, height = 400, 300
+
+        def get_expected_level(tile):
+            # the level at the corner of the tile that is closest to the eye
+            depth = min(
+                -camera.model_to_eye(corner)[2] for corner
+                in get_box_corners(tile.corners, frame.get_absolute_frame())
+            )
+            return scene.get_lod_level(tile.radius, depth, min(width, height))
+
+        # near the container, the tile around the eye gets the most detail
+        look_at(center, 0.0)
+        call_with_gl(scene.update_batch_tiles, width, height)
+        levels = [tile.level for tile in frame.batch_tiles.itervalues()]
+        assert 0 in levels
+        for tile in frame.batch_tiles.itervalues():
+            assert tile.level == get_expected_level(tile)
+
+        # far away, all tiles get the least detail
+        look_at(center, 1000*angstrom)
+        call_with_gl(scene.update_batch_tiles, width, height)
+        for tile in frame.batch_tiles.itervalues():
+            assert tile.level == len(scene.lod_levels) - 1
+            assert tile.level == get_expected_level(tile)
+    run_application(fn)
+
+
+def test_frustum_planes():
+    def fn():
+        FileNew = context.application.plugins.get_action("FileNew")
+        FileNew()
+        scene = context.application.scene
+        camera = context.application.camera
+        camera.rotation = Rotation.from_properties(0.7, [1, 2, 3], False)
+        camera.rotation_center = Translation([1.0, -2.0, 0.5])
+        width, height = 400, 300
+        for opening_angle in 0.0, 60*deg:
+            camera.opening_angle = opening_angle
+            normals, offsets = scene.get_frustum_planes(width, height)
+            znear = camera.znear
+            zfar = znear + camera.window_depth
+            w = 0.5*camera.window_size*width/height
+            h = 0.5*camera.window_size
+
+            def is_inside(point_e):
+                values = numpy.dot(normals, camera.eye_to_model(numpy.array(point_e, float))) + offsets
+                return (values >= 0).all()
+
+            for fraction in 0.01, 0.5, 0.99:
+                depth = znear + fraction*camera.window_depth
+                # the size of the window grows with the depth in perspective
+                if znear > 0:
+                    scale = depth/znear
+                else:
+                    scale = 1.0
+                for sx in -1, 1:
+                    for sy in -1, 1:
+                        assert is_inside([0.99*sx*w*scale, 0.99*sy*h*scale, -depth])
+                        assert not is_inside([1.01*sx*w*scale, 0.0, -depth])
+                        assert not is_inside([0.0, 1.01*sy*h*scale, -depth])
+            assert not is_inside([0.0, 0.0, -znear + 0.01*camera.window_depth])
+            assert not is_inside([0.0, 0.0, -zfar - 0.01*camera.window_depth])
+    run_application(fn)
+
+
+def test_culled_tiles():
+    def fn():
+        context.application.model.file_open("test/input/precursor.zml")
+        universe = context.application.model.universe
+        scene = context.application.scene
+        camera = context.application.camera
+        frame = get_first_frame()
+        # a second frame, far from the first one
+        Frame = context.application.plugins.get_node("Frame")
+        Atom = context.application.plugins.get_node("Atom")
+        far_frame = Frame(transformation=Translation([300*angstrom, 0, 0]))
+        universe.add(far_frame)
+        far_frame.add(Atom())
+        far_frame.add(Atom(transformation=Translation([15*angstrom, 0, 0])))
+        revalidate_scene()
+        assert len(frame.batch_tiles) > 0
+        assert len(far_frame.batch_tiles) == 2
+        # only the first frame is in the window
+        camera.opening_angle = 0.0
+        camera.window_size = 100*angstrom
+        look_at(frame.get_absolute_frame()*frame.bounding_box.corners.mean(axis=0), 100*angstrom)
+        call_with_gl(scene.update_batch_tiles, 400, 300)
+        for tile in frame.batch_tiles.itervalues():
+            assert (tile.offsets == numpy.zeros((1, 3), float)).all()
+            assert tile.offsets.shape == (1, 3)
+        for tile in far_frame.batch_tiles.itervalues():
+            assert tile.offsets.shape == (0, 3)
+        # and the other way around
+        look_at(far_frame.get_absolute_frame()*far_frame.bounding_box.corners.mean(axis=0), 100*angstrom)
+        call_with_gl(scene.update_batch_tiles, 400, 300)
+        for tile in frame.batch_tiles.itervalues():
+            assert tile.offsets.shape == (0, 3)
+        for tile in far_frame.batch_tiles.itervalues():
+            assert (tile.offsets == numpy.zeros((1, 3), float)).all()
+            assert tile.offsets.shape == (1, 3)
+    run_application(fn)
+
+
+def test_periodic_tiles():
+    def fn():
+        FileNew = context.application.plugins.get_action("FileNew")
+        FileNew()
+        universe = context.application.model.universe
+        scene = context.application.scene
+        camera = context.application.camera
+        universe.set_cell(UnitCell(numpy.identity(3, float)*10*angstrom, numpy.ones(3, bool)))
+        universe.set_repetitions(numpy.array([2, 2, 2], int))
+        # a rotated frame in the middle of the cell
+        Frame = context.application.plugins.get_node("Frame")
+        Atom = context.application.plugins.get_node("Atom")
+        rotation = Rotation.from_properties(0.5, [1, 1, 0], False).r
+        frame = Frame(transformation=Complete(rotation, numpy.ones(3, float)*5*angstrom))
+        universe.add(frame)
+        for position in [0, 0, 0], [2, 0, 0], [0, -2, 1], [1, 1, -2]:
+            frame.add(Atom(transformation=Translation(numpy.array(position, float)*angstrom)))
+        revalidate_scene()
+        assert len(frame.batch_tiles) > 0
+        # everything is in the window
+        camera.opening_angle = 0.0
+        camera.window_size = 500*angstrom
+        camera.window_depth = 2000*angstrom
+        look_at(universe.model_center.t, 500*angstrom)
+
+        call_with_gl(scene.update_batch_tiles, 400, 300)
+        translations = universe.get_image_translations()
+        assert len(translations) == 8
+        for tile in frame.batch_tiles.itervalues():
+            # the translations of all images, in the frame of the container
+            assert abs(tile.offsets - numpy.dot(translations, rotation)).max() < 1e-10
+
+        # with clipping, only the images that overlap the clipped region
+        universe.set_clipping(True)
+        assert len(scene.clip_planes) == 6
+        call_with_gl(scene.update_batch_tiles, 400, 300)
+        translations = universe.get_image_translations()
+        assert len(translations) == 64
+        low = -universe.clip_margin
+        high = 20*angstrom + universe.clip_margin
+        for tile in frame.batch_tiles.itervalues():
+            corners = numpy.array(get_box_corners(tile.corners, frame.get_absolute_frame()))
+            expected = [
+                translation for translation in translations
+                if ((corners + translation).max(axis=0) >= low).all() and
+                   ((corners + translation).min(axis=0) <= high).all()
+            ]
+            assert len(expected) == 8
+            assert abs(tile.offsets - numpy.dot(expected, rotation)).max() < 1e-10
+    run_application(fn)
@@ -39,7 +39,7 @@ import gtk
 import sys, traceback
 
 
-__all__ = ["Application"]
+__all__ = ["Application", "HeadlessApplication"]
 
 
 class Application(object):
@@ -137,3 +137,37 @@ class TestApplication(Application):
             gtk.main_quit()
 
 
+
+
+class HeadlessApplication(Application):
+    """An application without windows that draws the model offscreen
+
+    The model is loaded with context.application.model.file_open and the
+    images are obtained with context.application.vis_backend.render. Plugin
+    modules that can not be loaded without a display are skipped.
+    """
+    def __init__(self, width, height):
+        context.application = self
+
+        self.initialize_config()
+        self.initialize_model()
+        self.initialize_action_manager()
+        self.initialize_offscreen(width, height)
+        self.initialize_cache()
+        self.initialize_plugins()
+
+    def initialize_plugins(self):
+        from zeobuilder.plugins import PluginsCollection
+        self.plugins = PluginsCollection(tolerant=True)
+
+    def initialize_offscreen(self, width, height):
+        from zeobuilder.gui.visual.scene import Scene
+        from zeobuilder.gui.visual.camera import Camera
+        from zeobuilder.gui.visual.offscreen import VisBackendOffscreen, OffscreenMain
+        self.camera = Camera()
+        self.scene = Scene()
+        # each image is drawn once, so all revalidations must be done first
+        self.scene.revalidation_budget = None
+        self.main = OffscreenMain()
+        self.vis_backend = VisBackendOffscreen(self.scene, self.camera, width, height)
+        self.vis_backend.initialize_draw()
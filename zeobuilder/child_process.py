@@ -36,7 +36,7 @@ from zeobuilder import context
 from zeobuilder.application import TestApplication
 from zeobuilder.gui.simple import ok_error
 
-import gobject, gtk, subprocess, cPickle, gobject, os
+import gobject, gtk, subprocess, cPickle, gobject, os, signal
 
 
 __all__ = ["ChildProcessDialog"]
@@ -53,6 +53,8 @@ class ChildProcessDialog(object):
         self.response_active = False
         self.error_lines = []
         self.pickle = pickle
+        # set by _on_done, after which the event sources are removed
+        self.done = False
 
         for button in self.buttons:
             button.set_sensitive(False)
@@ -68,10 +70,13 @@ class ChildProcessDialog(object):
         env['PYTHONPATH'] = python_path
 
         #print >> sys.stderr, "ZEOBUILDER, spawn process"
+        # The child process gets its own process group, such that stop can
+        # also terminate the processes it starts itself, e.g. the workers of
+        # a multiprocessing pool.
         self.process = subprocess.Popen(
             args, bufsize=0, stdin=subprocess.PIPE,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env,
+            env=env, preexec_fn=os.setpgrp,
         )
         if self.pickle:
             cPickle.dump(input_data, self.process.stdin, -1)
@@ -89,10 +94,36 @@ class ChildProcessDialog(object):
         self.dialog.set_transient_for(context.parent_window)
         result = self.response_loop()
         self.dialog.hide()
+        if not self.done:
+            # The response was given before _on_done. Even when the child
+            # process has already exited, its last output may still be
+            # queued and the watches must not fire after run returns.
+            self.stop()
 
         #print >> sys.stderr, "result", result
         return result
 
+    def allow_response(self):
+        """Let the user close the dialog before the child process finishes
+
+        The child process and its own child processes are terminated when
+        the dialog is closed early.
+        """
+        if not self.response_active:
+            self.response_active = True
+            for button in self.buttons:
+                button.set_sensitive(True)
+
+    def stop(self):
+        for source in self.event_sources:
+            gobject.source_remove(source)
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except OSError:
+            # the process group is already gone
+            pass
+        self.process.wait()
+
     def response_loop(self):
         response = self.dialog.run()
         while not self.response_active:
@@ -123,6 +154,7 @@ class ChildProcessDialog(object):
 
     def _on_done(self, source, condition):
         #print >> sys.stderr, "ZEOBUILDER, _on_done"
+        self.done = True
         self.response_active = True
         for button in self.buttons:
             button.set_sensitive(True)
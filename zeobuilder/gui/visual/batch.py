@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+
+
+import numpy
+
+
+__all__ = ["sphere_mesh", "circle_mesh", "disk_mesh", "InstanceBatch"]
+
+
+def sphere_mesh(quality):
+    """Return the vertices and triangles of a unit sphere
+
+    Like gluSphere, the sphere has quality slices around the z-axis and
+    quality/2 stacks along the z-axis. The vertices are also the normals. The
+    triangles are counter-clockwise when seen from the outside.
+    """
+    slices = quality
+    stacks = max(quality/2, 2)
+    theta = numpy.linspace(0, numpy.pi, stacks+1)
+    phi = numpy.linspace(0, 2*numpy.pi, slices+1)
+    vertices = numpy.zeros((stacks+1, slices+1, 3), float)
+    vertices[:,:,0] = numpy.outer(numpy.sin(theta), numpy.cos(phi))
+    vertices[:,:,1] = numpy.outer(numpy.sin(theta), numpy.sin(phi))
+    vertices[:,:,2] = numpy.cos(theta).reshape(-1, 1)
+    # the corners of the quads: a and d on the upper ring, b and c below
+    a = (numpy.arange(stacks).reshape(-1, 1)*(slices+1) + numpy.arange(slices)).ravel()
+    b = a + slices + 1
+    c = b + 1
+    d = a + 1
+    triangles = numpy.concatenate([
+        numpy.array([a, b, c]).transpose(),
+        numpy.array([a, c, d]).transpose(),
+    ])
+    return vertices.reshape(-1, 3), triangles
+
+
+def circle_mesh(quality):
+    """Return the cosines, sines and side triangles of a unit cone
+
+    The vertices of a cone side are a bottom ring followed by a top ring,
+    each with quality+1 points. The triangles are counter-clockwise when seen
+    from the outside.
+    """
+    phi = numpy.linspace(0, 2*numpy.pi, quality+1)
+    a = numpy.arange(quality)
+    b = a + 1
+    c = b + quality + 1
+    d = a + quality + 1
+    triangles = numpy.concatenate([
+        numpy.array([a, b, c]).transpose(),
+        numpy.array([a, c, d]).transpose(),
+    ])
+    return numpy.cos(phi), numpy.sin(phi), triangles
+
+
+def disk_mesh(quality):
+    """Return the vertices and triangles of a unit disk in the xy-plane
+
+    The first vertex is the center, followed by a ring of quality+1 points.
+    The triangles are counter-clockwise when seen from the positive z-axis.
+    """
+    phi = numpy.linspace(0, 2*numpy.pi, quality+1)
+    vertices = numpy.zeros((quality+2, 3), float)
+    vertices[1:,0] = numpy.cos(phi)
+    vertices[1:,1] = numpy.sin(phi)
+    a = numpy.arange(quality) + 1
+    triangles = numpy.array([numpy.zeros(quality, int), a, a + 1]).transpose()
+    return vertices, triangles
+
+
+def _concatenate(group1, group2):
+    # join two groups of instances, i.e. two tuples of arrays
+    return tuple(numpy.concatenate([a, b]) for a, b in zip(group1, group2))
+
+
+def _take(group, indices):
+    # the instances at the given indices or mask
+    return tuple(field[indices] for field in group)
+
+
+class InstanceBatch(object):
+    """Instance data of spheres and cones, grouped by quality
+
+    Nodes that can be drawn in batches (see GLMixin.batchable) add their
+    primitives to a batch, and each group of instances is then drawn with
+    one call of the vis backend. Every instance gets the current name of the
+    batch, i.e. the name of the node that adds it (see VisBackend.create_name),
+    such that the instances can be picked and replaced node by node.
+    """
+
+    def __init__(self):
+        # The instances of each quality are a tuple of arrays, one for each
+        # argument of draw_spheres or draw_cones, followed by the names.
+        self.spheres = {}
+        self.cones = {}
+        # the instances that are not yet merged into the arrays, see flush
+        self.new_spheres = {}
+        self.new_cones = {}
+        self.name = 0
+
+    def __len__(self):
+        self.flush()
+        return sum(len(group[-1]) for group in self.iter_groups())
+
+    def add_sphere(self, center, radius, color, quality):
+        self.new_spheres.setdefault(quality, []).append((center, radius, color, self.name))
+
+    def add_cone(self, base, rotation, length, radius1, radius2, color, quality):
+        # The cone is oriented along the z-axis of the rotation matrix, like
+        # draw_cone after a transformation.
+        self.new_cones.setdefault(quality, []).append((base, rotation, length, radius1, radius2, color, self.name))
+
+    def flush(self):
+        for groups, new_groups in (self.spheres, self.new_spheres), (self.cones, self.new_cones):
+            for quality, instances in new_groups.iteritems():
+                fields = zip(*instances)
+                group = tuple(
+                    [numpy.array(field, float) for field in fields[:-1]] +
+                    [numpy.array(fields[-1], int)]
+                )
+                if quality in groups:
+                    group = _concatenate(groups[quality], group)
+                groups[quality] = group
+            new_groups.clear()
+
+    def iter_groups(self):
+        for group in self.spheres.itervalues():
+            yield group
+        for group in self.cones.itervalues():
+            yield group
+
+    def extend(self, other):
+        self.flush()
+        other.flush()
+        for groups, other_groups in (self.spheres, other.spheres), (self.cones, other.cones):
+            for quality, group in other_groups.iteritems():
+                if quality in groups:
+                    group = _concatenate(groups[quality], group)
+                groups[quality] = group
+
+    def select(self, names, keep):
+        # keep or drop the instances with the given names
+        self.flush()
+        result = InstanceBatch()
+        names = numpy.array(list(names), int)
+        for groups, result_groups in (self.spheres, result.spheres), (self.cones, result.cones):
+            for quality, group in groups.iteritems():
+                mask = numpy.in1d(group[-1], names)
+                if not keep:
+                    mask = ~mask
+                if mask.any():
+                    result_groups[quality] = _take(group, mask)
+        return result
+
+    def subset(self, names):
+        """Return a batch with only the instances with the given names"""
+        return self.select(names, True)
+
+    def remove(self, names):
+        """Remove the instances with the given names"""
+        result = self.select(names, False)
+        self.spheres = result.spheres
+        self.cones = result.cones
+
+    def get_names(self):
+        """Return the names of all instances, without duplicates"""
+        self.flush()
+        return numpy.unique(numpy.concatenate(
+            [numpy.zeros(0, int)] + [group[-1] for group in self.iter_groups()]
+        ))
+
+    def get_max_radius(self):
+        # the largest radius of all primitives, used for the level of detail
+        self.flush()
+        result = 0.0
+        for centers, radii, colors, names in self.spheres.itervalues():
+            result = max(result, radii.max())
+        for bases, rotations, lengths, radii1, radii2, colors, names in self.cones.itervalues():
+            result = max(result, radii1.max(), radii2.max())
+        return result
+
+    max_radius = property(get_max_radius)
+
+    def get_corners(self):
+        # the lowest and highest corner of a box around all primitives, or
+        # None when the batch is empty
+        self.flush()
+        lows = []
+        highs = []
+        for centers, radii, colors, names in self.spheres.itervalues():
+            lows.append(centers - radii.reshape(-1, 1))
+            highs.append(centers + radii.reshape(-1, 1))
+        for bases, rotations, lengths, radii1, radii2, colors, names in self.cones.itervalues():
+            radii = numpy.maximum(radii1, radii2).reshape(-1, 1)
+            tops = bases + rotations[:,:,2]*lengths.reshape(-1, 1)
+            lows.append(numpy.minimum(bases, tops) - radii)
+            highs.append(numpy.maximum(bases, tops) + radii)
+        if len(lows) == 0:
+            return None
+        return numpy.array([
+            numpy.concatenate(lows).min(axis=0),
+            numpy.concatenate(highs).max(axis=0),
+        ])
+
+    corners = property(get_corners)
+
+    def split(self, tile_size):
+        """Return a dictionary with a batch for each tile that has primitives
+
+        The tiles are the cells of a cubic grid with the given size. The keys
+        are the integer coordinates of the tiles. A sphere belongs to the tile
+        of its center, a cone to the tile of the center of its axis.
+        """
+        self.flush()
+        groups = []
+        centers = []
+        for quality, group in self.spheres.iteritems():
+            groups.append((quality, group, False))
+            centers.append(group[0])
+        for quality, group in self.cones.iteritems():
+            groups.append((quality, group, True))
+            bases, rotations, lengths = group[:3]
+            centers.append(bases + rotations[:,:,2]*(0.5*lengths).reshape(-1, 1))
+        if len(groups) == 0:
+            return {}
+        cells = numpy.floor(numpy.concatenate(centers)/tile_size).astype(int)
+        # one integer per cell, such that the cells can be grouped at once
+        low = cells.min(axis=0)
+        shape = cells.max(axis=0) - low + 1
+        cells -= low
+        cell_keys = (cells[:,0]*shape[1] + cells[:,1])*shape[2] + cells[:,2]
+        cell_keys, first, tiles = numpy.unique(cell_keys, return_index=True, return_inverse=True)
+        keys = cells[first] + low
+        batches = [InstanceBatch() for key in keys]
+        bins = numpy.arange(len(keys) + 1)
+        begin = 0
+        for quality, group, cone in groups:
+            end = begin + len(group[-1])
+            group_tiles = tiles[begin:end]
+            order = group_tiles.argsort(kind="mergesort")
+            bounds = group_tiles[order].searchsorted(bins)
+            for tile in (bounds[1:] > bounds[:-1]).nonzero()[0]:
+                part = _take(group, order[bounds[tile]:bounds[tile+1]])
+                if cone:
+                    batches[tile].cones[quality] = part
+                else:
+                    batches[tile].spheres[quality] = part
+            begin = end
+        return dict(
+            (tuple(key.tolist()), batch) for key, batch
+            in zip(keys, batches)
+        )
+
+    def draw(self, vis_backend, max_quality=None, names=False):
+        # max_quality is used to draw the same batch with less detail. When
+        # names is True, the instances are drawn with the colors of their
+        # names, for picking.
+        self.flush()
+        for quality, (centers, radii, colors, instance_names) in sorted(self.spheres.iteritems()):
+            if max_quality is not None:
+                quality = min(quality, max_quality)
+            vis_backend.draw_spheres(
+                centers, radii, colors, quality,
+                (instance_names if names else None)
+            )
+        for quality, (bases, rotations, lengths, radii1, radii2, colors, instance_names) in sorted(self.cones.iteritems()):
+            if max_quality is not None:
+                quality = min(quality, max_quality)
+            vis_backend.draw_cones(
+                bases, rotations, lengths, radii1, radii2, colors, quality,
+                (instance_names if names else None)
+            )
@@ -80,6 +80,12 @@ class DrawingArea(gtk.gtkgl.DrawingArea):
     def iter_hits(self, selection_box):
         if not self.get_gl_drawable().gl_begin(self.get_gl_context()): return
         vb = context.application.vis_backend
+        if vb.supports_picking:
+            names = vb.pick(self.allocation.width, self.allocation.height, selection_box)
+            self.get_gl_drawable().gl_end()
+            for name in names:
+                yield vb.names.get(name)
+            return
         try:
             for selection in vb.draw(self.allocation.width, self.allocation.height, selection_box):
                 yield vb.names.get(selection[2][-1])
@@ -94,6 +100,13 @@ class DrawingArea(gtk.gtkgl.DrawingArea):
     def get_nearest(self, x, y):
         if not self.get_gl_drawable().gl_begin(self.get_gl_context()): return
         vb = context.application.vis_backend
+        if vb.supports_picking:
+            names = vb.pick(self.allocation.width, self.allocation.height, (x, y, x, y))
+            self.get_gl_drawable().gl_end()
+            if len(names) == 0:
+                return None
+            else:
+                return vb.names.get(names[0])
         nearest = None
         for selection in vb.draw(self.allocation.width, self.allocation.height, (x, y, x, y)):
             if nearest is None:
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Offscreen drawing of the scene, without a window
+
+The OpenGL context of VisBackendOffscreen is created with EGL when PyOpenGL
+is configured for the EGL platform, i.e. when the environment variable
+PYOPENGL_PLATFORM is 'egl', and with OSMesa otherwise. EGL uses the driver of
+the GPU while OSMesa renders in software, so the latter also works on
+machines without a GPU or X11. The variable must be set before OpenGL is
+imported.
+"""
+
+
+from vis_backends import VisBackendOpenGL
+
+from zeobuilder import context
+
+from OpenGL.GL import glClear, glFinish, glPixelStorei, glReadPixels, \
+    glViewport, GL_COLOR_BUFFER_BIT, GL_DEPTH_BUFFER_BIT, GL_PACK_ALIGNMENT, \
+    GL_RGB, GL_UNSIGNED_BYTE
+
+import numpy, os, struct, zlib, ctypes
+
+
+__all__ = [
+    "VisBackendOffscreen", "OffscreenDrawingArea", "OffscreenMain",
+    "write_png",
+]
+
+
+class VisBackendOffscreen(VisBackendOpenGL):
+    """Draws the scene in an offscreen buffer with a fixed size"""
+    def __init__(self, scene, camera, width, height):
+        VisBackendOpenGL.__init__(self, scene, camera)
+        self.width = width
+        self.height = height
+        if os.environ.get("PYOPENGL_PLATFORM") == "egl":
+            self.create_egl_context()
+        else:
+            self.create_osmesa_context()
+        glViewport(0, 0, width, height)
+
+    def create_osmesa_context(self):
+        from OpenGL import osmesa, arrays
+        self.osmesa_context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self.osmesa_context:
+            raise RuntimeError("Could not create an OSMesa context.")
+        # OSMesa draws in this buffer
+        self.osmesa_buffer = arrays.GLubyteArray.zeros((self.height, self.width, 4))
+        if not osmesa.OSMesaMakeCurrent(self.osmesa_context, self.osmesa_buffer, GL_UNSIGNED_BYTE, self.width, self.height):
+            raise RuntimeError("Could not activate the OSMesa context.")
+
+    def create_egl_context(self):
+        from OpenGL import EGL, arrays
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major = EGL.EGLint()
+        minor = EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError("Could not initialize the EGL display.")
+        config_attributes = arrays.GLintArray.asArray([
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE, 8,
+            EGL.EGL_GREEN_SIZE, 8,
+            EGL.EGL_BLUE_SIZE, 8,
+            EGL.EGL_DEPTH_SIZE, 24,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE,
+        ])
+        config = EGL.EGLConfig()
+        num_configs = EGL.EGLint()
+        if not EGL.eglChooseConfig(display, config_attributes, ctypes.pointer(config), 1, ctypes.pointer(num_configs)) or num_configs.value == 0:
+            raise RuntimeError("No suitable EGL configuration found.")
+        surface_attributes = arrays.GLintArray.asArray([
+            EGL.EGL_WIDTH, self.width,
+            EGL.EGL_HEIGHT, self.height,
+            EGL.EGL_NONE,
+        ])
+        surface = EGL.eglCreatePbufferSurface(display, config, surface_attributes)
+        if surface == EGL.EGL_NO_SURFACE:
+            raise RuntimeError("Could not create an EGL pixel buffer.")
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        egl_context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+        if egl_context == EGL.EGL_NO_CONTEXT:
+            raise RuntimeError("Could not create an EGL context.")
+        if not EGL.eglMakeCurrent(display, surface, surface, egl_context):
+            raise RuntimeError("Could not activate the EGL context.")
+        self.egl_display = display
+
+    def draw(self, width, height, selection_box=None):
+        if selection_box is not None:
+            return VisBackendOpenGL.draw(self, width, height, selection_box)
+        # Unlike on the screen, the rotation center and the interactive tool
+        # are not drawn.
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        self.apply_view(width, height)
+        context.application.scene.draw(width, height)
+
+    def render(self):
+        """Draw the scene and return the image
+
+        The result is an array with shape (height, width, 3) and with the
+        red, green and blue components of each pixel, from the top row to the
+        bottom row.
+        """
+        self.draw(self.width, self.height)
+        glFinish()
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        data = glReadPixels(0, 0, self.width, self.height, GL_RGB, GL_UNSIGNED_BYTE)
+        if not isinstance(data, str):
+            data = numpy.asarray(data, numpy.uint8).tostring()
+        image = numpy.fromstring(data, numpy.uint8).reshape((self.height, self.width, 3))
+        # OpenGL starts with the bottom row
+        return image[::-1].copy()
+
+
+class OffscreenDrawingArea(object):
+    """Replaces the drawing area of the main window in the offscreen case
+
+    The scene is only drawn on request, see VisBackendOffscreen.render.
+    """
+    def queue_draw(self):
+        pass
+
+
+class OffscreenMain(object):
+    """Replaces the main window in the offscreen case"""
+    def __init__(self):
+        self.drawing_area = OffscreenDrawingArea()
+
+    def get_current_directory(self):
+        return os.getcwd()
+
+
+def write_png(filename, image):
+    """Write an image to a PNG file
+
+    Arguments:
+      filename  --  the file to write to
+      image  --  an array with shape (height, width, 3) with the red, green
+                 and blue components of each pixel, from the top row to the
+                 bottom row
+    """
+    image = numpy.asarray(image, numpy.uint8)
+    height, width = image.shape[:2]
+    # each row starts with the filter type, zero means no filter
+    raw = "".join("\0" + row.tostring() for row in image)
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack("!I", len(data)) + tag + data + struct.pack("!I", crc)
+
+    f = file(filename, "wb")
+    try:
+        f.write("\x89PNG\r\n\x1a\n")
+        # 8 bits per sample, color type 2 (RGB), no interlacing
+        f.write(chunk("IHDR", struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk("IDAT", zlib.compress(raw)))
+        f.write(chunk("IEND", ""))
+    finally:
+        f.close()
+
+
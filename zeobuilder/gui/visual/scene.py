@@ -35,9 +35,11 @@
 from zeobuilder import context
 from zeobuilder.undefined import Undefined
 
-from molmod import angstrom, Translation
+from zeobuilder.nodes.glmixin import GLMixin
 
-import numpy
+from molmod import angstrom, Translation, Rotation
+
+import numpy, heapq, time
 
 
 class Scene(object):
@@ -70,8 +72,25 @@ class Scene(object):
             None,
         )
 
-        self.revalidations = []
+        # The scheduled revalidations, see add_revalidation. The set is used
+        # to skip revalidations that are already scheduled. The heap defines
+        # the order in which they are executed.
+        self.revalidations = set([])
+        self.revalidation_heap = []
+        self.revalidation_counter = 0
+        # The maximum time, in seconds, spent on revalidations before a frame
+        # is drawn on the screen. The remaining revalidations are done before
+        # the next frames. None means no limit.
+        self.revalidation_budget = 0.2
         self.clip_planes = []
+        # The levels of detail of the batched nodes. Each level has a maximum
+        # quality and the minimum projected radius, in pixels, of the largest
+        # primitive in the batch.
+        self.lod_levels = [(None, 16.0), (12, 6.0), (6, 0.0)]
+        # the size of the tiles in which batches are split for culling
+        self.tile_size = 10*angstrom
+        # the containers with batch lists, see GLContainerMixin.draw
+        self.batch_nodes = set([])
 
     def initialize_draw(self):
         vb = context.application.vis_backend
@@ -138,18 +157,205 @@ class Scene(object):
             return universe.model_center
     model_center = property(get_model_center)
 
-    def add_revalidation(self, revalidation):
-        self.revalidations.append(revalidation)
+    def add_revalidation(self, revalidation, depth=None):
+        """Schedule a revalidation before the next frame is drawn
+
+        A revalidation that is already scheduled is not added twice.
+        Revalidations with a depth, i.e. the number of parents of the node,
+        are executed first, starting with the deepest nodes. This way the
+        bounding box of a container is computed once, after those of its
+        children. Otherwise, the revalidations are executed in the order in
+        which they were added, such that none of them is postponed forever.
+        """
+        if revalidation in self.revalidations:
+            return
+        self.revalidations.add(revalidation)
+        self.revalidation_counter += 1
+        if depth is None:
+            key = (1, 0, self.revalidation_counter)
+        else:
+            key = (0, -depth, self.revalidation_counter)
+        heapq.heappush(self.revalidation_heap, (key, revalidation))
+
+    def revalidate(self, budget=None):
+        """Execute the scheduled revalidations
+
+        When a budget in seconds is given, the remaining revalidations are
+        postponed to the next redraw once the budget is exceeded. Return True
+        when all revalidations are done. Only then the deleted lists are
+        released, see VisBackendOpenGL.flush_deleted_lists.
+        """
+        start = time.time()
+        while len(self.revalidation_heap) > 0:
+            if budget is not None and time.time() - start > budget:
+                context.application.main.drawing_area.queue_draw()
+                return False
+            key, revalidation = heapq.heappop(self.revalidation_heap)
+            self.revalidations.discard(revalidation)
+            revalidation()
+        context.application.vis_backend.flush_deleted_lists()
+        return True
+
+    def get_frustum_planes(self, width, height):
+        """Return the planes of the view frustum in model coordinates
+
+        The result is a tuple (normals, offsets). A point r is inside the
+        frustum when numpy.dot(normals, r) + offsets is nowhere negative.
+        """
+        camera = context.application.camera
+        znear = camera.znear
+        zfar = camera.znear + camera.window_depth
+        # the same window as in VisBackendOpenGL.apply_view
+        if width > height:
+            w = 0.5*float(width) / float(height)
+            h = 0.5
+        else:
+            w = 0.5
+            h = 0.5*float(height) / float(width)
+        w *= camera.window_size
+        h *= camera.window_size
+        # planes in eye coordinates, the eye looks along the negative z-axis
+        if znear > 0.0:
+            normals = numpy.array([
+                [0, 0, -1], [0, 0, 1],
+                [-1, 0, -w/znear], [1, 0, -w/znear],
+                [0, -1, -h/znear], [0, 1, -h/znear],
+            ], float)
+            offsets = numpy.array([-znear, zfar, 0, 0, 0, 0], float)
+        else:
+            normals = numpy.array([
+                [0, 0, -1], [0, 0, 1],
+                [-1, 0, 0], [1, 0, 0],
+                [0, -1, 0], [0, 1, 0],
+            ], float)
+            offsets = numpy.array([-znear, zfar, w, w, h, h], float)
+        # transform the planes to model coordinates
+        origin, axes = self.get_eye_frame()
+        return numpy.dot(normals, axes), numpy.dot(normals, origin) + offsets
+
+    def get_eye_frame(self):
+        # the linear transformation from model to eye coordinates
+        camera = context.application.camera
+        origin = camera.model_to_eye(numpy.zeros(3, float))
+        axes = numpy.array([
+            camera.model_to_eye(axis) - origin for axis in numpy.identity(3, float)
+        ]).transpose()
+        return origin, axes
+
+    def update_batch_tiles(self, width, height):
+        """Select the level of detail and the visible images of all batch tiles
+
+        The bounding boxes of the containers are tested against the view
+        frustum and the clip planes before their tiles, from the top of the
+        tree. A tile is drawn in each periodic image of the universe where it
+        is visible, see BatchTile. Only the first list of a tile is recompiled
+        when its level or its visible images change.
+        """
+        universe = context.application.model.universe
+        if universe is None or len(self.batch_nodes) == 0:
+            return
+        pixels = min(width, height)
+        normals, offsets = self.get_frustum_planes(width, height)
+        if len(self.clip_planes) > 0:
+            clip_planes = numpy.array(self.clip_planes, float)
+            normals = numpy.concatenate([normals, clip_planes[:,:3]])
+            offsets = numpy.concatenate([offsets, clip_planes[:,3]])
+        origin, axes = self.get_eye_frame()
+        translations = universe.get_image_translations()
+        shifts = numpy.dot(translations, normals.transpose()) + offsets
+        translation_depths = -numpy.dot(translations, axes.transpose())[:,2]
+
+        def get_corners(corners, frame):
+            # the eight corners of a box, in model coordinates
+            result = numpy.array([
+                [corners[i,0], corners[j,1], corners[k,2]]
+                for i in 0, 1 for j in 0, 1 for k in 0, 1
+            ])
+            if isinstance(frame, Rotation):
+                result = numpy.dot(result, frame.r.transpose())
+            if isinstance(frame, Translation):
+                result += frame.t
+            return result
+
+        def get_visible_images(corners):
+            # a mask with the images in which the box is (partially) visible
+            highest = numpy.dot(corners, normals.transpose()).max(axis=0)
+            return ((highest + shifts) >= 0).all(axis=1)
 
-    def draw(self):
+        node_visible = {}
+        def is_node_visible(node):
+            result = node_visible.get(node)
+            if result is None:
+                if isinstance(node.parent, GLMixin) and not is_node_visible(node.parent):
+                    result = False
+                elif node.bounding_box.corners is None:
+                    result = True
+                else:
+                    result = get_visible_images(get_corners(node.bounding_box.corners, node.get_absolute_frame())).any()
+                node_visible[node] = result
+            return result
+
+        hidden = numpy.zeros((0, 3), float)
+        for node in self.batch_nodes:
+            if not node.batch_lists_valid:
+                # the tiles are updated at the next redraw
+                continue
+            visible = is_node_visible(node)
+            frame = node.get_absolute_frame()
+            for tile in node.batch_tiles.itervalues():
+                if tile.corners is None:
+                    continue
+                if not visible:
+                    tile.update(tile.level, hidden)
+                    continue
+                corners = get_corners(tile.corners, frame)
+                mask = get_visible_images(corners)
+                if not mask.any():
+                    tile.update(tile.level, hidden)
+                    continue
+                # the translations of the images in the frame of the node
+                local_translations = translations[mask]
+                if isinstance(frame, Rotation):
+                    local_translations = numpy.dot(local_translations, frame.r)
+                # the level of detail at the corner that is closest to the eye
+                depth = (
+                    -(numpy.dot(corners, axes.transpose()) + origin)[:,2].max() +
+                    translation_depths[mask].min()
+                )
+                tile.update(self.get_lod_level(tile.radius, depth, pixels), local_translations)
+
+    def get_lod_level(self, radius, depth, pixels):
+        """Return the level of detail of a batch tile, see lod_levels
+
+        Arguments:
+          radius  --  the largest radius of the primitives in the tile
+          depth  --  the distance from the eye to the closest point of the
+                     tile, along the viewing direction
+          pixels  --  the smallest dimension of the window in pixels
+        """
+        camera = context.application.camera
+        if camera.znear > 0 and depth <= 0:
+            return 0
+        projected = radius/camera.depth_to_scale(depth)*pixels
+        for index, (max_quality, min_projected) in enumerate(self.lod_levels):
+            if projected >= min_projected:
+                return index
+        return len(self.lod_levels) - 1
+
+    def draw(self, width=None, height=None):
+        # The size of the window is only given when the scene is drawn on
+        # the screen. The revalidations may then be spread over several
+        # frames and the batch tiles are updated for the current view.
         vb = context.application.vis_backend
         for plane_i, coefficients in enumerate(self.clip_planes):
             vb.set_clip_plane(plane_i, coefficients)
 
-        self.revalidations.reverse()
-        for revalidation in self.revalidations:
-            revalidation()
-        self.revalidations = []
+        if width is None:
+            self.revalidate()
+        else:
+            self.revalidate(self.revalidation_budget)
+        if width is not None:
+            self.update_batch_tiles(width, height)
         universe = context.application.model.universe
         if universe is not None:
             vb.call_list(universe.total_list)
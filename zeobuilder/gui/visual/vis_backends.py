@@ -33,29 +33,44 @@
 
 
 from tools import Tool
+from batch import sphere_mesh, circle_mesh, disk_mesh
 
 from zeobuilder import context
 
 from molmod import Translation, Rotation
 
-from OpenGL.GLU import gluCylinder, gluDisk, gluNewQuadric, gluPickMatrix, \
-    gluQuadricNormals, gluQuadricOrientation, gluSphere, GLU_INSIDE, \
-    GLU_OUTSIDE, GLU_SMOOTH
-from OpenGL.GL import glBegin, glCallList, glClear, glClearColor, glClipPlane, \
-    glCullFace, glDeleteLists, glDepthFunc, glDisable, glEnable, glEnd, \
-    glEndList, glFogfv, glFrustum, glGenLists, glInitNames, glLight, \
-    glLineWidth, glLoadIdentity, glMaterial, glMatrixMode, glMultMatrixf, \
-    glNewList, glNormal3fv, glOrtho, glPopMatrix, \
+from OpenGL.GLU import gluPickMatrix
+from OpenGL.GL import glBegin, glCallList, glCallLists, glClear, \
+    glClearColor, glClipPlane, glColor3ub, glColorMaterial, glColorPointer, \
+    glCullFace, glPixelStorei, glPopAttrib, glPushAttrib, glReadPixels, \
+    glScissor, \
+    glDeleteLists, glDepthFunc, glDisable, glDisableClientState, \
+    glDrawElements, glEnable, glEnableClientState, glEnd, glEndList, \
+    glFogfv, glFrustum, glGenLists, glInitNames, glLight, glLineWidth, \
+    glListBase, glLoadIdentity, glMaterial, glMatrixMode, glMultMatrixf, \
+    glNewList, glNormal3fv, glNormalPointer, glOrtho, glPopMatrix, \
     glPopName, glPushMatrix, glPushName, glRenderMode, glRotate, \
     glSelectBuffer, glShadeModel, glTranslate, glTranslatef, glVertex, \
+    glVertexPointer, \
     GL_AMBIENT, GL_AMBIENT_AND_DIFFUSE, GL_BACK, GL_CLIP_PLANE0, \
     GL_CLIP_PLANE1, GL_CLIP_PLANE2, GL_CLIP_PLANE3, GL_CLIP_PLANE4, \
-    GL_CLIP_PLANE5, GL_COLOR_BUFFER_BIT, GL_COMPILE, GL_DEPTH_BUFFER_BIT, \
+    GL_CLIP_PLANE5, GL_COLOR_ARRAY, GL_COLOR_BUFFER_BIT, GL_COLOR_MATERIAL, \
+    GL_COMPILE, GL_DEPTH_BUFFER_BIT, GL_FLOAT, GL_NORMAL_ARRAY, \
+    GL_UNSIGNED_INT, GL_VERTEX_ARRAY, GL_CURRENT_BIT, GL_DEPTH_COMPONENT24, \
+    GL_DITHER, GL_ENABLE_BIT, GL_FLAT, GL_FOG_BIT, GL_LIGHTING_BIT, \
+    GL_PACK_ALIGNMENT, GL_RGBA, GL_RGBA8, GL_SCISSOR_BIT, GL_SCISSOR_TEST, \
+    GL_UNSIGNED_BYTE, \
     GL_DEPTH_TEST, GL_FOG, GL_FOG_COLOR, GL_FOG_END, GL_FOG_MODE, \
-    GL_FOG_START, GL_FRONT, GL_LESS, GL_LIGHT0, GL_LIGHTING, GL_LINEAR, \
+    GL_FOG_START, GL_FRONT, GL_LEQUAL, GL_LESS, GL_LIGHT0, GL_LIGHTING, GL_LINEAR, \
     GL_LINES, GL_MODELVIEW, GL_POLYGON, GL_POSITION, GL_PROJECTION, GL_QUADS, \
     GL_QUAD_STRIP, GL_RENDER, GL_SELECT, GL_SHININESS, GL_SMOOTH, \
     GL_SPECULAR, GL_TRIANGLES, GL_TRIANGLE_STRIP
+from OpenGL.GL.EXT.framebuffer_object import glBindFramebufferEXT, \
+    glBindRenderbufferEXT, glDeleteFramebuffersEXT, glDeleteRenderbuffersEXT, \
+    glFramebufferRenderbufferEXT, glGenFramebuffersEXT, glGenRenderbuffersEXT, \
+    glInitFramebufferObjectEXT, glRenderbufferStorageEXT, \
+    GL_COLOR_ATTACHMENT0_EXT, GL_DEPTH_ATTACHMENT_EXT, GL_FRAMEBUFFER_EXT, \
+    GL_RENDERBUFFER_EXT
 
 import numpy
 
@@ -63,12 +78,20 @@ __all__ = ["VisBackend", "VisBackendOpenGL"]
 
 
 class VisBackend(object):
+    # set to True when the batch related methods are implemented
+    supports_batches = False
+    # set to True when the pick method is implemented
+    supports_picking = False
+
     def initialize_draw(self):
         context.application.scene.initialize_draw()
 
     def draw(self):
         raise NotImplementedError
 
+    def pick(self, width, height, selection_box):
+        raise NotImplementedError
+
     #
     # List related functuions
     #
@@ -79,6 +102,9 @@ class VisBackend(object):
     def delete_list(self, l):
         raise NotImplementedError
 
+    def flush_deleted_lists(self):
+        raise NotImplementedError
+
     def begin_list(self, l):
         raise NotImplementedError
 
@@ -88,6 +114,25 @@ class VisBackend(object):
     def call_list(self, l):
         raise NotImplementedError
 
+    #
+    # Batch related functions
+    #
+
+    def create_batch_lists(self, size):
+        raise NotImplementedError
+
+    def delete_batch_lists(self, l, size):
+        raise NotImplementedError
+
+    def call_batch_lists(self, l):
+        raise NotImplementedError
+
+    def begin_periodic_image(self):
+        raise NotImplementedError
+
+    def end_periodic_image(self):
+        raise NotImplementedError
+
     #
     # Names
     #
@@ -98,6 +143,15 @@ class VisBackend(object):
     def pop_name(self):
         raise NotImplementedError
 
+    def set_name_color(self, name):
+        raise NotImplementedError
+
+    def create_name(self, owner):
+        raise NotImplementedError
+
+    def delete_name(self, name):
+        raise NotImplementedError
+
     #
     # Transform functions
     #
@@ -127,6 +181,9 @@ class VisBackend(object):
     def set_bright(self, bright):
         raise NotImplementedError
 
+    def set_overlay(self, overlay):
+        raise NotImplementedError
+
     def set_specular(self, specular):
         raise NotImplementedError
 
@@ -161,6 +218,12 @@ class VisBackend(object):
     def draw_disk(self, radius, quality):
         raise NotImplementedError
 
+    def draw_spheres(self, centers, radii, colors, quality, names=None):
+        raise NotImplementedError
+
+    def draw_cones(self, bases, rotations, lengths, radii1, radii2, colors, quality, names=None):
+        raise NotImplementedError
+
     def set_quadric_outside(self):
         raise NotImplementedError
 
@@ -221,22 +284,33 @@ def gl_apply_inverse(transformation):
 
 class VisBackendOpenGL(VisBackend):
     select_buffer_size = 1024*64
+    supports_batches = True
 
     def __init__(self, scene, camera):
         VisBackend.__init__(self)
         #self.name_counter = 0
         #self.matrix_counter = 0
         self.names = {}
+        # the names of the nodes without lists, see create_name
+        self.next_name = 1 << 23
+        self.free_names = []
+        # The lists and names that are deleted after the scheduled
+        # revalidations, see flush_deleted_lists.
+        self.deleted_lists = []
+        self.deleted_names = []
         self.clip_constants = [GL_CLIP_PLANE0, GL_CLIP_PLANE1, GL_CLIP_PLANE2, GL_CLIP_PLANE3, GL_CLIP_PLANE4, GL_CLIP_PLANE5]
         self.tool = Tool()
+        # unit meshes, see get_mesh
+        self.meshes = {}
+        self.quadric_inside = False
+        # the offscreen frame buffer for picking, see pick
+        self.pick_buffer = None
 
     #
     # Generic stuff
     #
 
     def initialize_draw(self):
-        self.quadric = gluNewQuadric()
-        gluQuadricNormals(self.quadric, GLU_SMOOTH)
         self.set_specular(True)
         self.set_bright(False)
         glLight(GL_LIGHT0, GL_SPECULAR, [0.7, 0.7, 0.7, 1.0])
@@ -247,12 +321,31 @@ class VisBackendOpenGL(VisBackend):
         glDepthFunc(GL_LESS)
         glEnable(GL_DEPTH_TEST)
         glCullFace(GL_BACK)
+        self.supports_picking = bool(glInitFramebufferObjectEXT())
+        # The lists that switch the list base in the periodic images, see
+        # call_batch_lists. The list that is executed depends on the list
+        # base at the time of the call.
+        self.begin_image_lists = glGenLists(3)
+        glNewList(self.begin_image_lists, GL_COMPILE)
+        glListBase(2)
+        glEndList()
+        glNewList(self.begin_image_lists + 1, GL_COMPILE)
+        glEndList()
+        glNewList(self.begin_image_lists + 2, GL_COMPILE)
+        glEndList()
+        self.end_image_lists = glGenLists(3)
+        glNewList(self.end_image_lists, GL_COMPILE)
+        glEndList()
+        glNewList(self.end_image_lists + 1, GL_COMPILE)
+        glEndList()
+        glNewList(self.end_image_lists + 2, GL_COMPILE)
+        glListBase(0)
+        glEndList()
         VisBackend.initialize_draw(self)
         self.tool.initialize_gl()
 
     def draw(self, width, height, selection_box=None):
         scene = context.application.scene
-        camera = context.application.camera
 
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         if selection_box is not None:
@@ -260,6 +353,30 @@ class VisBackendOpenGL(VisBackend):
             glSelectBuffer(self.select_buffer_size)
             glRenderMode(GL_SELECT)
             glInitNames()
+            # draw the batched nodes with their own names, see
+            # call_batch_lists
+            glListBase(1)
+
+        self.apply_view(width, height, selection_box, selection_box is None)
+        if selection_box is None:
+            scene.draw(width, height)
+        else:
+            scene.draw()
+
+        if selection_box is not None:
+            glListBase(0)
+            # now let the caller analyze the hits by returning the selection
+            # buffer. Note: The selection buffer can be used as an iterator
+            # over 3-tupples (near, far, names) where names is tuple that
+            # contains the gl_names associated with the encountered vertices.
+            return glRenderMode(GL_RENDER)
+        else:
+            # draw the interactive tool (e.g. selection rectangle):
+            glCallList(self.tool.total_list)
+
+    def apply_view(self, width, height, selection_box=None, draw_rotation_center=False):
+        scene = context.application.scene
+        camera = context.application.camera
 
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
@@ -291,7 +408,7 @@ class VisBackendOpenGL(VisBackend):
         gl_apply_inverse(camera.eye)
         glTranslatef(0.0, 0.0, -znear)
         # Draw the rotation center, only when realy drawing objects:
-        if selection_box is None:
+        if draw_rotation_center:
             glMaterial(GL_FRONT, GL_AMBIENT_AND_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
             glShadeModel(GL_SMOOTH)
             self.call_list(scene.rotation_center_list)
@@ -301,17 +418,79 @@ class VisBackendOpenGL(VisBackend):
         gl_apply_inverse(camera.rotation_center)
         gl_apply_inverse(scene.model_center)
 
-        scene.draw()
+    def pick(self, width, height, selection_box):
+        """Return the names of the lists that are visible in the selection box
 
-        if selection_box is not None:
-            # now let the caller analyze the hits by returning the selection
-            # buffer. Note: The selection buffer can be used as an iterator
-            # over 3-tupples (near, far, names) where names is tuple that
-            # contains the gl_names associated with the encountered vertices.
-            return glRenderMode(GL_RENDER)
+        The scene is drawn in an offscreen frame buffer, where each named list
+        gets a flat color that encodes its name, see push_name. The pixels in
+        the selection box are read back at once. The names are sorted by the
+        number of pixels they cover, starting with the largest.
+        """
+        scene = context.application.scene
+
+        self.bind_pick_buffer(width, height)
+        glPushAttrib(GL_COLOR_BUFFER_BIT | GL_ENABLE_BIT | GL_LIGHTING_BIT | GL_FOG_BIT | GL_SCISSOR_BIT)
+        glDisable(GL_LIGHTING)
+        glDisable(GL_FOG)
+        glDisable(GL_DITHER)
+        glShadeModel(GL_FLAT)
+        # the window coordinates have the y-axis pointing down
+        left = max(0, min(width - 1, int(min(selection_box[0], selection_box[2]))))
+        right = max(0, min(width - 1, int(max(selection_box[0], selection_box[2]))))
+        bottom = max(0, min(height - 1, height - 1 - int(max(selection_box[1], selection_box[3]))))
+        top = max(0, min(height - 1, height - 1 - int(min(selection_box[1], selection_box[3]))))
+        glEnable(GL_SCISSOR_TEST)
+        glScissor(left, bottom, right - left + 1, top - bottom + 1)
+        glClearColor(0.0, 0.0, 0.0, 0.0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        # draw the batched nodes with their own names, see call_batch_lists
+        glListBase(1)
+        self.apply_view(width, height)
+        scene.draw()
+        glListBase(0)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        pixels = glReadPixels(left, bottom, right - left + 1, top - bottom + 1, GL_RGBA, GL_UNSIGNED_BYTE)
+        glPopAttrib()
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+
+        if isinstance(pixels, str):
+            pixels = numpy.frombuffer(pixels, numpy.uint8)
+        pixels = numpy.asarray(pixels, numpy.uint8).reshape(-1, 4).astype(int)
+        names = pixels[:,0] | (pixels[:,1] << 8) | (pixels[:,2] << 16)
+        names.sort()
+        names, first = numpy.unique(names, return_index=True)
+        counts = numpy.diff(numpy.append(first, len(pixels)))
+        # zero is the background
+        mask = names != 0
+        names = names[mask]
+        counts = counts[mask]
+        return names[counts.argsort()[::-1]].tolist()
+
+    def bind_pick_buffer(self, width, height):
+        # the frame buffer is only recreated when the size of the window
+        # changes
+        if self.pick_buffer is not None and self.pick_buffer[3:] != (width, height):
+            self.delete_pick_buffer()
+        if self.pick_buffer is None:
+            frame_buffer = glGenFramebuffersEXT(1)
+            color_buffer, depth_buffer = glGenRenderbuffersEXT(2)
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, frame_buffer)
+            glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, color_buffer)
+            glRenderbufferStorageEXT(GL_RENDERBUFFER_EXT, GL_RGBA8, width, height)
+            glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_RENDERBUFFER_EXT, color_buffer)
+            glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, depth_buffer)
+            glRenderbufferStorageEXT(GL_RENDERBUFFER_EXT, GL_DEPTH_COMPONENT24, width, height)
+            glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_DEPTH_ATTACHMENT_EXT, GL_RENDERBUFFER_EXT, depth_buffer)
+            glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, 0)
+            self.pick_buffer = (frame_buffer, color_buffer, depth_buffer, width, height)
         else:
-            # draw the interactive tool (e.g. selection rectangle):
-            glCallList(self.tool.total_list)
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.pick_buffer[0])
+
+    def delete_pick_buffer(self):
+        frame_buffer, color_buffer, depth_buffer = self.pick_buffer[:3]
+        glDeleteRenderbuffersEXT(2, numpy.array([color_buffer, depth_buffer], numpy.uint32))
+        glDeleteFramebuffersEXT(1, numpy.array([frame_buffer], numpy.uint32))
+        self.pick_buffer = None
 
     #
     # List related functuions
@@ -324,10 +503,21 @@ class VisBackendOpenGL(VisBackend):
         return l
 
     def delete_list(self, l):
-        glDeleteLists(l, 1)
+        self.deleted_lists.append((l, 1))
         if l in self.names:
             del self.names[l]
 
+    def flush_deleted_lists(self):
+        # Lists that are not yet revalidated may still call deleted lists.
+        # The numbers of the deleted lists are therefore only released when
+        # all revalidations are done, see Scene.revalidate, such that
+        # glGenLists can not hand them out to other nodes in the meantime.
+        for l, size in self.deleted_lists:
+            glDeleteLists(l, size)
+        self.deleted_lists = []
+        self.free_names.extend(self.deleted_names)
+        self.deleted_names = []
+
     def begin_list(self, l):
         glNewList(l, GL_COMPILE)
 
@@ -337,12 +527,39 @@ class VisBackendOpenGL(VisBackend):
     def call_list(self, l):
         glCallList(l)
 
+    #
+    # Batch related functions
+    #
+
+    def create_batch_lists(self, size):
+        # a contiguous range of lists, see GLContainerMixin and BatchTile
+        return glGenLists(size)
+
+    def delete_batch_lists(self, l, size):
+        self.deleted_lists.append((l, size))
+
+    def call_batch_lists(self, l):
+        # The list base is added at execution time. It is zero when drawing,
+        # such that the first list with the tiles is called. It is one while
+        # selecting, such that the second list with all batched nodes is
+        # called. It is two in the periodic images that are drawn by the
+        # tiles themselves, such that the third list (empty) is called.
+        glCallLists(numpy.array([l], numpy.uint32))
+
+    def begin_periodic_image(self):
+        # Skip the batches in the following lists, except while selecting.
+        glCallLists(numpy.array([self.begin_image_lists], numpy.uint32))
+
+    def end_periodic_image(self):
+        glCallLists(numpy.array([self.end_image_lists], numpy.uint32))
+
     #
     # Names
     #
 
     def push_name(self, name):
         glPushName(name)
+        self.set_name_color(name)
         #self.name_counter += 1
         #print "NAME UP  ", self.name_counter
 
@@ -352,6 +569,37 @@ class VisBackendOpenGL(VisBackend):
         #print "NAME DOWN", self.name_counter
         #assert self.name_counter >= 0
 
+    def create_name(self, owner):
+        # A name for a node that has no lists, see GLMixin.batched. These
+        # names are taken above the numbers of the lists, within the 24 bits
+        # of the colors used for picking.
+        if len(self.free_names) > 0:
+            name = self.free_names.pop()
+        else:
+            name = self.next_name
+            self.next_name += 1
+        self.names[name] = owner
+        return name
+
+    def delete_name(self, name):
+        del self.names[name]
+        self.deleted_names.append(name)
+
+    def set_name_color(self, name):
+        # The flat color is only visible while picking, see pick. It is not
+        # restored by pop_name, so a container sets its own color again after
+        # the lists of its children, see GLContainerMixin.draw.
+        glColor3ub(name & 255, (name >> 8) & 255, (name >> 16) & 255)
+
+    def get_name_colors(self, names):
+        # the flat colors of the names, see push_name
+        colors = numpy.ones((len(names), 4), float)
+        colors[:,0] = names & 255
+        colors[:,1] = (names >> 8) & 255
+        colors[:,2] = (names >> 16) & 255
+        colors[:,:3] /= 255
+        return colors
+
     #
     # Transform functions
     #
@@ -390,6 +638,14 @@ class VisBackendOpenGL(VisBackend):
         else:
             glMaterial(GL_FRONT, GL_SHININESS, 70.0)
 
+    def set_overlay(self, overlay):
+        # Draw the same geometry once more on top of itself, e.g. the
+        # highlight of the selected instances in a BatchTile.
+        if overlay:
+            glDepthFunc(GL_LEQUAL)
+        else:
+            glDepthFunc(GL_LESS)
+
     def set_specular(self, specular):
         if specular:
             glMaterial(GL_FRONT, GL_SPECULAR, [0.7, 0.7, 0.7, 1.0])
@@ -449,23 +705,152 @@ class VisBackendOpenGL(VisBackend):
                 glVertex(vector)
         glEnd()
 
+    def get_mesh(self, primitive, quality):
+        # The unit meshes are tessellated only once for each quality. Display
+        # lists can not be nested in the lists under construction, so the
+        # meshes are kept as arrays and scaled by the draw functions.
+        key = (primitive, quality)
+        mesh = self.meshes.get(key)
+        if mesh is None:
+            if primitive == "sphere":
+                mesh = sphere_mesh(quality)
+            elif primitive == "cone":
+                mesh = circle_mesh(quality)
+            elif primitive == "disk":
+                mesh = disk_mesh(quality)
+            else:
+                raise ValueError("Unknown primitive: %s" % primitive)
+            self.meshes[key] = mesh
+        return mesh
+
     def draw_sphere(self, radius, quality):
-        gluSphere(self.quadric, radius, quality, quality/2)
+        vertices, triangles = self.get_mesh("sphere", quality)
+        self.draw_mesh(vertices*radius, vertices, triangles)
 
     def draw_cylinder(self, radius, length, quality):
-        gluCylinder(self.quadric, radius, radius, length, quality, 1)
+        self.draw_cone(radius, radius, length, quality)
 
     def draw_cone(self, radius1, radius2, length, quality):
-        gluCylinder(self.quadric, radius1, radius2, length, quality, 1)
+        cosines, sines, triangles = self.get_mesh("cone", quality)
+        size = len(cosines)
+        vertices = numpy.zeros((2*size, 3), float)
+        vertices[:size,0] = radius1*cosines
+        vertices[:size,1] = radius1*sines
+        vertices[size:,0] = radius2*cosines
+        vertices[size:,1] = radius2*sines
+        vertices[size:,2] = length
+        normals = numpy.zeros((2*size, 3), float)
+        normals[:,0] = numpy.concatenate([cosines, cosines])
+        normals[:,1] = numpy.concatenate([sines, sines])
+        if length != 0:
+            normals[:,2] = (radius1 - radius2)/length
+        normals /= numpy.sqrt((normals**2).sum(axis=1)).reshape(-1, 1)
+        self.draw_mesh(vertices, normals, triangles)
 
     def draw_disk(self, radius, quality):
-        gluDisk(self.quadric, 0, radius, quality, 1)
+        vertices, triangles = self.get_mesh("disk", quality)
+        normals = numpy.zeros(vertices.shape, float)
+        normals[:,2] = 1
+        self.draw_mesh(vertices*radius, normals, triangles)
+
+    def draw_mesh(self, vertices, normals, triangles):
+        # The meshes are oriented to the outside, like the quadrics of GLU.
+        if self.quadric_inside:
+            normals = -normals
+            triangles = triangles[:,::-1]
+        self.draw_triangle_arrays(vertices, normals, None, triangles)
+
+    def draw_triangle_arrays(self, vertices, normals, colors, triangles):
+        # All triangles are drawn at once from vertex arrays. When colors are
+        # given, the colors of the vertices are used as material color.
+        vertices = numpy.ascontiguousarray(vertices, numpy.float32)
+        normals = numpy.ascontiguousarray(normals, numpy.float32)
+        triangles = numpy.ascontiguousarray(triangles, numpy.uint32)
+        if colors is not None:
+            # the current color is undefined after drawing a color array
+            glPushAttrib(GL_CURRENT_BIT | GL_ENABLE_BIT)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 0, vertices)
+        glNormalPointer(GL_FLOAT, 0, normals)
+        if colors is not None:
+            colors = numpy.ascontiguousarray(colors, numpy.float32)
+            glColorMaterial(GL_FRONT, GL_AMBIENT_AND_DIFFUSE)
+            glEnable(GL_COLOR_MATERIAL)
+            glEnableClientState(GL_COLOR_ARRAY)
+            glColorPointer(4, GL_FLOAT, 0, colors)
+        glDrawElements(GL_TRIANGLES, triangles.size, GL_UNSIGNED_INT, triangles)
+        glDisableClientState(GL_NORMAL_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        if colors is not None:
+            glDisableClientState(GL_COLOR_ARRAY)
+            glPopAttrib()
+
+    def draw_spheres(self, centers, radii, colors, quality, names=None):
+        # When names are given, each sphere is drawn with its own name, see
+        # InstanceBatch.
+        if names is not None:
+            if not self.supports_picking:
+                for index, name in enumerate(names):
+                    self.push_name(name)
+                    self.draw_spheres(
+                        centers[index:index+1], radii[index:index+1],
+                        colors[index:index+1], quality
+                    )
+                    self.pop_name()
+                return
+            colors = self.get_name_colors(names)
+        unit_vertices, unit_triangles = self.get_mesh("sphere", quality)
+        size = len(unit_vertices)
+        vertices = unit_vertices*radii.reshape(-1, 1, 1) + centers.reshape(-1, 1, 3)
+        normals = numpy.resize(unit_vertices, vertices.shape)
+        triangles = unit_triangles + (numpy.arange(len(centers))*size).reshape(-1, 1, 1)
+        self.draw_triangle_arrays(
+            vertices.reshape(-1, 3), normals.reshape(-1, 3),
+            numpy.repeat(colors, size, axis=0), triangles,
+        )
+
+    def draw_cones(self, bases, rotations, lengths, radii1, radii2, colors, quality, names=None):
+        # see draw_spheres
+        if names is not None:
+            if not self.supports_picking:
+                for index, name in enumerate(names):
+                    self.push_name(name)
+                    self.draw_cones(
+                        bases[index:index+1], rotations[index:index+1],
+                        lengths[index:index+1], radii1[index:index+1],
+                        radii2[index:index+1], colors[index:index+1], quality
+                    )
+                    self.pop_name()
+                return
+            colors = self.get_name_colors(names)
+        cosines, sines, unit_triangles = self.get_mesh("cone", quality)
+        size = 2*len(cosines)
+        # the vertices and normals in the frames of the cones
+        local_vertices = numpy.zeros((len(bases), 2, len(cosines), 3), float)
+        local_vertices[:,0,:,0] = numpy.outer(radii1, cosines)
+        local_vertices[:,0,:,1] = numpy.outer(radii1, sines)
+        local_vertices[:,1,:,0] = numpy.outer(radii2, cosines)
+        local_vertices[:,1,:,1] = numpy.outer(radii2, sines)
+        local_vertices[:,1,:,2] = lengths.reshape(-1, 1)
+        local_normals = numpy.zeros(local_vertices.shape, float)
+        local_normals[:,:,:,0] = cosines
+        local_normals[:,:,:,1] = sines
+        local_normals[:,:,:,2] = ((radii1 - radii2)/lengths).reshape(-1, 1, 1)
+        local_normals /= numpy.sqrt((local_normals**2).sum(axis=3)).reshape(local_normals.shape[:3] + (1,))
+        vertices = numpy.einsum("nij,nkj->nki", rotations, local_vertices.reshape(len(bases), -1, 3)) + bases.reshape(-1, 1, 3)
+        normals = numpy.einsum("nij,nkj->nki", rotations, local_normals.reshape(len(bases), -1, 3))
+        triangles = unit_triangles + (numpy.arange(len(bases))*size).reshape(-1, 1, 1)
+        self.draw_triangle_arrays(
+            vertices.reshape(-1, 3), normals.reshape(-1, 3),
+            numpy.repeat(colors, size, axis=0), triangles,
+        )
 
     def set_quadric_outside(self):
-        gluQuadricOrientation(self.quadric, GLU_OUTSIDE)
+        self.quadric_inside = False
 
     def set_quadric_inside(self):
-        gluQuadricOrientation(self.quadric, GLU_INSIDE)
+        self.quadric_inside = True
 
     #
     # Clip functions
@@ -36,6 +36,8 @@ from parent_mixin import ContainerMixin
 from glmixin import GLMixin
 
 from zeobuilder import context
+from zeobuilder.nodes.helpers import BatchTile
+from zeobuilder.gui.visual.batch import InstanceBatch
 
 
 __all__ = ["GLContainerMixin"]
@@ -77,14 +79,117 @@ class GLContainerMixin(ContainerMixin):
         vb.set_bright(False)
 
     def draw(self):
+        vb = context.application.vis_backend
+        batched = False
         for child in self.children:
-            child.call_list()
+            if child.batched:
+                batched = True
+            else:
+                child.call_list()
+                # the child leaves the color of its name behind
+                vb.set_name_color(self.draw_list)
+        if batched:
+            if self.batch_lists is None:
+                self.batch_lists = vb.create_batch_lists(3)
+                context.application.scene.batch_nodes.add(self)
+                self.batch_lists_valid = True
+                self.invalidate_batch_lists()
+            vb.call_batch_lists(self.batch_lists)
+            vb.set_name_color(self.draw_list)
+
+    #
+    # Invalidation
+    #
+
+    def invalidate_batch_child(self, child, geometry=True):
+        # Only the tiles of the batched children that are marked here are
+        # compiled again. When geometry is False, only the selection changed.
+        if self.gl_active:
+            self.batch_dirty[child] = geometry or self.batch_dirty.get(child, False)
+            self.invalidate_batch_lists()
+
+    def invalidate_batch_lists(self):
+        if self.gl_active and self.batch_lists is not None and self.batch_lists_valid:
+            self.batch_lists_valid = False
+            context.application.main.drawing_area.queue_draw()
+            context.application.scene.add_revalidation(self.revalidate_batch_lists)
 
 
     #
     # Revalidation
     #
 
+    def revalidate_batch_lists(self):
+        # The visible batched children are drawn from their instances, in
+        # spatial tiles that can be culled separately, see BatchTile and
+        # Scene.update_batch_tiles. batch_children keeps the name and the
+        # tiles of each child, such that only the tiles of the children in
+        # batch_dirty are compiled again. The first list calls the lists of
+        # all tiles. The second list calls the lists with the names of the
+        # instances, which is used for picking. The third list is empty, see
+        # VisBackendOpenGL.call_batch_lists.
+        if self.gl_active and self.batch_lists is not None:
+            vb = context.application.vis_backend
+            scene = context.application.scene
+            changed = set([])
+            highlighted = set([])
+            removed = []
+            added = {}
+            batch = InstanceBatch()
+            for child, geometry in self.batch_dirty.items():
+                name, keys = self.batch_children.get(child, (None, []))
+                if not geometry:
+                    highlighted.update(keys)
+                    continue
+                if name is not None:
+                    del self.batch_children[child]
+                    removed.append(name)
+                    for key in keys:
+                        self.batch_tiles[key].children.discard(child)
+                    changed.update(keys)
+                if child.gl_active and child.parent is self and child.visible:
+                    batch.name = child.batch_name
+                    child.add_instances(batch)
+                    added[child.batch_name] = child
+            self.batch_dirty.clear()
+            for key in changed:
+                self.batch_tiles[key].batch.remove(removed)
+            for key, tile_batch in batch.split(scene.tile_size).iteritems():
+                tile = self.batch_tiles.get(key)
+                if tile is None:
+                    tile = BatchTile(len(scene.lod_levels))
+                    self.batch_tiles[key] = tile
+                tile.batch.extend(tile_batch)
+                changed.add(key)
+                for name in tile_batch.get_names().tolist():
+                    child = added[name]
+                    tile.children.add(child)
+                    self.batch_children.setdefault(child, (name, []))[1].append(key)
+            for key in changed:
+                tile = self.batch_tiles[key]
+                if len(tile.batch) == 0:
+                    tile.delete()
+                    del self.batch_tiles[key]
+                else:
+                    tile.compile(scene.lod_levels, self.get_selected_names(tile))
+            for key in highlighted - changed:
+                tile = self.batch_tiles[key]
+                tile.compile_selection(scene.lod_levels, self.get_selected_names(tile))
+            vb.begin_list(self.batch_lists)
+            for tile in self.batch_tiles.itervalues():
+                vb.call_list(tile.lists)
+            vb.end_list()
+            vb.begin_list(self.batch_lists + 1)
+            for tile in self.batch_tiles.itervalues():
+                vb.call_list(tile.lists + 1)
+            vb.end_list()
+            vb.begin_list(self.batch_lists + 2)
+            vb.end_list()
+            self.batch_lists_valid = True
+
+    def get_selected_names(self, tile):
+        return [child.batch_name for child in tile.children if child.selected]
+
     def revalidate_bounding_box(self):
         for child in self.children:
             child_bounding_box = child.get_bounding_box_in_parent_frame()
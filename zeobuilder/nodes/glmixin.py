@@ -55,6 +55,9 @@ class GLMixin(gobject.GObject):
 
     __metaclass__ = NodeClass
     double_sided = False
+    # batchable nodes are drawn together by their parent container, see
+    # add_instances and GLContainerMixin.revalidate_batch_lists
+    batchable = False
 
     #
     # State
@@ -99,18 +102,35 @@ class GLMixin(gobject.GObject):
     # OpenGL
     #
 
+    def get_batched(self):
+        # Batched nodes have no lists of their own. They are drawn and picked
+        # from the instances they add to the tiles of their parent, see
+        # add_instances and GLContainerMixin.revalidate_batch_lists.
+        vb = context.application.vis_backend
+        return self.batchable and vb.supports_batches and isinstance(self.parent, GLMixin)
+
     def initialize_gl(self):
         assert not self.gl_active
         vb = context.application.vis_backend
         self.gl_active = True
+        self.batched = self.get_batched()
         self.bounding_box = BoundingBox()
-        self.draw_list = vb.create_list(self)
-        self.boundingbox_list = vb.create_list()
-        self.total_list = vb.create_list()
-        ##print "Created lists (%i, %i, %i): %s" % (self.draw_list, self.boundingbox_list, self.total_list, self.get_name())
+        if self.batched:
+            self.batch_name = vb.create_name(self)
+        else:
+            self.draw_list = vb.create_list(self)
+            self.boundingbox_list = vb.create_list()
+            self.total_list = vb.create_list()
+            ##print "Created lists (%i, %i, %i): %s" % (self.draw_list, self.boundingbox_list, self.total_list, self.get_name())
         self.draw_list_valid = True
         self.boundingbox_list_valid = True
         self.total_list_valid = True
+        # the lists of the batched children, see GLContainerMixin
+        self.batch_lists = None
+        self.batch_lists_valid = True
+        self.batch_tiles = {}
+        self.batch_children = {}
+        self.batch_dirty = {}
         self.invalidate_all_lists()
         if isinstance(self.parent, GLMixin):
             self.parent.invalidate_all_lists()
@@ -119,19 +139,36 @@ class GLMixin(gobject.GObject):
         assert self.gl_active
         self.gl_active = False
         vb = context.application.vis_backend
-        ##print "Deleting lists (%i, %i, %i): %s" % (self.draw_list, self.boundingbox_list, self.total_list, self.get_name())
-        vb.delete_list(self.draw_list)
-        vb.delete_list(self.boundingbox_list)
-        vb.delete_list(self.total_list)
+        if self.batched:
+            vb.delete_name(self.batch_name)
+            del self.batch_name
+        else:
+            ##print "Deleting lists (%i, %i, %i): %s" % (self.draw_list, self.boundingbox_list, self.total_list, self.get_name())
+            vb.delete_list(self.draw_list)
+            vb.delete_list(self.boundingbox_list)
+            vb.delete_list(self.total_list)
+            del self.draw_list
+            del self.boundingbox_list
+            del self.total_list
+        if self.batch_lists is not None:
+            vb.delete_batch_lists(self.batch_lists, 3)
+            context.application.scene.batch_nodes.discard(self)
+        for tile in self.batch_tiles.itervalues():
+            tile.delete()
         del self.bounding_box
-        del self.draw_list
-        del self.boundingbox_list
-        del self.total_list
         del self.draw_list_valid
         del self.boundingbox_list_valid
         del self.total_list_valid
+        del self.batch_lists
+        del self.batch_lists_valid
+        del self.batch_tiles
+        del self.batch_children
+        del self.batch_dirty
         if isinstance(self.parent, GLMixin):
             self.parent.invalidate_all_lists()
+            if self.batched:
+                self.parent.invalidate_batch_child(self)
+        del self.batched
 
 
     #
@@ -139,7 +176,11 @@ class GLMixin(gobject.GObject):
     #
 
     def invalidate_draw_list(self):
-        if self.gl_active and self.draw_list_valid:
+        if self.gl_active and self.batched:
+            self.parent.invalidate_batch_child(self)
+            self.emit("on-draw-list-invalidated")
+            self.parent.invalidate_boundingbox_list()
+        elif self.gl_active and self.draw_list_valid:
             self.draw_list_valid = False
             context.application.main.drawing_area.queue_draw()
             context.application.scene.add_revalidation(self.revalidate_draw_list)
@@ -154,14 +195,18 @@ class GLMixin(gobject.GObject):
         if self.gl_active and self.boundingbox_list_valid:
             self.boundingbox_list_valid = False
             context.application.main.drawing_area.queue_draw()
-            context.application.scene.add_revalidation(self.revalidate_boundingbox_list)
+            context.application.scene.add_revalidation(self.revalidate_boundingbox_list, self.get_depth())
             self.emit("on-boundingbox-list-invalidated")
             ##print "EMIT %s: on-boundingbox-list-invalidated"  % self.get_name()
             if isinstance(self.parent, GLMixin):
                 self.parent.invalidate_boundingbox_list()
 
     def invalidate_total_list(self):
-        if self.gl_active and self.total_list_valid:
+        if self.gl_active and self.batched:
+            self.parent.invalidate_batch_child(self)
+            self.emit("on-total-list-invalidated")
+            self.parent.invalidate_boundingbox_list()
+        elif self.gl_active and self.total_list_valid:
             self.total_list_valid = False
             context.application.main.drawing_area.queue_draw()
             context.application.scene.add_revalidation(self.revalidate_total_list)
@@ -175,6 +220,15 @@ class GLMixin(gobject.GObject):
         self.invalidate_boundingbox_list()
         self.invalidate_draw_list()
 
+    def get_depth(self):
+        # the number of parents that are drawn, see Scene.add_revalidation
+        result = 0
+        parent = self.parent
+        while isinstance(parent, GLMixin):
+            result += 1
+            parent = parent.parent
+        return result
+
     #
     # Revalidation
     #
@@ -192,12 +246,16 @@ class GLMixin(gobject.GObject):
 
     def revalidate_boundingbox_list(self):
         if self.gl_active:
-            vb = context.application.vis_backend
-            ##print "Compiling selection list (%i): %s" % (self.boundingbox_list, self.get_name())
-            vb.begin_list(self.boundingbox_list)
-            self.revalidate_bounding_box()
-            self.bounding_box.draw()
-            vb.end_list()
+            if self.batched:
+                # only the box itself is used, by the parent
+                self.revalidate_bounding_box()
+            else:
+                vb = context.application.vis_backend
+                ##print "Compiling selection list (%i): %s" % (self.boundingbox_list, self.get_name())
+                vb.begin_list(self.boundingbox_list)
+                self.revalidate_bounding_box()
+                self.bounding_box.draw()
+                vb.end_list()
             self.boundingbox_list_valid = True
 
     def revalidate_bounding_box(self):
@@ -227,6 +285,10 @@ class GLMixin(gobject.GObject):
         else:
             vb.set_bright(False)
 
+    def add_instances(self, batch):
+        # only called for batchable nodes, see InstanceBatch
+        raise NotImplementedError
+
     def call_list(self):
         ##print "Executing total list (%i): %s" % (self.total_list, self.get_name())
         context.application.vis_backend.call_list(self.total_list)
@@ -280,7 +342,11 @@ class GLMixin(gobject.GObject):
     #
 
     def on_select_changed(self, foo):
-        self.invalidate_total_list()
+        if self.gl_active and self.batched:
+            # only the highlight changes, see BatchTile
+            self.parent.invalidate_batch_child(self, False)
+        else:
+            self.invalidate_total_list()
 
 gobject.signal_new("on-draw-list-invalidated", GLMixin, gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
 gobject.signal_new("on-boundingbox-list-invalidated", GLMixin, gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
@@ -366,17 +432,20 @@ class GLTransformationMixin(GLMixin):
 
     def initialize_gl(self):
         vb = context.application.vis_backend
-        self.transformation_list = vb.create_list()
-        ##print "Created transformation list (%i): %s" % (self.transformation_list, self.get_name())
+        if not self.get_batched():
+            self.transformation_list = vb.create_list()
+            ##print "Created transformation list (%i): %s" % (self.transformation_list, self.get_name())
         self.transformation_list_valid = True
         GLMixin.initialize_gl(self)
 
     def cleanup_gl(self):
+        batched = self.batched
         GLMixin.cleanup_gl(self)
-        vb = context.application.vis_backend
-        ##print "Deleting transformation list (%i): %s" % (self.transformation_list, self.get_name())
-        vb.delete_list(self.transformation_list)
-        del self.transformation_list
+        if not batched:
+            vb = context.application.vis_backend
+            ##print "Deleting transformation list (%i): %s" % (self.transformation_list, self.get_name())
+            vb.delete_list(self.transformation_list)
+            del self.transformation_list
         del self.transformation_list_valid
 
     #
@@ -385,7 +454,11 @@ class GLTransformationMixin(GLMixin):
 
     def invalidate_transformation_list(self):
         ##print "CALL %s: on-transformation-list-invalidated" % self.get_name()
-        if self.gl_active and self.transformation_list_valid:
+        if self.gl_active and self.batched:
+            self.parent.invalidate_batch_child(self)
+            self.emit("on-transformation-list-invalidated")
+            self.parent.invalidate_boundingbox_list()
+        elif self.gl_active and self.transformation_list_valid:
             self.transformation_list_valid = False
             context.application.main.drawing_area.queue_draw()
             context.application.scene.add_revalidation(self.revalidate_transformation_list)
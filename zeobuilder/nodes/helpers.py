@@ -36,13 +36,14 @@ from zeobuilder import context
 from zeobuilder.nodes.meta import NodeClass, Property
 from zeobuilder.gui.fields_dialogs import DialogFieldInfo
 import zeobuilder.gui.fields as fields
+from zeobuilder.gui.visual.batch import InstanceBatch
 
 from molmod import angstrom
 
 import numpy
 
 
-__all__ = ["FrameAxes", "BoundingBox"]
+__all__ = ["FrameAxes", "BoundingBox", "BatchTile"]
 
 
 def draw_axis_spike(thickness, length):
@@ -253,3 +254,81 @@ class BoundingBox(object):
         vb.call_list(context.application.scene.end_mesh_list)
 
 
+class BatchTile(object):
+    """The display lists of a part of the batched children of a container
+
+    The first list calls the list of the current level of detail and the
+    list with the selection highlight once for each visible periodic image,
+    with the translation of that image in the frame of the container. It is
+    empty when the tile is culled. The second list draws all primitives with
+    the names of their nodes, for picking. The following lists draw the
+    primitives at each level of detail (see Scene.lod_levels), and then the
+    selected primitives once more, as a bright overlay. The level and the
+    visible images of a tile can thus be changed by recompiling only the
+    first list, and the selection by recompiling only the overlays.
+    """
+
+    def __init__(self, num_levels):
+        vb = context.application.vis_backend
+        self.num_levels = num_levels
+        self.lists = vb.create_batch_lists(2 + 2*num_levels)
+        self.level = 0
+        self.offsets = numpy.zeros((1, 3), float)
+        self.corners = None
+        self.radius = 0.0
+        # the instances of the tile and the nodes that added them
+        self.batch = InstanceBatch()
+        self.children = set([])
+        self.compile_switch()
+
+    def delete(self):
+        vb = context.application.vis_backend
+        vb.delete_batch_lists(self.lists, 2 + 2*self.num_levels)
+
+    def compile(self, lod_levels, selected_names):
+        vb = context.application.vis_backend
+        self.corners = self.batch.corners
+        self.radius = self.batch.max_radius
+        vb.begin_list(self.lists + 1)
+        self.batch.draw(vb, names=True)
+        vb.end_list()
+        for level, (max_quality, min_projected) in enumerate(lod_levels):
+            vb.begin_list(self.lists + 2 + level)
+            self.batch.draw(vb, max_quality)
+            vb.end_list()
+        self.compile_selection(lod_levels, selected_names)
+
+    def compile_selection(self, lod_levels, selected_names):
+        vb = context.application.vis_backend
+        selected = self.batch.subset(selected_names)
+        for level, (max_quality, min_projected) in enumerate(lod_levels):
+            vb.begin_list(self.lists + 2 + self.num_levels + level)
+            if len(selected) > 0:
+                vb.set_overlay(True)
+                vb.set_bright(True)
+                selected.draw(vb, max_quality)
+                vb.set_bright(False)
+                vb.set_overlay(False)
+            vb.end_list()
+
+    def compile_switch(self):
+        vb = context.application.vis_backend
+        vb.begin_list(self.lists)
+        for offset in self.offsets:
+            if (offset == 0).all():
+                vb.call_list(self.lists + 2 + self.level)
+                vb.call_list(self.lists + 2 + self.num_levels + self.level)
+            else:
+                vb.push_matrix()
+                vb.translate(*offset)
+                vb.call_list(self.lists + 2 + self.level)
+                vb.call_list(self.lists + 2 + self.num_levels + self.level)
+                vb.pop_matrix()
+        vb.end_list()
+
+    def update(self, level, offsets):
+        if level != self.level or offsets.shape != self.offsets.shape or (offsets != self.offsets).any():
+            self.level = level
+            self.offsets = offsets
+            self.compile_switch()
+
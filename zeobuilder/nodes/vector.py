@@ -102,15 +102,20 @@ class Vector(GLReferentBase):
 
     def revalidate_boundingbox_list(self):
         if self.gl_active:
-            vb = context.application.vis_backend
-            #print "Compiling selection list (" + str(self.boundingbox_list) + "): " + str(self.name)
-            vb.begin_list(self.boundingbox_list)
-            vb.push_matrix()
-            vb.transform(self.orientation)
-            self.revalidate_bounding_box()
-            self.bounding_box.draw()
-            vb.pop_matrix()
-            vb.end_list()
+            # the orientation is also used by get_bounding_box_in_parent_frame
+            self.calc_vector_dimensions()
+            if self.batched:
+                self.revalidate_bounding_box()
+            else:
+                vb = context.application.vis_backend
+                #print "Compiling selection list (" + str(self.boundingbox_list) + "): " + str(self.name)
+                vb.begin_list(self.boundingbox_list)
+                vb.push_matrix()
+                vb.transform(self.orientation)
+                self.revalidate_bounding_box()
+                self.bounding_box.draw()
+                vb.pop_matrix()
+                vb.end_list()
             self.boundingbox_list_valid = True
 
     #
@@ -92,7 +92,11 @@ class PluginNotFoundError(Exception):
 
 
 class PluginsCollection(object):
-    def __init__(self):
+    def __init__(self, tolerant=False):
+        # When tolerant, modules that can not be loaded, e.g. because they
+        # create dialogs and there is no display, are skipped. They are
+        # listed in failed_modules.
+        self.tolerant = tolerant
         self.module_descriptions = set([])
         for directory in context.share_dir, context.user_dir:
             self.find_modules(os.path.join(directory, "plugins"))
@@ -113,11 +117,17 @@ class PluginsCollection(object):
 
     def load_modules(self):
         self.modules = []
+        self.failed_modules = []
         for directory, name in self.module_descriptions:
             #print name, directory
             (f, pathname, description) = imp.find_module(name, [directory])
             try:
-                self.modules.append(imp.load_module(name, f, pathname, description))
+                try:
+                    self.modules.append(imp.load_module(name, f, pathname, description))
+                except Exception, e:
+                    if not self.tolerant:
+                        raise
+                    self.failed_modules.append((pathname, "%s: %s" % (e.__class__.__name__, e)))
             finally:
                 f.close()
 
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Zeobuilder is an extensible GUI-toolkit for molecular model construction.
+# Copyright (C) 2007 - 2012 Toon Verstraelen <Toon.Verstraelen@UGent.be>, Center
+# for Molecular Modeling (CMM), Ghent University, Ghent, Belgium; all rights
+# reserved unless otherwise stated.
+#
+# This file is part of Zeobuilder.
+#
+# Zeobuilder is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# In addition to the regulations of the GNU General Public License,
+# publications and communications based in parts on this program or on
+# parts of this program are required to cite the following article:
+#
+# "ZEOBUILDER: a GUI toolkit for the construction of complex molecules on the
+# nanoscale with building blocks", Toon Verstraelen, Veronique Van Speybroeck
+# and Michel Waroquier, Journal of Chemical Information and Modeling, Vol. 48
+# (7), 1530-1541, 2008
+# DOI:10.1021/ci8000748
+#
+# Zeobuilder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+#--
+"""Headless rendering of Zeobuilder models
+
+This module draws images of ZML files, or of any other format with a load
+filter, without a window. The images are rendered offscreen, see
+zeobuilder.gui.visual.offscreen, by a pool of worker processes and are
+written to PNG files. A sequence of frames in which the model turns around
+the vertical axis of the screen can be used for movies. See main for the
+command line.
+"""
+
+
+from zeobuilder import context
+
+from molmod import angstrom, deg, Translation, Rotation
+
+import os, sys, optparse, multiprocessing
+
+
+__all__ = ["main"]
+
+
+def parse_rotation(description):
+    """Convert a string 'x,y,z,angle' into a rotation axis and an angle"""
+    try:
+        values = [float(word) for word in description.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != 4 or values[:3] == [0.0, 0.0, 0.0]:
+        raise ValueError("A rotation must be given as x,y,z,angle, got '%s'." % description)
+    return values[:3], values[3]*deg
+
+
+def get_model_name(filename):
+    name = os.path.basename(filename)
+    for extension in ".gz", ".bz2":
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return os.path.splitext(name)[0]
+
+
+def make_jobs(filenames, options):
+    """Return a list of jobs, one for each frame of each model
+
+    The frames of one model are consecutive, such that a worker process can
+    draw them without loading the model again.
+    """
+    axis, angle = parse_rotation(options.rotation)
+    result = []
+    for filename in filenames:
+        for frame in xrange(options.frames):
+            result.append({
+                "filename": filename,
+                "output": options.output % {
+                    "name": get_model_name(filename),
+                    "frame": frame,
+                },
+                "axis": axis,
+                "angle": angle,
+                "turn": options.turn*deg*frame/options.frames,
+                "viewer_distance": options.viewer_distance*angstrom,
+                "opening_angle": options.opening_angle*deg,
+                "window_size": options.window_size*angstrom,
+                "window_depth": options.window_depth*angstrom,
+            })
+    return result
+
+
+def _initialize_worker(width, height):
+    # Each worker process has its own application and OpenGL context.
+    from zeobuilder.application import HeadlessApplication
+    HeadlessApplication(width, height)
+
+
+def render_frame(job):
+    from zeobuilder.gui.visual.offscreen import write_png
+
+    application = context.application
+    model = application.model
+    filename = os.path.normpath(os.path.realpath(job["filename"]))
+    if model.filename != filename:
+        model.file_open(filename)
+
+    camera = application.camera
+    camera.reset()
+    camera.eye = Translation([0, 0, job["viewer_distance"]])
+    camera.opening_angle = job["opening_angle"]
+    camera.window_size = job["window_size"]
+    camera.window_depth = job["window_depth"]
+    camera.rotation = (
+        Rotation.from_properties(job["angle"], job["axis"], False) *
+        Rotation.from_properties(job["turn"], [0, 1, 0], False)
+    )
+    # the fog depends on the window depth
+    application.scene.update_render_settings()
+
+    write_png(job["output"], application.vis_backend.render())
+
+
+def _render_frame_safe(job):
+    # Used in the process pool, such that one failing frame does not stop the
+    # others.
+    try:
+        render_frame(job)
+        return job["output"], None
+    except Exception, e:
+        return job["output"], "%s: %s" % (e.__class__.__name__, e)
+
+
+usage = """Usage: %prog [options] model1 [model2 ...]
+
+Draws images of the given models, e.g. ZML files, without a window and
+writes them to PNG files. With --frames, a sequence of images is drawn in
+which the model turns around the vertical axis of the image. All lengths are
+in angstrom and all angles in degrees.
+
+The OpenGL context is created with OSMesa, which renders in software and
+works on machines without a GPU or X11, or with EGL, see --platform."""
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage)
+    parser.add_option("-o", "--output", default="%(name)s-%(frame)04i.png",
+        help="The filenames of the images. %(name)s is replaced by the "
+        "filename of the model without extension and %(frame)i by the frame "
+        "number. [default=%default]")
+    parser.add_option("--width", type="int", default=800, help="[default=%default]")
+    parser.add_option("--height", type="int", default=600, help="[default=%default]")
+    parser.add_option("--viewer-distance", type="float", default=100.0,
+        help="[default=%default]")
+    parser.add_option("--opening-angle", type="float", default=0.0,
+        help="Zero means orthogonal projection. [default=%default]")
+    parser.add_option("--window-size", type="float", default=25.0,
+        help="[default=%default]")
+    parser.add_option("--window-depth", type="float", default=200.0,
+        help="[default=%default]")
+    parser.add_option("--rotation", default="0,0,1,0",
+        help="The rotation of the model, as x,y,z,angle. [default=%default]")
+    parser.add_option("--frames", type="int", default=1,
+        help="The number of images of each model. [default=%default]")
+    parser.add_option("--turn", type="float", default=360.0,
+        help="The rotation of the model over all frames. [default=%default]")
+    parser.add_option("--platform", choices=["osmesa", "egl"],
+        default=os.environ.get("PYOPENGL_PLATFORM", "osmesa"),
+        help="osmesa or egl. [default=%default]")
+    parser.add_option("-j", "--processes", type="int", default=1,
+        help="The number of processes that draw the images in parallel. "
+        "[default=%default]")
+    (options, args) = parser.parse_args(argv)
+
+    if len(args) == 0:
+        parser.error("Expecting at least one model.")
+    for filename in args:
+        if not os.path.isfile(filename):
+            parser.error("File %s does not exist." % filename)
+    if options.width <= 0 or options.height <= 0:
+        parser.error("The width and the height must be positive.")
+    if options.frames <= 0:
+        parser.error("The number of frames must be positive.")
+    try:
+        jobs = make_jobs(args, options)
+    except (ValueError, KeyError, TypeError), e:
+        parser.error(str(e))
+
+    # PyOpenGL reads this variable when it is imported in the workers.
+    os.environ["PYOPENGL_PLATFORM"] = options.platform
+    pool = multiprocessing.Pool(
+        options.processes, _initialize_worker, (options.width, options.height)
+    )
+    try:
+        failed = 0
+        chunksize = max(1, options.frames/options.processes)
+        for output, error in pool.imap(_render_frame_safe, jobs, chunksize):
+            if error is None:
+                print output
+            else:
+                print >> sys.stderr, "%s: %s" % (output, error)
+                failed += 1
+    finally:
+        pool.terminate()
+        pool.join()
+    if failed > 0:
+        sys.exit(1)
+
+